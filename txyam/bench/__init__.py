@@ -0,0 +1,5 @@
+"""
+A benchmark harness that runs the client against fake memcached servers
+(see L{txyam.bench.server}) or real ones.  Run
+C{python -m txyam.bench --help} for its options.
+"""
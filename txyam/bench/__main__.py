@@ -0,0 +1,97 @@
+"""
+Run benchmarks from the command line, for instance:
+
+    python -m txyam.bench --servers 4 --distribution zipfian --pool-size 2
+"""
+import random
+import sys
+from argparse import ArgumentParser
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from txyam.bench.server import listen
+from txyam.bench.workload import Benchmark, DISTRIBUTIONS
+from txyam.client import YamClient
+from txyam.routing import HashRingRouter, KetamaRouter, RendezvousRouter
+
+
+ROUTERS = {'hashring': HashRingRouter, 'ketama': KetamaRouter, 'rendezvous': RendezvousRouter}
+
+
+def parseArguments(argv):
+    parser = ArgumentParser(prog="python -m txyam.bench", description="Benchmark the txyam client.")
+    parser.add_argument("--servers", type=int, default=2,
+                        help="the number of in-process fake servers to start")
+    parser.add_argument("--hosts", help="comma separated host:port servers to use instead")
+    parser.add_argument("--operations", default=",".join(Benchmark.operations),
+                        help="comma separated operations to run, of %s" % ", ".join(Benchmark.operations))
+    parser.add_argument("--distribution", choices=sorted(DISTRIBUTIONS), default="uniform")
+    parser.add_argument("--keys", type=int, default=10000, help="the number of distinct keys")
+    parser.add_argument("--value-size", type=int, default=100, help="bytes per value")
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="the fraction of requests that are writes")
+    parser.add_argument("--batch", type=int, default=10, help="keys per getMultiple")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=20000, help="requests per operation")
+    parser.add_argument("--duration", type=float, help="seconds per operation, instead of --requests")
+    parser.add_argument("--seed", type=int, help="seed for choosing keys")
+    parser.add_argument("--router", choices=sorted(ROUTERS), default="hashring")
+    parser.add_argument("--pool-size", type=int, default=1)
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--binary", action="store_true",
+                        help="use the binary protocol (the fake servers only speak text, so needs --hosts)")
+    parser.add_argument("--batch-window", type=float)
+    parser.add_argument("--merge-gets", action="store_true")
+    parser.add_argument("--buffer-large-values", action="store_true")
+    args = parser.parse_args(argv)
+    if args.duration is not None:
+        args.requests = None
+    if args.binary and not args.hosts:
+        parser.error("--binary needs --hosts")
+    for operation in args.operations.split(","):
+        if operation not in Benchmark.operations:
+            parser.error("unknown operation %r" % operation)
+    return args
+
+
+def report(result):
+    def milliseconds(seconds):
+        return "%9.3f" % (seconds * 1000) if seconds is not None else "        -"
+    rate = result['opsPerSecond'] or 0
+    cpu = result['cpuPerOp'] * 1000000 if result['cpuPerOp'] is not None else 0
+    print "%-12s %8d %6d %10.0f %s %s %10.1f" % (result['operation'], result['requests'], result['errors'], rate,
+                                                 milliseconds(result['p50']), milliseconds(result['p99']), cpu)
+
+
+@inlineCallbacks
+def run(args):
+    if args.hosts:
+        hosts = []
+        for hostport in args.hosts.split(","):
+            host, _, port = hostport.partition(":")
+            hosts.append((host, int(port or 11211)))
+    else:
+        hosts = [("127.0.0.1", listen().getHost().port) for _ in xrange(args.servers)]
+    client = YamClient(hosts, connect=False, router=ROUTERS[args.router], poolSize=args.pool_size,
+                       replicas=args.replicas, binary=args.binary, batchWindow=args.batch_window,
+                       mergeGets=args.merge_gets, bufferLargeValues=args.buffer_large_values)
+    yield client.connect()
+    print "%-12s %8s %6s %10s %9s %9s %10s" % ("operation", "requests", "errors", "ops/sec",
+                                               "p50 ms", "p99 ms", "cpu us/op")
+    for operation in args.operations.split(","):
+        keys = DISTRIBUTIONS[args.distribution](args.keys, rand=random.Random(args.seed))
+        benchmark = Benchmark(client, operation, keys, args.value_size, args.write_ratio, args.concurrency,
+                              args.requests, args.duration, args.batch)
+        result = yield benchmark.run()
+        report(result)
+    client.disconnect()
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    run(args).addErrback(lambda failure: failure.printTraceback(sys.stderr)).addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
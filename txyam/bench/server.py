@@ -0,0 +1,279 @@
+"""
+An in-memory server that speaks enough of the memcached text protocol to
+benchmark the client against, without a real memcached.  Items are kept in
+a C{dict} with no memory limit and no eviction.
+
+Run C{python -m txyam.bench.server --port 11211} to start one on its own,
+so that its CPU time isn't counted against the client's.
+"""
+import sys
+from argparse import ArgumentParser
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+
+# exptimes longer than this are unix timestamps, not offsets
+RELATIVE_EXPTIME = 60 * 60 * 24 * 30
+
+
+class FakeMemCacheProtocol(LineReceiver):
+    """
+    Handles one client connection.  Every command is answered as soon as
+    it is read, in order.
+    """
+    MAX_LENGTH = 2048
+
+    def connectionMade(self):
+        self.storing = None
+        self.chunks = []
+        self.received = 0
+
+
+    def lineReceived(self, line):
+        parts = line.split()
+        if not parts:
+            self.sendLine("ERROR")
+            return
+        handler = getattr(self, "cmd_" + parts[0], None)
+        if handler is None:
+            self.sendLine("ERROR")
+            return
+        try:
+            handler(*parts[1:])
+        except (TypeError, ValueError):
+            self.sendLine("CLIENT_ERROR bad command line format")
+
+
+    def rawDataReceived(self, data):
+        self.chunks.append(data)
+        self.received += len(data)
+        cmd, key, flags, exptime, length, cas, noreply = self.storing
+        if self.received < length + 2:
+            return
+        data = "".join(self.chunks)
+        self.storing, self.chunks, self.received = None, [], 0
+        if data[length:length + 2] != "\r\n":
+            self.sendLine("CLIENT_ERROR bad data chunk")
+        else:
+            result = self.factory.store(cmd, key, flags, exptime, data[:length], cas)
+            if not noreply:
+                self.sendLine(result)
+        self.setLineMode(data[length + 2:])
+
+
+    def startValue(self, cmd, key, flags, exptime, length, cas=None, noreply=None):
+        self.storing = (cmd, key, int(flags), int(exptime), int(length), cas and int(cas), noreply)
+        self.setRawMode()
+
+
+    def cmd_set(self, key, flags, exptime, length, noreply=None):
+        self.startValue("set", key, flags, exptime, length, noreply=noreply)
+
+
+    def cmd_add(self, key, flags, exptime, length, noreply=None):
+        self.startValue("add", key, flags, exptime, length, noreply=noreply)
+
+
+    def cmd_replace(self, key, flags, exptime, length, noreply=None):
+        self.startValue("replace", key, flags, exptime, length, noreply=noreply)
+
+
+    def cmd_append(self, key, flags, exptime, length, noreply=None):
+        self.startValue("append", key, flags, exptime, length, noreply=noreply)
+
+
+    def cmd_prepend(self, key, flags, exptime, length, noreply=None):
+        self.startValue("prepend", key, flags, exptime, length, noreply=noreply)
+
+
+    def cmd_cas(self, key, flags, exptime, length, cas, noreply=None):
+        self.startValue("cas", key, flags, exptime, length, cas, noreply)
+
+
+    def cmd_get(self, *keys):
+        self.sendValues(keys, False)
+
+
+    def cmd_gets(self, *keys):
+        self.sendValues(keys, True)
+
+
+    def sendValues(self, keys, withIdentifier):
+        if not keys:
+            self.sendLine("ERROR")
+            return
+        lines = []
+        for key in keys:
+            item = self.factory.fetch(key)
+            if item is None:
+                continue
+            flags, value, cas = item[:3]
+            if withIdentifier:
+                lines.append("VALUE %s %d %d %d\r\n" % (key, flags, len(value), cas))
+            else:
+                lines.append("VALUE %s %d %d\r\n" % (key, flags, len(value)))
+            lines.append(value)
+            lines.append("\r\n")
+        lines.append("END\r\n")
+        self.transport.write("".join(lines))
+
+
+    def cmd_delete(self, key, noreply=None):
+        result = "DELETED" if self.factory.delete(key) else "NOT_FOUND"
+        if not noreply:
+            self.sendLine(result)
+
+
+    def cmd_incr(self, key, value, noreply=None):
+        self.change(key, int(value), noreply)
+
+
+    def cmd_decr(self, key, value, noreply=None):
+        self.change(key, -int(value), noreply)
+
+
+    def change(self, key, delta, noreply):
+        item = self.factory.fetch(key)
+        if item is None:
+            result = "NOT_FOUND"
+        elif not item[1].isdigit():
+            result = "CLIENT_ERROR cannot increment or decrement non-numeric value"
+        else:
+            # increments wrap around, decrements stop at 0
+            value = max(int(item[1]) + delta, 0) % 2 ** 64
+            result = str(value)
+            item[1] = result
+            item[2] = self.factory.nextIdentifier()
+        if not noreply:
+            self.sendLine(result)
+
+
+    def cmd_touch(self, key, exptime, noreply=None):
+        item = self.factory.fetch(key)
+        if item is not None:
+            item[3] = self.factory.expiresAt(int(exptime))
+        if not noreply:
+            self.sendLine("TOUCHED" if item is not None else "NOT_FOUND")
+
+
+    def cmd_flush_all(self, *args):
+        self.factory.items.clear()
+        if "noreply" not in args:
+            self.sendLine("OK")
+
+
+    def cmd_version(self):
+        self.sendLine("VERSION txyam-fake")
+
+
+    def cmd_stats(self, *args):
+        stats = dict(self.factory.counts, curr_items=len(self.factory.items))
+        for name, value in sorted(stats.items()):
+            self.sendLine("STAT %s %s" % (name, value))
+        self.sendLine("END")
+
+
+    def cmd_quit(self):
+        self.transport.loseConnection()
+
+
+class FakeMemCacheServerFactory(ServerFactory):
+    """
+    Holds the items for every connection to one fake server.
+    """
+    protocol = FakeMemCacheProtocol
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.items = {}
+        self.identifier = 0
+        self.counts = {'cmd_get': 0, 'get_hits': 0, 'get_misses': 0, 'cmd_set': 0}
+
+
+    def nextIdentifier(self):
+        self.identifier += 1
+        return self.identifier
+
+
+    def expiresAt(self, exptime):
+        if exptime == 0:
+            return None
+        if exptime < 0:
+            return 0
+        if exptime <= RELATIVE_EXPTIME:
+            return self.clock.seconds() + exptime
+        return exptime
+
+
+    def fetch(self, key, count=True):
+        """
+        @return: The C{[flags, value, cas, expires]} C{list} for C{key}, or
+        C{None} if it isn't set or has expired.
+        """
+        item = self.items.get(key)
+        if item is not None and item[3] is not None and item[3] <= self.clock.seconds():
+            del self.items[key]
+            item = None
+        if count:
+            self.counts['cmd_get'] += 1
+            self.counts['get_hits' if item is not None else 'get_misses'] += 1
+        return item
+
+
+    def store(self, cmd, key, flags, exptime, value, cas=None):
+        """
+        @return: The response line for the storage command.
+        """
+        self.counts['cmd_set'] += 1
+        item = self.fetch(key, count=False)
+        if cmd == "add" and item is not None:
+            return "NOT_STORED"
+        if cmd in ("replace", "append", "prepend") and item is None:
+            return "NOT_STORED"
+        if cmd == "cas":
+            if item is None:
+                return "NOT_FOUND"
+            if item[2] != cas:
+                return "EXISTS"
+        if cmd == "append":
+            item[1] += value
+            item[2] = self.nextIdentifier()
+        elif cmd == "prepend":
+            item[1] = value + item[1]
+            item[2] = self.nextIdentifier()
+        else:
+            self.items[key] = [flags, value, self.nextIdentifier(), self.expiresAt(exptime)]
+        return "STORED"
+
+
+    def delete(self, key):
+        return self.items.pop(key, None) is not None
+
+
+def listen(port=0, interface="127.0.0.1", clock=None):
+    """
+    Start a fake server.
+
+    @param port: The TCP port to listen on, or 0 for any free port.
+
+    @return: The C{IListeningPort}.  Its C{getHost().port} is the port it
+    is listening on, and its C{factory} holds the items.
+    """
+    return reactor.listenTCP(port, FakeMemCacheServerFactory(clock), interface=interface)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Run a fake memcached server.")
+    parser.add_argument("--port", type=int, default=11211)
+    parser.add_argument("--interface", default="127.0.0.1")
+    args = parser.parse_args(argv)
+    log.startLogging(sys.stdout)
+    listen(args.port, args.interface)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
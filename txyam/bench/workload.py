@@ -0,0 +1,178 @@
+"""
+Key distributions and the loop that drives a L{txyam.client.YamClient}
+with them while measuring throughput, latency and CPU time.
+"""
+import os
+import random
+import time
+from bisect import bisect
+
+from twisted.internet.defer import inlineCallbacks, gatherResults, returnValue
+
+from txyam.stats import Histogram
+from txyam.utils import memoize
+
+
+class UniformKeys:
+    """
+    Every one of C{count} keys is equally likely.
+    """
+    def __init__(self, count, prefix="bench:", rand=None):
+        self.keys = ["%s%d" % (prefix, index) for index in xrange(count)]
+        self.random = rand or random.Random()
+
+
+    def next(self):
+        return self.keys[self.random.randrange(len(self.keys))]
+
+
+class ZipfianKeys(UniformKeys):
+    """
+    The Nth most popular of C{count} keys is read in proportion to
+    M{1 / N ** skew}, so that a few keys get most of the traffic.
+    """
+    def __init__(self, count, prefix="bench:", rand=None, skew=0.99):
+        UniformKeys.__init__(self, count, prefix, rand)
+        self.cumulative = []
+        total = 0.0
+        for rank in xrange(1, count + 1):
+            total += 1.0 / rank ** skew
+            self.cumulative.append(total)
+
+
+    def next(self):
+        index = bisect(self.cumulative, self.random.random() * self.cumulative[-1])
+        return self.keys[min(index, len(self.keys) - 1)]
+
+
+DISTRIBUTIONS = {'uniform': UniformKeys, 'zipfian': ZipfianKeys}
+
+
+def makeValue(size):
+    """
+    @return: A C{str} of C{size} hex digits, which compresses about as well
+    as typical cached data.
+    """
+    return os.urandom((size + 1) // 2).encode('hex')[:size]
+
+
+class Benchmark:
+    """
+    Runs one operation against a client from C{concurrency} loops at once,
+    each of which waits for its last request before sending the next, until
+    C{requests} requests have been made or C{duration} seconds have passed.
+
+    The operations are C{get}, C{getMultiple}, C{getPickled} and
+    C{memoize}.  A C{writeRatio} fraction of requests are writes instead
+    (C{set} or C{setPickled}); memoized calls write on their own misses.
+    """
+    operations = ('get', 'getMultiple', 'getPickled', 'memoize')
+
+    def __init__(self, client, operation, keys, valueSize=100, writeRatio=0.1, concurrency=10,
+                 requests=10000, duration=None, batch=10):
+        """
+        @param keys: A L{UniformKeys} or L{ZipfianKeys}.
+
+        @param batch: The number of keys in each C{getMultiple}.
+        """
+        if operation not in self.operations:
+            raise ValueError("Unknown operation %r" % operation)
+        self.client = client
+        self.operation = operation
+        self.keys = keys
+        self.value = makeValue(valueSize)
+        self.writeRatio = writeRatio
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.batch = batch
+        self.compute = memoize(client)(self.computeValue)
+        self.histogram = Histogram(smallest=0.00001, factor=1.05)
+        self.sent = 0
+        self.errors = 0
+        self.deadline = None
+
+
+    def computeValue(self, key):
+        return self.value
+
+
+    def preload(self, chunk=100):
+        """
+        Store every key, so that reads hit.  Memoized values are left to be
+        computed by the benchmark itself.
+
+        @return: A C{Deferred} that fires when they are all stored.
+        """
+        if self.operation == 'memoize':
+            return gatherResults([])
+        if self.operation == 'getPickled':
+            store = self.client.setMultiplePickled
+        else:
+            store = self.client.setMultiple
+        keys = self.keys.keys
+        ds = []
+        for index in xrange(0, len(keys), chunk):
+            ds.append(store(dict.fromkeys(keys[index:index + chunk], self.value)))
+        return gatherResults(ds)
+
+
+    def request(self):
+        """
+        @return: A C{Deferred} for one randomly chosen read or write.
+        """
+        key = self.keys.next()
+        write = self.writeRatio and self.keys.random.random() < self.writeRatio
+        if self.operation == 'memoize':
+            return self.compute(key)
+        if self.operation == 'getPickled':
+            if write:
+                return self.client.setPickled(key, self.value)
+            return self.client.getPickled(key)
+        if write:
+            return self.client.set(key, self.value)
+        if self.operation == 'getMultiple':
+            return self.client.getMultiple([key] + [self.keys.next() for _ in xrange(self.batch - 1)])
+        return self.client.get(key)
+
+
+    def finished(self):
+        if self.requests is not None and self.sent >= self.requests:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+    @inlineCallbacks
+    def worker(self):
+        while not self.finished():
+            self.sent += 1
+            started = time.time()
+            try:
+                yield self.request()
+            except Exception:
+                self.errors += 1
+            self.histogram.record(time.time() - started)
+
+
+    @inlineCallbacks
+    def run(self):
+        """
+        Preload the keys and run the benchmark.
+
+        @return: A C{Deferred} that fires with a C{dict} of results: the
+        number of C{requests} and C{errors}, the C{seconds} taken,
+        C{opsPerSecond}, the C{p50} and C{p99} latencies in seconds, and
+        C{cpuPerOp}, the CPU seconds used by this process per request.
+        """
+        yield self.preload()
+        self.deadline = time.time() + self.duration if self.duration is not None else None
+        cpu = sum(os.times()[:2])
+        started = time.time()
+        yield gatherResults([self.worker() for _ in xrange(self.concurrency)])
+        seconds = time.time() - started
+        cpu = sum(os.times()[:2]) - cpu
+        count = self.histogram.count
+        returnValue({'operation': self.operation, 'requests': count, 'errors': self.errors,
+                     'seconds': seconds, 'opsPerSecond': count / seconds if seconds else None,
+                     'p50': self.histogram.percentile(50), 'p99': self.histogram.percentile(99),
+                     'cpuPerOp': cpu / count if count else None})
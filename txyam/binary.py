@@ -0,0 +1,550 @@
+"""
+The memcached binary protocol.
+
+L{BinaryMemCacheProtocol} has the same commands, and fires its C{Deferred}s
+with the same results, as L{txyam.factory.ConnectingMemCacheProtocol}, so
+either can be used by L{txyam.client.YamClient}.  Responses are
+length-prefixed, so no line parsing is needed.  Multi-gets are sent as quiet
+C{GETKQ} requests followed by a C{NOOP}, so misses cost nothing on the wire,
+and storage and delete commands sent while pipelining are quiet too, so a
+batch of them only gets responses for the ones that fail.
+"""
+import struct
+from collections import deque
+
+from twisted.internet.defer import Deferred, TimeoutError, succeed, fail
+from twisted.internet.protocol import Protocol
+from twisted.protocols.memcache import ClientError, ServerError, NoSuchCommand
+from twisted.protocols.policies import TimeoutMixin
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from txyam.factory import MemCacheClientFactory, Pipelining, observed
+
+
+HEADER = struct.Struct("!BBHBBHIIQ")
+REQUEST = 0x80
+RESPONSE = 0x81
+
+GET = 0x00
+SET = 0x01
+ADD = 0x02
+REPLACE = 0x03
+DELETE = 0x04
+INCREMENT = 0x05
+DECREMENT = 0x06
+FLUSH = 0x08
+NOOP = 0x0a
+VERSION = 0x0b
+GETKQ = 0x0d
+APPEND = 0x0e
+PREPEND = 0x0f
+STAT = 0x10
+SETQ = 0x11
+ADDQ = 0x12
+REPLACEQ = 0x13
+DELETEQ = 0x14
+APPENDQ = 0x19
+PREPENDQ = 0x1a
+
+QUIET = {SET: SETQ, ADD: ADDQ, REPLACE: REPLACEQ, DELETE: DELETEQ, APPEND: APPENDQ, PREPEND: PREPENDQ}
+
+NO_ERROR = 0x00
+KEY_NOT_FOUND = 0x01
+KEY_EXISTS = 0x02
+VALUE_TOO_LARGE = 0x03
+INVALID_ARGUMENTS = 0x04
+ITEM_NOT_STORED = 0x05
+NON_NUMERIC = 0x06
+UNKNOWN_COMMAND = 0x81
+
+# statuses that mean a command didn't happen, rather than that it failed,
+# which the text protocol reports as False
+NOT_DONE = frozenset([KEY_NOT_FOUND, KEY_EXISTS, ITEM_NOT_STORED])
+
+# the opaque for requests nobody is waiting on
+UNTRACKED = 0
+
+
+def toError(status, message):
+    if status == UNKNOWN_COMMAND:
+        return NoSuchCommand()
+    if status in (VALUE_TOO_LARGE, INVALID_ARGUMENTS, NON_NUMERIC):
+        return ClientError(message)
+    return ServerError(message)
+
+
+class Request:
+    """
+    A request waiting for its response.  C{decode} is called with the
+    response's status, extras, key, value and cas, and returns the result.
+
+    If the request is quiet, the server only responds when something goes
+    wrong, and C{silentResult} is the result when it doesn't.
+    """
+    def __init__(self, decode, quiet=False, silentResult=True):
+        self.decode = decode
+        self.quiet = quiet
+        self.silentResult = silentResult
+        self.deferred = Deferred()
+
+
+    def respond(self, status, extras, key, value, cas):
+        """
+        @return: C{True} if this was the last response to the request.
+        """
+        try:
+            result = self.decode(status, extras, key, value, cas)
+        except Exception:
+            self.deferred.errback(Failure())
+        else:
+            self.deferred.callback(result)
+        return True
+
+
+    def skipped(self):
+        """
+        Called when the server responded to a later request, so this one will
+        never get a response.
+        """
+        if self.quiet:
+            self.deferred.callback(self.silentResult)
+        else:
+            self.deferred.errback(Failure(ServerError("No response")))
+
+
+    def fail(self, reason):
+        self.deferred.errback(reason)
+
+
+class MultiGet:
+    """
+    A multi-get, made of one quiet C{GETKQ} per key and a C{NOOP} that ends
+    it.  Keys that aren't found get no response.
+    """
+    def __init__(self, keys, withIdentifier):
+        self.withIdentifier = withIdentifier
+        miss = (0, "", None) if withIdentifier else (0, None)
+        self.values = dict((key, miss) for key in keys)
+        self.deferred = Deferred()
+
+
+    def respond(self, status, extras, key, value, cas):
+        """
+        Called with the response to the C{NOOP}.
+        """
+        self.deferred.callback(self.values)
+        return True
+
+
+    def found(self, key, extras, value, cas):
+        flags = struct.unpack("!I", extras)[0]
+        if self.withIdentifier:
+            self.values[key] = (flags, str(cas), value)
+        else:
+            self.values[key] = (flags, value)
+
+
+    def fail(self, reason):
+        self.deferred.errback(reason)
+
+
+class MultiGetKey:
+    """
+    The request for one key of a L{MultiGet}.
+    """
+    def __init__(self, multi):
+        self.multi = multi
+
+
+    def respond(self, status, extras, key, value, cas):
+        if status == NO_ERROR:
+            self.multi.found(key, extras, value, cas)
+        elif status != KEY_NOT_FOUND:
+            log.msg("Error getting %s: %s" % (key, value))
+        return True
+
+
+    def skipped(self):
+        pass
+
+
+    def fail(self, reason):
+        pass
+
+
+class Stats(Request):
+    """
+    A C{STAT} request, which gets one response per statistic followed by an
+    empty one.
+    """
+    def __init__(self):
+        Request.__init__(self, None)
+        self.stats = {}
+
+
+    def respond(self, status, extras, key, value, cas):
+        if status != NO_ERROR:
+            self.deferred.errback(Failure(toError(status, value)))
+        elif key:
+            self.stats[key] = value
+            return False
+        else:
+            self.deferred.callback(self.stats)
+        return True
+
+
+def decodeStored(status, extras, key, value, cas):
+    if status == NO_ERROR:
+        return True
+    if status in NOT_DONE:
+        return False
+    raise toError(status, value)
+
+
+def decodeCounter(status, extras, key, value, cas):
+    if status == NO_ERROR:
+        return struct.unpack("!Q", value)[0]
+    if status == KEY_NOT_FOUND:
+        return False
+    raise toError(status, value)
+
+
+def decodeValue(status, extras, key, value, cas):
+    if status == NO_ERROR:
+        return value
+    raise toError(status, value)
+
+
+def getDecoder(withIdentifier):
+    def decode(status, extras, key, value, cas):
+        if status == KEY_NOT_FOUND:
+            return (0, "", None) if withIdentifier else (0, None)
+        if status != NO_ERROR:
+            raise toError(status, value)
+        flags = struct.unpack("!I", extras)[0]
+        if withIdentifier:
+            return (flags, str(cas), value)
+        return (flags, value)
+    return decode
+
+
+class BinaryMemCacheProtocol(Pipelining, Protocol, TimeoutMixin):
+    """
+    A client for the memcached binary protocol with the same interface as
+    L{txyam.factory.ConnectingMemCacheProtocol}.
+
+    @ivar _current: The requests waiting for responses, as C{(opaque,
+    request)} tuples in the order they were sent.
+    """
+    MAX_KEY_LENGTH = 250
+    _disconnected = False
+
+    def __init__(self, timeOut=60):
+        self._current = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._needed = HEADER.size
+        self._opaque = 0
+        self._quietSent = False
+        self.persistentTimeOut = self.timeOut = timeOut
+
+
+    def connectionMade(self):
+        self.factory.connectionMade()
+
+
+    def connectionLost(self, reason):
+        self._disconnected = True
+        self._stopBatching()
+        self._cancelCommands(reason)
+
+
+    def timeoutConnection(self):
+        self._cancelCommands(TimeoutError("Connection timeout"))
+        self.transport.loseConnection()
+
+
+    def _cancelCommands(self, reason):
+        while self._current:
+            _, request = self._current.popleft()
+            request.fail(reason)
+
+
+    def queueDepth(self):
+        """
+        @return: The number of commands waiting for a response.
+        """
+        return len(self._current)
+
+
+    def startPipeline(self):
+        """
+        Start buffering outgoing commands.  Storage and delete commands are
+        sent quietly until L{flushPipeline} is called, which sends all of the
+        buffered commands in a single write.
+        """
+        Pipelining.startPipeline(self)
+
+
+    def flushPipeline(self):
+        """
+        Send all commands buffered since L{startPipeline} in one write, ending
+        with a C{NOOP} if any of them were quiet.
+        """
+        if self._quietSent:
+            self._quietSent = False
+            noop = self._send(NOOP, request=Request(lambda *args: None))
+            # nobody waits on the NOOP; it only makes the server respond
+            noop.deferred.addErrback(lambda failure: None)
+        Pipelining.flushPipeline(self)
+
+
+    def _send(self, opcode, key="", extras="", value="", cas=0, request=None):
+        if request is None:
+            opaque = UNTRACKED
+        else:
+            if not self._current:
+                self.setTimeout(self.persistentTimeOut)
+            self._opaque = self._opaque % 0xffffffff + 1
+            opaque = self._opaque
+            self._current.append((opaque, request))
+        header = HEADER.pack(REQUEST, opcode, len(key), len(extras), 0, 0,
+                             len(extras) + len(key) + len(value), opaque, cas)
+        self._write(header + extras + key + value)
+        return request
+
+
+    def _checkKey(self, key):
+        if self._disconnected:
+            return fail(RuntimeError("not connected"))
+        if not isinstance(key, bytes):
+            return fail(ClientError("Invalid type for key: %s, expecting bytes" % type(key)))
+        if len(key) > self.MAX_KEY_LENGTH:
+            return fail(ClientError("Key too long"))
+        return None
+
+
+    def _checkValue(self, key, val):
+        error = self._checkKey(key)
+        if error is None and not isinstance(val, bytes):
+            error = fail(ClientError("Invalid type for value: %s, expecting bytes" % type(val)))
+        return error
+
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < self._needed:
+            return
+
+        data = "".join(self._buffer)
+        offset = 0
+        while len(data) - offset >= HEADER.size:
+            magic, opcode, keylen, extlen, _, status, bodylen, opaque, cas = HEADER.unpack_from(data, offset)
+            if magic != RESPONSE:
+                log.msg("Bad magic byte %#x from %s, disconnecting" % (magic, self))
+                self.transport.loseConnection()
+                return
+            end = offset + HEADER.size + bodylen
+            if len(data) < end:
+                self._needed = end - offset
+                break
+            start = offset + HEADER.size
+            extras = data[start:start + extlen]
+            key = data[start + extlen:start + extlen + keylen]
+            value = data[start + extlen + keylen:end]
+            offset = end
+            self._needed = HEADER.size
+            self.responseReceived(status, opaque, cas, extras, key, value)
+
+        data = data[offset:]
+        self._buffer = [data] if data else []
+        self._buffered = len(data)
+        if not self._current:
+            self.setTimeout(None)
+
+
+    def responseReceived(self, status, opaque, cas, extras, key, value):
+        if opaque == UNTRACKED:
+            # misses and existing keys are normal for quiet deletes and adds
+            if status not in NOT_DONE:
+                log.msg("Error from %s for a command without a reply: %s" % (self, value))
+            return
+        while self._current:
+            expected, request = self._current[0]
+            if expected == opaque:
+                if request.respond(status, extras, key, value, cas):
+                    self._current.popleft()
+                return
+            # the server only skips quiet requests that succeeded
+            self._current.popleft()
+            request.skipped()
+        log.msg("Unexpected response from %s" % self)
+
+
+    def _store(self, opcode, key, val, flags=0, expireTime=0, cas=0):
+        error = self._checkValue(key, val)
+        if error is not None:
+            return error
+        extras = struct.pack("!II", flags, expireTime)
+        return self._sendStorage(opcode, key, extras, val, cas).deferred
+
+
+    def _sendStorage(self, opcode, key, extras="", val="", cas=0):
+        if (self._pipeline is not None or self.batchWindow is not None) and opcode in QUIET:
+            self._quietSent = True
+            return self._send(QUIET[opcode], key, extras, val, cas, Request(decodeStored, quiet=True))
+        return self._send(opcode, key, extras, val, cas, Request(decodeStored))
+
+
+    @observed
+    def get(self, key, withIdentifier=False):
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        return self._send(GET, key, request=Request(getDecoder(withIdentifier))).deferred
+
+
+    @observed
+    def getMultiple(self, keys, withIdentifier=False):
+        for key in keys:
+            error = self._checkKey(key)
+            if error is not None:
+                return error
+        multi = MultiGet(keys, withIdentifier)
+        for key in multi.values:
+            self._send(GETKQ, key, request=MultiGetKey(multi))
+        self._send(NOOP, request=multi)
+        return multi.deferred
+
+
+    @observed
+    def set(self, key, val, flags=0, expireTime=0):
+        return self._store(SET, key, val, flags, expireTime)
+
+
+    @observed
+    def add(self, key, val, flags=0, expireTime=0):
+        return self._store(ADD, key, val, flags, expireTime)
+
+
+    @observed
+    def replace(self, key, val, flags=0, expireTime=0):
+        return self._store(REPLACE, key, val, flags, expireTime)
+
+
+    @observed
+    def checkAndSet(self, key, val, cas, flags=0, expireTime=0):
+        return self._store(SET, key, val, flags, expireTime, int(cas))
+
+
+    @observed
+    def append(self, key, val):
+        error = self._checkValue(key, val)
+        if error is not None:
+            return error
+        return self._sendStorage(APPEND, key, val=val).deferred
+
+
+    @observed
+    def prepend(self, key, val):
+        error = self._checkValue(key, val)
+        if error is not None:
+            return error
+        return self._sendStorage(PREPEND, key, val=val).deferred
+
+
+    @observed
+    def delete(self, key):
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        return self._sendStorage(DELETE, key).deferred
+
+
+    @observed
+    def increment(self, key, val=1):
+        return self._counter(INCREMENT, key, val)
+
+
+    @observed
+    def decrement(self, key, val=1):
+        return self._counter(DECREMENT, key, val)
+
+
+    def _counter(self, opcode, key, val):
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        # an expiration of all ones means don't create missing keys, which
+        # is how the text protocol behaves
+        extras = struct.pack("!QQI", val, 0, 0xffffffff)
+        return self._send(opcode, key, extras, request=Request(decodeCounter)).deferred
+
+
+    def setNoReply(self, key, val, flags=0, expireTime=0):
+        """
+        Like C{set}, but quiet and untracked.  The returned C{Deferred} fires
+        with C{None} immediately.
+        """
+        return self._storeNoReply(SETQ, key, val, flags, expireTime)
+
+
+    def addNoReply(self, key, val, flags=0, expireTime=0):
+        """
+        Like C{add}, but quiet and untracked.  The returned C{Deferred} fires
+        with C{None} immediately.
+        """
+        return self._storeNoReply(ADDQ, key, val, flags, expireTime)
+
+
+    def deleteNoReply(self, key):
+        """
+        Like C{delete}, but quiet and untracked.  The returned C{Deferred}
+        fires with C{None} immediately.
+        """
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        self._send(DELETEQ, key)
+        return succeed(None)
+
+
+    def _storeNoReply(self, opcode, key, val, flags, expireTime):
+        error = self._checkValue(key, val)
+        if error is not None:
+            return error
+        self._send(opcode, key, struct.pack("!II", flags, expireTime), val)
+        return succeed(None)
+
+
+    def flushAll(self):
+        if self._disconnected:
+            return fail(RuntimeError("not connected"))
+        return self._send(FLUSH, request=Request(decodeStored)).deferred
+
+
+    def version(self):
+        if self._disconnected:
+            return fail(RuntimeError("not connected"))
+        return self._send(VERSION, request=Request(decodeValue)).deferred
+
+
+    def stats(self, arg=None):
+        if self._disconnected:
+            return fail(RuntimeError("not connected"))
+        return self._send(STAT, arg or "", request=Stats()).deferred
+
+
+    def __str__(self):
+        return "memcache[%s]" % str(self.factory.addr)
+
+
+class BinaryMemCacheClientFactory(MemCacheClientFactory):
+    """
+    A L{MemCacheClientFactory} for servers spoken to with the binary
+    protocol.
+    """
+    protocol = BinaryMemCacheProtocol
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+
+
+class LRUCache:
+    """
+    A local cache bounded by number of entries and total size, where each
+    entry expires after its own time to live.  The least recently used
+    entries are evicted first.
+    """
+    def __init__(self, maxEntries=1000, maxBytes=None, clock=None):
+        """
+        @param maxEntries: The maximum number of entries to keep.
+
+        @param maxBytes: The maximum total size of all entries, or C{None} for
+        no limit.
+
+        @param clock: An C{IReactorTime} provider used to expire entries.
+        """
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.clock = clock or reactor
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        expires, size, value = entry
+        if expires <= self.clock.seconds():
+            self.bytes -= size
+            return default
+        # reinsert as the most recently used
+        self.entries[key] = entry
+        return value
+
+
+    def set(self, key, value, ttl, size=0):
+        """
+        Store C{value}, which will expire C{ttl} seconds from now.  C{size}
+        counts towards C{maxBytes}.
+        """
+        self.delete(key)
+        if ttl <= 0 or (self.maxBytes is not None and size > self.maxBytes):
+            return
+        self.entries[key] = (self.clock.seconds() + ttl, size, value)
+        self.bytes += size
+        while len(self.entries) > self.maxEntries or (self.maxBytes is not None and self.bytes > self.maxBytes):
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+def invalidating(cmd):
+    """
+    Used to wrap the methods of the wrapped client that change a key, so that
+    the local copy of the key is removed first.
+    """
+    def wrapper(self, key, *args, **kwargs):
+        self.invalidate(key)
+        return getattr(self.client, cmd)(key, *args, **kwargs)
+    return wrapper
+
+
+def invalidatingMultiple(cmd):
+    """
+    Just like L{invalidating}, but for methods that change many keys.
+    """
+    def wrapper(self, keys, *args, **kwargs):
+        for key in keys:
+            self.invalidate(key)
+        return getattr(self.client, cmd)(keys, *args, **kwargs)
+    return wrapper
+
+
+class NearCacheClient:
+    """
+    Wraps a L{txyam.client.YamClient} with a small in-process cache of recently
+    read values.  Reads are served locally until the local copy expires, and
+    writes made through this client update or invalidate the local copy.
+    Values stored by other clients may be stale for up to C{ttl} seconds.
+
+    Objects returned by L{getPickled} are shared between callers and should
+    not be modified.  Any method not defined here is passed straight through
+    to the wrapped client.
+    """
+    # memcached treats expire times longer than this as unix timestamps
+    maxRelativeExpireTime = 60 * 60 * 24 * 30
+
+    def __init__(self, client, ttl=5, maxEntries=1000, maxBytes=10 * 1024 * 1024, clock=None):
+        """
+        @param client: The L{txyam.client.YamClient} to wrap.
+
+        @param ttl: The longest time in seconds a value will be kept locally.
+
+        @param maxEntries: The maximum number of values to keep locally.
+
+        @param maxBytes: The maximum total size of the values kept locally.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.clock = clock or reactor
+        self.cache = LRUCache(maxEntries, maxBytes, self.clock)
+        self.hits = 0
+        self.misses = 0
+
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+    def localTTL(self, expireTime):
+        """
+        Get how long to keep a value locally, which is never longer than it
+        would be kept by memcached.
+        """
+        if not expireTime:
+            return self.ttl
+        if expireTime > self.maxRelativeExpireTime:
+            expireTime -= self.clock.seconds()
+        return min(self.ttl, expireTime)
+
+
+    def invalidate(self, key):
+        """
+        Remove the local copies of C{key}.
+        """
+        self.cache.delete(('raw', key))
+        self.cache.delete(('pickled', key))
+
+
+    def get(self, key, withIdentifier=False, **kwargs):
+        if withIdentifier:
+            return self.client.get(key, withIdentifier, **kwargs)
+        result = self.cache.get(('raw', key))
+        if result is not None:
+            self.hits += 1
+            return succeed(result)
+        self.misses += 1
+
+        def store(result):
+            if result[1] is not None:
+                self.cache.set(('raw', key), result, self.ttl, len(result[1]))
+            return result
+        return self.client.get(key, **kwargs).addCallback(store)
+
+
+    def getPickled(self, key, uncompress=False, **kwargs):
+        result = self.cache.get(('pickled', key))
+        if result is not None:
+            self.hits += 1
+            return succeed(result)
+        self.misses += 1
+
+        def decode(result):
+            if result[1] is None:
+                return result
+            d = self.client.decodeResult(result, uncompress)
+            return d.addCallback(store, len(result[1]))
+
+        def store(result, size):
+            self.cache.set(('pickled', key), result, self.ttl, size)
+            return result
+        return self.client.get(key, **kwargs).addCallback(decode)
+
+
+    def set(self, key, val, flags=0, expireTime=0, **kwargs):
+        self.invalidate(key)
+
+        def store(stored):
+            if stored:
+                self.cache.set(('raw', key), (flags, val), self.localTTL(expireTime), len(val))
+            return stored
+        return self.client.set(key, val, flags, expireTime, **kwargs).addCallback(store)
+
+
+    def localStats(self):
+        """
+        @return: A C{dict} with the local cache's hits, misses, number of
+        entries and total size.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.cache), 'bytes': self.cache.bytes}
+
+
+    setPickled = invalidating("setPickled")
+    add = invalidating("add")
+    addPickled = invalidating("addPickled")
+    replace = invalidating("replace")
+    checkAndSet = invalidating("checkAndSet")
+    append = invalidating("append")
+    prepend = invalidating("prepend")
+    increment = invalidating("increment")
+    decrement = invalidating("decrement")
+    delete = invalidating("delete")
+    setMultiple = invalidatingMultiple("setMultiple")
+    setMultiplePickled = invalidatingMultiple("setMultiplePickled")
+    addMultiple = invalidatingMultiple("addMultiple")
+    addMultiplePickled = invalidatingMultiple("addMultiplePickled")
+    deleteMultiple = invalidatingMultiple("deleteMultiple")
+    incrementMultiple = invalidatingMultiple("incrementMultiple")
+    modify = invalidating("modify")
+    modifyPickled = invalidating("modifyPickled")
+    modifyMultiple = invalidatingMultiple("modifyMultiple")
+    modifyMultiplePickled = invalidatingMultiple("modifyMultiplePickled")
@@ -1,14 +1,19 @@
-import cPickle
-import zlib
+import math
+import os
+import random
 
-from twisted.internet.defer import inlineCallbacks, DeferredList, returnValue
+from twisted.internet.defer import Deferred, DeferredList, succeed, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
 from twisted.internet import reactor
 from twisted.python import log
+from twisted.python.failure import Failure
 
-from hash_ring import HashRing
-
-from txyam.utils import deferredDict
-from txyam.factory import MemCacheClientFactory
+from txyam.utils import deferredDict, timeoutDeferred, SingleFlight, LatencyTracker
+from txyam.factory import MemCacheClientFactory, BufferedMemCacheClientFactory, MemCacheClientPool
+from txyam.binary import BinaryMemCacheClientFactory
+from txyam.routing import HashRingRouter
+from txyam.serialization import Codec, CODEC_MASK, CHUNKED
+from txyam.cache import LRUCache
 
 
 class NoServerError(Exception):
@@ -23,25 +28,430 @@ class InvalidHostPortError(Exception):
     """
 
 
+class QuorumError(Exception):
+    """
+    So many hosts failed to connect that the quorum can't be met.
+    """
+
+
+class ConflictError(Exception):
+    """
+    Keys kept being changed by someone else while they were being modified.
+
+    @ivar keys: The keys that weren't modified.
+    """
+    def __init__(self, keys):
+        Exception.__init__(self, "Gave up modifying %s" % ", ".join(keys))
+        self.keys = keys
+
+
+# the result of a command that timed out, if timeouts aren't errors
+MISSES = {'get': (0, None), 'gets': (0, "", None), 'increment': None, 'decrement': None,
+          'stats': None, 'version': None}
+
+# commands that change the existing value, so need it on the key's server
+CHANGES = frozenset(['increment', 'decrement', 'append', 'prepend', 'replace'])
+
+
 def wrap(cmd):
     """
-    Used to wrap all of the memcache methods (get,set,getMultiple,etc).
+    Used to wrap all of the memcache methods (set,delete,increment,etc) that
+    change a key.  The command is also sent to the replicas of the key, if
+    there are any, but the result is the result from the primary server.
     """
+    miss = MISSES.get(cmd, False)
+
     def wrapper(self, key, *args, **kwargs):
-        func = getattr(self.getClient(key), cmd)
-        return func(key, *args, **kwargs)
+        timeout = kwargs.pop('timeout', None)
+        self.invalidateHotKey(key)
+        clients = self.getClients(key)
+        for client in clients[1:]:
+            getattr(client, cmd)(key, *args, **kwargs).addErrback(self.replicaFailed, key)
+
+        def command():
+            return getattr(clients[0], cmd)(key, *args, **kwargs)
+        return self.bounded(self.migrated(command(), key, command, cmd in CHANGES), timeout, miss)
     return wrapper
 
 
+class Modification:
+    """
+    Reads keys with C{gets}, changes their values with a function and writes
+    them back with C{cas}, so nothing written in between is lost.  Keys that
+    were changed in between are tried again, up to C{retries} more times,
+    after a random delay of up to C{backoff} seconds that doubles (up to
+    C{maxBackoff}) each time.  Missing keys are written with C{add}.
+    """
+    def __init__(self, client, keys, func, pickled, retries, backoff, maxBackoff, kwargs):
+        """
+        @param func: Called with each key and its value (C{None} if it is
+        missing), and returns the new value or a C{Deferred} that fires
+        with it.
+
+        @param pickled: If C{True}, values are decoded and encoded as with
+        C{getPickled} and C{setPickled}.
+
+        @param kwargs: Passed on to the write, as with C{setPickled}, or C{set}
+        (C{flags}, C{expireTime} and C{timeout}).
+        """
+        self.client = client
+        self.func = func
+        self.pickled = pickled
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.uncompress = kwargs.pop('uncompress', False)
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.results = {}
+        self.deferred = Deferred()
+        self.run(keys)
+
+
+    def run(self, keys):
+        self.attempts += 1
+        timeout = self.kwargs.get('timeout')
+        # retries are run by the clock, so errors have to end up in a Deferred
+        if self.pickled:
+            d = maybeDeferred(self.client.getMultiplePickled, keys, withIdentifier=True, timeout=timeout,
+                              uncompress=self.uncompress)
+        else:
+            d = maybeDeferred(self.client.getMultiple, keys, withIdentifier=True, timeout=timeout)
+        d.addCallback(self.modifyAll)
+        d.addErrback(self.deferred.errback)
+
+
+    def modifyAll(self, results):
+        ds = {}
+        for key, result in results.items():
+            ds[key] = maybeDeferred(self.func, key, result[-1]).addCallback(self.write, key, result)
+        return deferredDict(ds).addCallback(self.written)
+
+
+    def write(self, value, key, result):
+        kwargs = dict(self.kwargs)
+        if result[-1] is not None:
+            cmd, kwargs['cas'] = "checkAndSet", result[1]
+        else:
+            cmd = "add"
+        if self.pickled:
+            d = self.client.encode(value, kwargs)
+            d.addCallback(lambda encoded: self.client.store(cmd, key, encoded[0], encoded[1], kwargs))
+        else:
+            d = getattr(self.client, cmd)(key, value, **kwargs)
+        return d.addCallback(lambda stored: (stored, value))
+
+
+    def written(self, outcomes):
+        conflicts = []
+        for key, outcome in outcomes.items():
+            if isinstance(outcome, Failure):
+                self.deferred.errback(outcome)
+                return
+            stored, value = outcome
+            if stored:
+                self.results[key] = value
+            else:
+                conflicts.append(key)
+        if not conflicts:
+            self.deferred.callback(self.results)
+        elif self.attempts > self.retries:
+            self.deferred.errback(ConflictError(conflicts))
+        else:
+            # full jitter, so the writers that collided don't collide again
+            delay = random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** (self.attempts - 1)))
+            self.client.clock.callLater(delay, self.run, conflicts)
+
+
+class ReplicaRead:
+    """
+    Reads a key from the first of a list of servers that has it.  The next
+    server is tried when one misses or fails, or, if there's a C{hedgeDelay},
+    when it hasn't answered within that many seconds.  The first value
+    found wins.
+    """
+    def __init__(self, key, clients, clock, hedgeDelay=None, latencies=None):
+        self.key = key
+        self.clients = clients
+        self.clock = clock
+        self.hedgeDelay = hedgeDelay
+        self.latencies = latencies
+        self.next = 0
+        self.outstanding = 0
+        self.missed = False
+        self.failure = None
+        self.timer = None
+        self.deferred = Deferred()
+        self.tryNext()
+
+
+    def cancelTimer(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
+    def tryNext(self):
+        self.cancelTimer()
+        if self.next >= len(self.clients):
+            return False
+        client = self.clients[self.next]
+        self.next += 1
+        self.outstanding += 1
+        if self.hedgeDelay is not None and self.next < len(self.clients):
+            self.timer = self.clock.callLater(self.hedgeDelay, self.tryNext)
+        client.get(self.key).addBoth(self.handleResult, self.clock.seconds())
+        return True
+
+
+    def handleResult(self, result, started):
+        self.outstanding -= 1
+        if self.latencies is not None:
+            self.latencies.record(self.clock.seconds() - started)
+        if self.deferred.called:
+            return
+        if isinstance(result, Failure):
+            self.failure = result
+        elif result[1] is not None:
+            self.cancelTimer()
+            self.deferred.callback(result)
+            return
+        else:
+            self.missed = True
+
+        if not self.tryNext() and self.outstanding == 0:
+            if self.missed:
+                self.deferred.callback((0, None))
+            else:
+                self.deferred.errback(self.failure)
+
+
+class QueuedClient(object):
+    """
+    Stands in for the protocol of a server that hasn't connected yet.  Every
+    command called on it is queued, and sent once the server connects.  If
+    it doesn't, they fail with a L{NoServerError}.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.waiting = []
+
+
+    def __getattr__(self, name):
+        # only commands are queued; this is also hashed and compared
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            d = Deferred()
+            self.waiting.append((d, name, args, kwargs))
+            return d
+        return queue
+
+
+    def ready(self, client):
+        waiting, self.waiting = self.waiting, []
+        for d, name, args, kwargs in waiting:
+            maybeDeferred(getattr(client, name), *args, **kwargs).chainDeferred(d)
+
+
+    def failed(self, reason):
+        waiting, self.waiting = self.waiting, []
+        for d, name, args, kwargs in waiting:
+            d.errback(NoServerError("Could not connect to %s: %s" % (self.factory.hostport, reason)))
+
+
 class YamClient:
-    def __init__(self, hosts, connect=True):
+    chunkPrefix = "txyam:chunk:"
+    lockPrefix = "txyam:lock:"
+
+    def __init__(self, hosts, connect=True, router=HashRingRouter, weights=None, poolSize=1,
+                 coalesce=False, codec=None, threadPool=None, offloadThreshold=65536, chunkSize=None,
+                 replicas=1, hedgeDelay=None, hedgePercentile=None, timeout=None, raiseOnTimeout=False,
+                 health=None, hotKeys=None, hotKeyTTL=None, binary=False,
+                 bufferLargeValues=False, batchWindow=None, batchBytes=65536, mergeGets=False,
+                 quorum=None, connectConcurrency=None, connectTimeout=30, lazy=False, queueUntilReady=False):
         """
         @param hosts: A C{list} of C{tuple}s containing hosts and ports.
+
+        @param router: The L{txyam.routing.Router} subclass used to decide
+        which server owns a key.
+
+        @param weights: An optional C{dict} mapping "host:port" strings to
+        server weights, for routers that support them.
+
+        @param poolSize: The number of connections to make to each host.
+
+        @param coalesce: If C{True}, concurrent C{get}s of the same key share
+        a single request to the server.
+
+        @param codec: The L{txyam.serialization.Codec} used to encode and
+        decode values stored with L{setPickled} and friends.
+
+        @param threadPool: An optional, started
+        C{twisted.python.threadpool.ThreadPool} used to encode and decode
+        large values off of the reactor thread.
+
+        @param offloadThreshold: Values at least this many bytes long are
+        encoded and decoded in C{threadPool}.
+
+        @param chunkSize: If given, encoded values longer than this are split
+        into chunks of this size, so values larger than memcached's item size
+        limit can be stored.
+
+        @param replicas: The number of servers each key is stored on.  Writes
+        go to all of them, and reads fall back to the replicas when the
+        primary server misses or fails.
+
+        @param hedgeDelay: If given, reads also try the next replica when the
+        server being read from hasn't answered within this many seconds.
+
+        @param hedgePercentile: If given, the hedge delay is this percentile
+        of recent read latencies (C{hedgeDelay} is used until there are
+        enough of them).
+
+        @param timeout: The default longest time, in seconds, any command will
+        wait for a server.  Every command also takes a C{timeout} keyword
+        argument.
+
+        @param raiseOnTimeout: If C{True}, commands that time out fail with a
+        C{TimeoutError}.  Otherwise, they return a miss: C{(0, None)} for
+        gets, C{None} for increments and decrements, and C{False} for
+        everything else.
+
+        @param health: An optional L{txyam.health.HealthMonitor} that takes
+        unhealthy servers out of the ring.
+
+        @param hotKeys: An optional L{txyam.hotkeys.HotKeyDetector} that is
+        told about every key read.  With replicas, hot keys are read from a
+        random replica instead of always from the primary.
+
+        @param hotKeyTTL: If given, hot keys are also kept in a local cache
+        for this many seconds.  Writes made through this client remove them
+        from it.
+
+        @param binary: If C{True}, speak the binary protocol to the servers
+        (see L{txyam.binary}).
+
+        @param bufferLargeValues: If C{True}, large values are read into
+        preallocated C{bytearray}s and returned as them, which saves copying
+        them.  See L{txyam.factory.BufferedMemCacheProtocol}.
+
+        @param batchWindow: If given, the commands sent to each connection
+        within this many seconds (0 meaning the same reactor iteration) are
+        sent in one write, or sooner if they add up to C{batchBytes}.
+
+        @param mergeGets: If C{True}, adjacent C{get}s in a batch are sent as
+        one multi-key C{get}.  Only the text protocol merges gets.
+
+        @param quorum: The number of hosts (or, if less than 1, the fraction
+        of them) that must connect before L{connect} fires.  By default, it
+        waits for all of them.
+
+        @param connectConcurrency: If given, at most this many hosts are
+        connected to at once.  The next host is started when one connects
+        or gives up.
+
+        @param connectTimeout: How long, in seconds, each host has to make its
+        first connection before it is given up on (it is still retried in
+        the background, as with any lost connection).
+
+        @param lazy: If C{True}, hosts aren't connected to until the first
+        command for them, and L{connect} fires right away.  Implies
+        C{queueUntilReady}.
+
+        @param queueUntilReady: If C{True}, hosts that haven't finished
+        their first connection are still in the ring, and commands for them
+        wait until they connect (see L{QueuedClient}).  So that keys don't
+        move when they do, hosts are named in the ring by their configured
+        "host:port" rather than their connected address.
         """
-        self.hosts = hosts
-        self.hash_ring = HashRing(hosts)
+        self.hosts = list(hosts)
+        self.factories = []
+        self.routerClass = router
+        self.weights = weights
+        self.poolSize = poolSize
+        self.coalesce = coalesce
+        self.inflight = SingleFlight()
+        self.codec = codec or Codec()
+        self.threadPool = threadPool
+        self.offloadThreshold = offloadThreshold
+        self.chunkSize = chunkSize
+        self.replicas = replicas
+        self.hedgeDelay = hedgeDelay
+        self.hedgePercentile = hedgePercentile
+        self.latencies = LatencyTracker() if hedgePercentile is not None else None
+        self.timeout = timeout
+        self.raiseOnTimeout = raiseOnTimeout
+        self.observers = []
+        self.health = health
+        if health is not None:
+            health.owner = self
+            self.addObserver(health)
+        if binary:
+            self.factoryClass = BinaryMemCacheClientFactory
+        elif bufferLargeValues:
+            self.factoryClass = BufferedMemCacheClientFactory
+        else:
+            self.factoryClass = MemCacheClientFactory
+        self.batchWindow = batchWindow
+        self.batchBytes = batchBytes
+        self.mergeGets = mergeGets
+        self.hotKeys = hotKeys
+        self.hotKeyTTL = hotKeyTTL
+        self.clock = reactor
+        self.hotCache = None
+        if hotKeys is not None and hotKeyTTL:
+            self.hotCache = LRUCache(hotKeys.sketch.capacity, clock=self.clock)
+        self.router = router([], weights)
+        self.previousFactories = None
+        self.previousRouter = None
+        self.retiring = []
+        self.migrationCall = None
+        self.copyForward = False
+        self.copyExpireTime = 0
+        self.quorum = quorum
+        self.connectConcurrency = connectConcurrency
+        self.connectTimeout = connectTimeout
+        self.lazy = lazy
+        self.queueUntilReady = queueUntilReady or lazy
+        self.unstarted = []
+        self.starting = {}
+        self.queued = {}
+        self.everConnected = set()
+        self.quorumWaiters = []
         if connect:
-            self.connect()
+            # nobody else is waiting for it, so this is the only place to log
+            self.connect().addErrback(log.err, "Failed to connect to enough hosts")
+
+
+    def getActiveFactories(self, factories=None):
+        if factories is None:
+            factories = self.factories
+        return [factory for factory in factories
+                if (factory.client is not None or self.isPending(factory)) and
+                (self.health is None or self.health.isHealthy(factory))]
+
+
+    def isPending(self, factory):
+        """
+        Whether commands for C{factory} should wait for it to connect.
+        """
+        return self.queueUntilReady and (factory in self.starting or factory in self.unstarted)
+
+
+    def clientFor(self, factory):
+        """
+        Get the protocol to send commands for C{factory} on, or a
+        L{QueuedClient} if it hasn't connected yet.
+        """
+        if factory.client is None and self.isPending(factory):
+            if factory not in self.queued:
+                self.queued[factory] = QueuedClient(factory)
+                if factory in self.unstarted:
+                    self.startConnecting(factory)
+            return self.queued[factory]
+        return factory.client
 
 
     def getActiveConnections(self):
@@ -49,117 +459,1167 @@ class YamClient:
                 if factory.client is not None]
 
 
+    def connectionStateChanged(self, factory):
+        """
+        Called by a factory whenever it connects or disconnects.
+        """
+        if self.health is not None and factory.client is None:
+            self.health.connectionLost(factory)
+        if factory.client is not None:
+            self.everConnected.add(factory)
+            self.attemptFinished(factory)
+        elif factory in self.starting and not factory.continueTrying:
+            # its first connection failed and won't be retried.  Otherwise
+            # it is retried until connectTimeout, as it is for pools, which
+            # only say when they connect
+            self.attemptFinished(factory, "connection failed")
+        self.rebuildRouter()
+        self.checkQuorum()
+        if factory.client is not None and factory in self.queued:
+            self.queued.pop(factory).ready(factory.client)
+
+
+    def rebuildRouter(self):
+        """
+        Route keys to the active factories.  The router is only rebuilt when
+        they change, so that routing a key is just a lookup.
+        """
+        factories = self.getActiveFactories()
+        log.msg("Using %i active hosts" % len(factories))
+        self.router = self.routerClass(factories, self.weights)
+        if self.previousFactories is not None:
+            self.previousRouter = self.routerClass(self.getActiveFactories(self.previousFactories), self.weights)
+
+
+    def addObserver(self, observer):
+        """
+        Add an observer, whose C{observe} method will be called with every
+        command sent to a server.  See L{txyam.stats}.
+        """
+        self.observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        self.observers.remove(observer)
+
+
+    def observe(self, factory, cmd, args, d):
+        """
+        Called by a factory with each command sent to its server.
+        """
+        for observer in self.observers:
+            observer.observe(factory, cmd, args, d)
+
+
     def getClient(self, key):
-        hosts = self.getActiveConnections()
-        if hosts != self.hash_ring.nodes:
-            self.hash_ring = HashRing(hosts)
-        log.msg("Using %i active hosts" % len(hosts))
-        if len(hosts) == 0:
+        factory = self.router.getNode(key)
+        if factory is None:
+            raise NoServerError("No connected servers remaining.")
+        return self.clientFor(factory)
+
+
+    def getPreviousClient(self, key):
+        """
+        During a migration, get the client for the server that owned C{key}
+        in the old ring, if it isn't the server that owns it now.
+        """
+        if self.previousRouter is None:
+            return None
+        factory = self.previousRouter.getNode(key)
+        if factory is None or factory is self.router.getNode(key):
+            return None
+        return self.clientFor(factory)
+
+
+    def getClients(self, key):
+        """
+        Get the clients for the servers that hold C{key}: the primary first,
+        followed by up to C{replicas - 1} replicas.
+        """
+        if self.replicas == 1:
+            return [self.getClient(key)]
+        factories = self.router.getNodes(key, self.replicas)
+        if not factories:
             raise NoServerError("No connected servers remaining.")
-        return self.hash_ring.get_node(key)
+        return [self.clientFor(factory) for factory in factories]
 
 
-    @inlineCallbacks
     def connect(self):
-        self.factories = []
-        for hp in self.hosts:
-            if isinstance(hp, tuple):
-                host, port = hp
-            elif isinstance(hp, str):
-                host, port = hp, 11211
+        """
+        Start connecting to the hosts, C{connectConcurrency} at a time.
+
+        @return: A C{Deferred} that fires with this client when C{quorum} of
+        the hosts have connected, or right away if C{lazy}.  It fails with a
+        L{QuorumError} once so many hosts have failed to connect, or timed
+        out, that the quorum can't be met (they are still retried in the
+        background).
+        """
+        self.factories = [self.makeFactory(hp) for hp in self.hosts]
+        self.unstarted = list(self.factories)
+        self.rebuildRouter()
+        if self.lazy:
+            return succeed(self)
+        for _ in xrange(self.connectConcurrency or len(self.factories)):
+            self.connectNext()
+        d = Deferred()
+        self.quorumWaiters.append(d)
+        self.checkQuorum()
+        return d
+
+
+    def checkQuorum(self):
+        if not self.quorumWaiters:
+            return
+        needed = len(self.factories) if self.quorum is None else self.quorum
+        if needed < 1:
+            needed = int(math.ceil(needed * len(self.factories)))
+        needed = min(needed, len(self.factories))
+        connected = len([factory for factory in self.factories if factory in self.everConnected])
+        possible = len([factory for factory in self.factories if factory in self.everConnected or
+                        factory in self.starting or factory in self.unstarted])
+        if connected >= needed:
+            waiters, self.quorumWaiters = self.quorumWaiters, []
+            for d in waiters:
+                d.callback(self)
+        elif possible < needed:
+            waiters, self.quorumWaiters = self.quorumWaiters, []
+            error = QuorumError("Only %i of the %i hosts needed can connect" % (possible, needed))
+            for d in waiters:
+                d.errback(error)
+
+
+    def connectNext(self):
+        if self.unstarted:
+            self.startConnecting(self.unstarted[0])
+
+
+    def parseHost(self, hp):
+        """
+        @return: A C{tuple} of the host and port in a C{hosts} entry.
+        """
+        if isinstance(hp, tuple):
+            return hp
+        elif isinstance(hp, str):
+            return hp, 11211
+        raise InvalidHostPortError("Connection info should be either hostnames or host/port tuples")
+
+
+    def makeFactory(self, hp):
+        """
+        Make the factory, or pool of factories, for one of C{hosts}.
+        """
+        host, port = self.parseHost(hp)
+        hostport = "%s:%i" % (host, port)
+        if self.poolSize > 1:
+            factory = MemCacheClientPool(self.poolSize, self, hostport, self.factoryClass)
+            members = factory.factories
+        else:
+            factory = self.factoryClass(self, hostport)
+            members = [factory]
+        factory.nameByHostPort = self.queueUntilReady
+        for member in members:
+            member.batchWindow = self.batchWindow
+            member.batchBytes = self.batchBytes
+            member.mergeGets = self.mergeGets
+        return factory
+
+
+    def startConnecting(self, factory):
+        """
+        Start connecting C{factory}, which gets C{connectTimeout} seconds to
+        connect before commands waiting for it fail.
+        """
+        if factory in self.unstarted:
+            self.unstarted.remove(factory)
+        host, port = factory.hostport.rsplit(":", 1)
+        members = factory.factories if isinstance(factory, MemCacheClientPool) else [factory]
+        for member in members:
+            reactor.connectTCP(host, int(port), member, timeout=self.connectTimeout)
+        self.starting[factory] = self.clock.callLater(self.connectTimeout, self.startupTimedOut, factory)
+
+
+    def startupTimedOut(self, factory):
+        self.attemptFinished(factory, "timed out")
+        self.rebuildRouter()
+        self.checkQuorum()
+
+
+    def attemptFinished(self, factory, failed=None):
+        """
+        Called when C{factory}'s first connection is made, or has failed
+        because of C{failed}.
+        """
+        call = self.starting.pop(factory, None)
+        if call is None:
+            return
+        if call.active():
+            call.cancel()
+        if failed is not None and factory in self.queued:
+            self.queued.pop(factory).failed(failed)
+        self.connectNext()
+
+
+    def connectHost(self, hp):
+        """
+        Start connecting to one of C{hosts}.
+
+        @return: The new factory, or pool of factories.
+        """
+        factory = self.makeFactory(hp)
+        self.startConnecting(factory)
+        return factory
+
+
+    def readiness(self):
+        """
+        @return: A C{dict} mapping each host's "host:port" to its state:
+        C{"waiting"} to start connecting, C{"connecting"}, C{"connected"} or
+        C{"disconnected"} (because it was given up on, or its connection was
+        lost).
+        """
+        states = {}
+        for factory in self.factories:
+            if factory.client is not None:
+                states[factory.hostport] = "connected"
+            elif factory in self.starting:
+                states[factory.hostport] = "connecting"
+            elif factory in self.unstarted:
+                states[factory.hostport] = "waiting"
             else:
-                raise InvalidHostPortError("Connection info should be either hostnames or host/port tuples")
-            factory = MemCacheClientFactory()
-            reactor.connectTCP(host, port, factory)
-            self.factories.append(factory)
+                states[factory.hostport] = "disconnected"
+        return states
+
+
+    def addHost(self, hp, weight=None, migrate=False):
+        """
+        Connect to another server.  It is added to the ring once it is
+        connected.
+
+        @param hp: A hostname or C{(host, port)} tuple, as in C{hosts}.
+
+        @param weight: The server's weight, for routers that use weights.
+
+        @param migrate: If C{True}, start a migration (see
+        L{startMigration}), so the keys that move to the new server can still
+        be read from the servers that owned them.
+
+        @return: A C{Deferred} that fires when the server is connected.
+        """
+        if migrate:
+            self.startMigration()
+        factory = self.connectHost(hp)
+        if weight is not None:
+            self.weights = dict(self.weights or {}, **{factory.hostport: weight})
+        self.hosts.append(hp)
+        self.factories.append(factory)
+        return factory.deferred
+
+
+    def removeHost(self, hp, migrate=False):
+        """
+        Stop using a server and disconnect from it.
+
+        @param migrate: If C{True}, start a migration (see
+        L{startMigration}), and stay connected to the server until it is
+        finished, so the keys it owned can still be read from it.
+        """
+        hp = self.parseHost(hp)
+        for index, other in enumerate(self.hosts):
+            if self.parseHost(other) == hp:
+                break
+        else:
+            raise InvalidHostPortError("Not connected to %s:%i" % hp)
+        factory = self.factories[index]
+        if factory in self.unstarted:
+            self.unstarted.remove(factory)
+        self.attemptFinished(factory, "removed")
+        if migrate:
+            self.startMigration()
+            self.retiring.append(factory)
+        else:
+            self.disconnectFactory(factory)
+        del self.hosts[index]
+        del self.factories[index]
+        self.rebuildRouter()
+        self.checkQuorum()
+
+
+    def startMigration(self, copyForward=None, copyExpireTime=None, duration=None):
+        """
+        Remember the current ring, so that while hosts are added and removed,
+        reads that miss on the new ring are retried on the server that owned
+        the key in this one.  Writes also delete the key from that server, so
+        that old values aren't read later.  If a migration is already
+        started, its ring is kept.
+
+        @param copyForward: If C{True}, values found on the old server are
+        also added to the new one.
+
+        @param copyExpireTime: The expire time to copy values with (memcached
+        doesn't tell clients how long a value has left).
+
+        @param duration: If given, the migration is finished after this many
+        seconds.
+        """
+        if copyForward is not None:
+            self.copyForward = copyForward
+        if copyExpireTime is not None:
+            self.copyExpireTime = copyExpireTime
+        if self.previousFactories is None:
+            self.previousFactories = list(self.factories)
+            self.rebuildRouter()
+        if duration is not None:
+            if self.migrationCall is not None and self.migrationCall.active():
+                self.migrationCall.cancel()
+            self.migrationCall = self.clock.callLater(duration, self.finishMigration)
+
 
-        # fire callback when all connections have been established
-        yield DeferredList([factory.deferred for factory in self.factories])
-        returnValue(self)
+    def finishMigration(self):
+        """
+        Stop reading from the old ring, and disconnect from removed servers.
+        """
+        if self.migrationCall is not None and self.migrationCall.active():
+            self.migrationCall.cancel()
+        self.migrationCall = None
+        self.previousFactories = None
+        self.previousRouter = None
+        retiring, self.retiring = self.retiring, []
+        for factory in retiring:
+            self.disconnectFactory(factory)
+
+
+    def disconnectFactory(self, factory):
+        factory.stopTrying()
+        for connection in factory.getConnections():
+            connection.transport.loseConnection()
 
 
     def disconnect(self):
         log.msg("Disconnecting from all clients.")
-        for factory in self.factories:
+        self.unstarted = []
+        for factory in self.starting.keys():
+            self.attemptFinished(factory, "disconnected")
+        self.checkQuorum()
+        if self.health is not None:
+            self.health.stop()
+        for factory in self.factories + self.retiring:
             factory.stopTrying()
-        for connection in self.getActiveConnections():
-            connection.transport.loseConnection()
+        for factory in self.factories + self.retiring:
+            for connection in factory.getConnections():
+                connection.transport.loseConnection()
 
 
-    def flushAll(self):
+    def flushAll(self, timeout=None):
         hosts = self.getActiveConnections()
         log.msg("Flushing %i hosts" % len(hosts))
-        return DeferredList([host.flushAll() for host in hosts])
+        return DeferredList([self.bounded(host.flushAll(), timeout, False) for host in hosts])
 
 
-    def stats(self, arg=None):
+    def stats(self, arg=None, timeout=None):
         ds = {}
         for factory in self.factories:
             if not factory.client is None:
                 hp = "%s:%i" % (factory.addr.host, factory.addr.port)
-                ds[hp] = factory.client.stats(arg)
+                ds[hp] = self.bounded(factory.client.stats(arg), timeout, MISSES['stats'])
         log.msg("Getting stats on %i hosts" % len(ds))
         return deferredDict(ds)
 
 
-    def version(self):
+    def poolStats(self):
+        """
+        Get connection pool statistics for each host that uses a pool.
+
+        @return: A C{dict} mapping "host:port" to the result of
+        L{MemCacheClientPool.poolStats}.
+        """
+        return dict((factory.hostport, factory.poolStats()) for factory in self.factories
+                    if isinstance(factory, MemCacheClientPool))
+
+
+    def version(self, timeout=None):
         ds = {}
         for factory in self.factories:
             if not factory.client is None:
                 hp = "%s:%i" % (factory.addr.host, factory.addr.port)
-                ds[hp] = factory.client.version()
+                ds[hp] = self.bounded(factory.client.version(), timeout, MISSES['version'])
         log.msg("Getting version on %i hosts" % len(ds))
         return deferredDict(ds)
 
 
     def pickle(self, value, compress):
-        p = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
-        if compress:
-            p = zlib.compress(p)
-        return p
+        return self.codec.encode(value, 'pickle', compress)[1]
 
 
     def unpickle(self, value, uncompress):
-        if uncompress:
-            value = zlib.decompress(value)
-        return cPickle.loads(value)
+        return self.codec.decode(0, value, uncompress)
+
+
+    def offload(self, size):
+        """
+        Whether encoding or decoding a value of C{size} bytes should be done
+        in the thread pool.
+        """
+        return self.threadPool is not None and size >= self.offloadThreshold
+
+
+    def encode(self, value, kwargs):
+        """
+        Encode C{value} with the codec, using (and removing) the C{serializer},
+        C{compress} and C{offload} keyword arguments in C{kwargs}.
+
+        Serialization is done in the thread pool if C{offload} is C{True}.
+        Otherwise, only compression of large values is.
+
+        @return: A C{Deferred} that fires with a C{tuple} of the flags to
+        store, including any C{flags} in C{kwargs}, and the encoded value.
+
+        @raise ValueError: If C{flags} uses any of the low eight bits, which
+        are reserved for the codec and for marking chunked values.
+        """
+        serializer = kwargs.pop('serializer', None)
+        compress = kwargs.pop('compress', None)
+        flags = kwargs.pop('flags', 0)
+        if flags & (CODEC_MASK | CHUNKED):
+            raise ValueError("The low eight bits of flags are reserved, use flags above 255")
+
+        def merge(encoded):
+            return flags | encoded[0], encoded[1]
+
+        if kwargs.pop('offload', False) and self.threadPool is not None:
+            d = deferToThreadPool(reactor, self.threadPool, self.codec.encode, value, serializer, compress)
+            return d.addCallback(merge)
+        codecFlags, data = self.codec.serialize(value, serializer)
+        if compress is not False and self.offload(len(data)):
+            d = deferToThreadPool(reactor, self.threadPool, self.codec.compress, codecFlags, data, compress)
+            return d.addCallback(merge)
+        return succeed(merge(self.codec.compress(codecFlags, data, compress)))
+
+
+    def decode(self, flags, data, uncompress=False):
+        """
+        Decode C{data} with the codec, in the thread pool if it is large.
+
+        @return: A C{Deferred} that fires with the decoded value.
+        """
+        if self.offload(len(data)):
+            return deferToThreadPool(reactor, self.threadPool, self.codec.decode, flags, data, uncompress)
+        return maybeDeferred(self.codec.decode, flags, data, uncompress)
 
 
     def setPickled(self, key, value, **kwargs):
-        value = self.pickle(value, kwargs.pop('compress', False))
-        return self.set(key, value, **kwargs)
+        """
+        Encode C{value} and store it.  The value is pickled unless a different
+        C{serializer} name is given, and is compressed if C{compress} is
+        C{True} (or, if it isn't given, when the value is large).  If C{offload}
+        is C{True} and the client has a thread pool, it is encoded there.  Any
+        other keyword arguments are passed on to C{set}.
+        """
+        d = self.encode(value, kwargs)
+        return d.addCallback(lambda encoded: self.store("set", key, encoded[0], encoded[1], kwargs))
 
 
     def addPickled(self, key, value, **kwargs):
-        value = self.pickle(value, kwargs.pop('compress', False))
-        return self.add(key, value, **kwargs)
+        """
+        Just like L{setPickled}, but uses C{add}.
+        """
+        d = self.encode(value, kwargs)
+        return d.addCallback(lambda encoded: self.store("add", key, encoded[0], encoded[1], kwargs))
+
+
+    def store(self, cmd, key, flags, value, kwargs):
+        """
+        Store an encoded value with C{cmd}, passing it C{flags} and any
+        C{kwargs} (such as C{cas} for C{checkAndSet}).  If the client has a C{chunkSize}
+        and the value is larger than it, the value is split into chunks that
+        are stored under their own keys (and so spread across servers), and
+        a manifest listing them is stored under C{key}.
+
+        If the client has a C{chunkSize}, the value being replaced is also
+        read, and if it was chunked, its chunks are deleted once the new
+        value is stored.
+        """
+        if self.chunkSize is None:
+            return getattr(self, cmd)(key, value, flags=flags, **kwargs)
+        # sent before the write on the same connection, so it reads the old value
+        replaced = self.getClient(key).get(key)
+        if len(value) <= self.chunkSize:
+            d = getattr(self, cmd)(key, value, flags=flags, **kwargs)
+            return d.addCallback(self.deleteChunks, replaced)
+
+        # a new token each time, so readers never mix chunks of two values
+        token = os.urandom(8).encode('hex')
+        chunks = {}
+        for index, offset in enumerate(xrange(0, len(value), self.chunkSize)):
+            chunks["%s%s:%i" % (self.chunkPrefix, token, index)] = (0, value[offset:offset + self.chunkSize])
+        manifest = "%s:%i:%i" % (token, len(chunks), len(value))
+
+        def storeManifest(results):
+            if not all(results.values()):
+                return False
+            return getattr(self, cmd)(key, manifest, flags=flags | CHUNKED, **kwargs)
+        d = self._storeMultiple("set", chunks, kwargs.get('expireTime', 0), False, kwargs.get('timeout'))
+        return d.addCallback(storeManifest).addCallback(self.deleteChunks, replaced)
+
+
+    def deleteChunks(self, stored, replaced):
+        """
+        If C{stored} is true, delete the chunks of the value that C{replaced}
+        fires with, if it was chunked.
+
+        @return: C{stored}.
+        """
+        def delete(result):
+            if stored and result[0] & CHUNKED and result[-1] is not None:
+                self.deleteMultiple(self.chunkKeys(str(result[-1])), noreply=True)
+        replaced.addCallback(delete).addErrback(log.err, "Failed to delete replaced chunks")
+        return stored
+
+
+    def chunkKeys(self, manifest):
+        """
+        @return: The keys of the chunks listed in a manifest stored by
+        L{store}.
+        """
+        token, count = manifest.split(":")[:2]
+        return ["%s%s:%s" % (self.chunkPrefix, token, index) for index in xrange(int(count))]
+
+
+    def getChunks(self, manifest):
+        """
+        Get all of the chunks listed in a manifest stored by L{store}, with one
+        C{get} per server, and join them.
+
+        @return: A C{Deferred} that fires with the joined value, as a
+        C{bytearray}, or C{None} if any chunk is missing.
+        """
+        length = manifest.split(":")[2]
+        keys = self.chunkKeys(manifest)
+
+        def join(results):
+            value = bytearray(int(length))
+            offset = 0
+            for key in keys:
+                chunk = results[key][1]
+                if chunk is None or offset + len(chunk) > len(value):
+                    return None
+                value[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+            if offset != len(value):
+                return None
+            return value
+        return self.getMultiple(keys).addCallback(join)
+
+
+    def decodeResult(self, result, uncompress):
+        """
+        Decode the value in a C{tuple} returned by C{get}, if there is one.
+
+        @return: A C{Deferred} that fires with the decoded result.
+        """
+        index = len(result) - 1
+        if result[index] is None:
+            return succeed(result)
+
+        def replace(value):
+            return result[:index] + (value,)
+
+        def decodeJoined(value):
+            if value is None:
+                return replace(None)
+            return self.decode(result[0] & ~CHUNKED, value, uncompress).addCallback(replace)
+
+        if result[0] & CHUNKED:
+            return self.getChunks(result[index]).addCallback(decodeJoined)
+        return self.decode(result[0], result[index], uncompress).addCallback(replace)
+
+
+    def bounded(self, d, timeout, miss):
+        """
+        Bound the time a caller waits for C{d}.  If it takes longer than
+        C{timeout} seconds (or the client's C{timeout}, if C{timeout} is
+        C{None}), the returned C{Deferred} fires with C{miss}, or fails with
+        a C{TimeoutError} if the client's C{raiseOnTimeout} is C{True}.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return d
+        if self.raiseOnTimeout:
+            return timeoutDeferred(d, timeout, self.clock)
+        return timeoutDeferred(d, timeout, self.clock, lambda: miss)
+
+
+    def get(self, key, withIdentifier=False, timeout=None):
+        if withIdentifier:
+            return self.bounded(self.getClient(key).get(key, withIdentifier), timeout, MISSES['gets'])
+        hot = False
+        if self.hotKeys is not None:
+            self.hotKeys.record(key)
+            hot = self.hotKeys.isHot(key)
+            if hot and self.hotCache is not None:
+                result = self.hotCache.get(key)
+                if result is not None:
+                    return succeed(result)
+        if self.replicas > 1:
+            clients = self.getClients(key)
+            if hot:
+                start = random.randrange(len(clients))
+                clients = clients[start:] + clients[:start]
+            func, args = self.getFromReplicas, (key, clients)
+        else:
+            func, args = self.getClient(key).get, (key,)
+        if self.coalesce:
+            d = self.inflight.call(key, func, *args)
+        else:
+            d = func(*args)
+        if self.previousRouter is not None:
+            d.addCallback(self.getFromPrevious, key)
+        if hot and self.hotCache is not None:
+            d.addCallback(self.cacheHotKey, key)
+        return self.bounded(d, timeout, MISSES['get'])
+
+
+    def getFromPrevious(self, result, key):
+        """
+        If C{result} is a miss, get C{key} from the server that owned it
+        before a migration.
+        """
+        client = self.getPreviousClient(key) if result[-1] is None else None
+        if client is None:
+            return result
+        return client.get(key).addCallback(self.copyResult, key)
+
+
+    def migrated(self, d, key, command, changes):
+        """
+        During a migration, delete C{key} from the server that owned it in
+        the old ring once C{d}, the result of C{command}, fires, so that an
+        older value isn't read from there after a miss.
+
+        @param changes: If C{True}, the command changes the existing value
+        (as C{increment} does), so if it misses, the value is copied from
+        the old server and the command is run again.
+        """
+        previous = self.getPreviousClient(key)
+        if previous is None:
+            return d
+        if not changes:
+            previous.deleteNoReply(key)
+            return d
+
+        def copy(found):
+            if found[-1] is None:
+                return False
+            d = self.getClient(key).add(key, str(found[-1]), found[0], self.copyExpireTime)
+            return d.addCallback(lambda _: command()).addCallback(delete)
+
+        def delete(result):
+            previous.deleteNoReply(key)
+            return result
+
+        def retry(result):
+            if result is not False:
+                return delete(result)
+            return previous.get(key).addCallback(copy)
+        return d.addCallback(retry)
+
+
+    def copyResult(self, result, key):
+        if self.copyForward and result[-1] is not None:
+            d = self.getClient(key).add(key, str(result[-1]), result[0], self.copyExpireTime)
+            d.addErrback(log.err, "Failed to copy %s" % key)
+        return result
+
+
+    def getHotKeys(self):
+        """
+        @return: A C{list} of C{(key, fraction of reads)} tuples for the keys
+        that are currently hot, hottest first.
+        """
+        if self.hotKeys is None:
+            return []
+        return self.hotKeys.getHotKeys()
+
+
+    def cacheHotKey(self, result, key):
+        if result[-1] is not None:
+            self.hotCache.set(key, result, self.hotKeyTTL, len(result[-1]))
+        return result
+
+
+    def invalidateHotKey(self, key):
+        if self.hotCache is not None:
+            self.hotCache.delete(key)
+
+
+    def getFromReplicas(self, key, clients):
+        """
+        Get C{key} from the first of C{clients} that has it.  See
+        L{ReplicaRead}.
+        """
+        hedgeDelay = self.hedgeDelay
+        if self.latencies is not None:
+            hedgeDelay = self.latencies.percentile(self.hedgePercentile, hedgeDelay)
+        return ReplicaRead(key, clients, self.clock, hedgeDelay, self.latencies).deferred
 
 
     def getPickled(self, key, **kwargs):
-        def handleResult(result, uncompress):
-            index = len(result) - 1
-            result = list(result)
-            if result[index] is not None:
-                result[index] = self.unpickle(result[index], uncompress)
-            return tuple(result)
+        """
+        Get a value stored with L{setPickled} or L{addPickled} and decode it,
+        using the flags it was stored with.  Values stored by older versions
+        of txyam with compression need an C{uncompress} keyword argument of
+        C{True}.
+        """
+        uncompress = kwargs.pop('uncompress', False)
+        return self.get(key, **kwargs).addCallback(self.decodeResult, uncompress)
+
+
+    def getMultiple(self, keys, withIdentifier=False, timeout=None):
+        """
+        Get the given list of C{keys}, split across servers.
+
+        Keys are grouped by the server that owns them, and a single batched
+        C{get} is sent to each server in parallel.  The per-server results
+        are merged into a single C{dict}.
+
+        @param keys: A C{list} of keys to retrieve.
+
+        @param withIdentifier: If C{True}, issue a C{gets} so that the cas
+        identifiers are returned along with the values.
+
+        @param timeout: The longest time to wait for each server.  Keys on a
+        server that doesn't answer in time are misses.
+
+        @return: A C{Deferred} that fires with a C{dict} whose keys are the
+        elements of C{keys} and whose values are tuples of (flags, value), or
+        (flags, cas identifier, value) if C{withIdentifier} is C{True}.
+        """
+        cached = {}
+        if self.hotKeys is not None and not withIdentifier:
+            cached = self._getHotKeys(keys)
+            keys = [key for key in keys if key not in cached]
+        d = self._getMultiple(keys, withIdentifier, 0, timeout)
+        if self.replicas > 1 and not withIdentifier:
+            d.addCallback(self._fillFromReplicas, 1, timeout)
+        if self.previousRouter is not None and not withIdentifier:
+            d.addCallback(self._fillFromPrevious, timeout)
+        if self.hotKeys is not None and not withIdentifier:
+            d.addCallback(self._mergeHotKeys, cached)
+        return d
+
+
+    def _getHotKeys(self, keys):
+        """
+        Record reads of C{keys}, and get the hot ones that are cached locally.
+        """
+        cached = {}
+        for key in keys:
+            self.hotKeys.record(key)
+            if self.hotCache is not None and self.hotKeys.isHot(key):
+                result = self.hotCache.get(key)
+                if result is not None:
+                    cached[key] = result
+        return cached
+
+
+    def _mergeHotKeys(self, results, cached):
+        if self.hotCache is not None:
+            for key, result in results.items():
+                if self.hotKeys.isHot(key):
+                    self.cacheHotKey(result, key)
+        results.update(cached)
+        return results
+
+
+    def _getMultiple(self, keys, withIdentifier, level, timeout):
+        """
+        Get C{keys} from the primary servers (if C{level} is 0), or from the
+        C{level}th replicas.
+        """
+        groups = {}
+        for key in keys:
+            if level == 0:
+                client = self.getClient(key)
+            else:
+                factories = self.router.getNodes(key, level + 1)
+                if len(factories) <= level:
+                    continue
+                client = self.clientFor(factories[level])
+            groups.setdefault(client, []).append(key)
+
+        def merge(results):
+            rvalue = {}
+            for success, result in results:
+                rvalue.update(result)
+            return rvalue
+
+        miss = MISSES['gets' if withIdentifier else 'get']
+        ds = [self.bounded(server.getMultiple(ks, withIdentifier), timeout, dict.fromkeys(ks, miss))
+              for server, ks in groups.items()]
+        dl = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        return dl.addCallbacks(merge, lambda failure: failure.value.subFailure)
+
+
+    def _fillFromReplicas(self, results, level, timeout):
+        missing = [key for key, result in results.items() if result[-1] is None]
+        if not missing or level >= self.replicas:
+            return results
+
+        def merge(found):
+            for key, result in found.items():
+                if result[-1] is not None:
+                    results[key] = result
+            return self._fillFromReplicas(results, level + 1, timeout)
+        return self._getMultiple(missing, False, level, timeout).addCallback(merge)
+
+
+    def _fillFromPrevious(self, results, timeout):
+        groups = {}
+        for key, result in results.items():
+            client = self.getPreviousClient(key) if result[-1] is None else None
+            if client is not None:
+                groups.setdefault(client, []).append(key)
+
+        def merge(found):
+            for success, group in found:
+                for key, result in group.items():
+                    if result[-1] is not None:
+                        results[key] = self.copyResult(result, key)
+            return results
+
+        ds = [self.bounded(server.getMultiple(ks), timeout, dict.fromkeys(ks, MISSES['get']))
+              for server, ks in groups.items()]
+        dl = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        return dl.addCallbacks(merge, lambda failure: failure.value.subFailure)
+
+
+    def getMultiplePickled(self, keys, **kwargs):
+        """
+        Just like L{getMultiple}, but decodes each value that was found.
+        Accepts an C{uncompress} keyword argument, as L{getPickled} does.
+        """
+        def handleResult(results, uncompress):
+            return deferredDict(dict((key, self.decodeResult(result, uncompress))
+                                     for key, result in results.items()))
         uncompress = kwargs.pop('uncompress', False)
-        return self.get(key, **kwargs).addCallback(handleResult, uncompress)
+        return self.getMultiple(keys, **kwargs).addCallback(handleResult, uncompress)
+
+
+    def getOrCompute(self, key, func, expireTime=0, staleTime=0, beta=None, lockTime=30, cacheNone=True):
+        """
+        Get the value of C{key}, computing and storing it with C{func} if it
+        isn't there.  Values are stored with the time they become stale (a
+        soft expiry, C{expireTime} seconds after they are computed) and are
+        kept by memcached for another C{staleTime} seconds.  A stale value is
+        still returned, while one caller, the one that gets a lock made with
+        C{add}, computes the new value in the background.
+
+        @param func: A function taking no arguments, which returns the value
+        or a C{Deferred} that fires with it.
+
+        @param beta: If given, values are also recomputed early, each read
+        having a chance of refreshing them that grows as the soft expiry
+        nears and with how long C{func} took (the XFetch algorithm).  1 is a
+        good value; larger values recompute earlier.
+
+        @param lockTime: How long, in seconds, the refresh lock is held if the
+        caller holding it never finishes.
+
+        @param cacheNone: If C{False}, C{None} results are not stored.
+
+        @return: A C{Deferred} that fires with the value.
+        """
+        d = self.getPickled(key)
+        return d.addCallback(self.useComputed, key, func, expireTime, staleTime, beta, lockTime, cacheNone)
+
+
+    def useComputed(self, result, key, func, expireTime, staleTime, beta, lockTime, cacheNone):
+        """
+        Handle the C{getPickled} C{result} for a key stored by
+        L{getOrCompute}: compute the value if it is missing, and start a
+        refresh if it is stale.
+        """
+        if result[-1] is None:
+            if self.coalesce:
+                return self.inflight.call(("compute", key), self.compute, key, func, expireTime, staleTime,
+                                          cacheNone)
+            return self.compute(key, func, expireTime, staleTime, cacheNone)
+        value, staleAt, delta = result[-1]
+        now = self.clock.seconds()
+        if beta:
+            # -log(u) is exponentially distributed, so most reads only look a
+            # little ahead, and the slower func is, the further they look
+            now -= delta * beta * math.log(1.0 - random.random())
+        if staleAt is None or now < staleAt:
+            return value
+        lock = self.lockPrefix + key
+
+        def refresh(locked):
+            if locked:
+                d = self.compute(key, func, expireTime, staleTime, cacheNone)
+                d.addCallback(lambda _: self.delete(lock))
+                d.addErrback(log.err, "Failed to refresh %s" % key)
+        d = self.add(lock, "1", expireTime=lockTime).addCallback(refresh)
+        d.addErrback(log.err, "Failed to lock %s" % key)
+        return value
+
+
+    def compute(self, key, func, expireTime, staleTime, cacheNone=True):
+        """
+        Call C{func} and store its result for L{getOrCompute}.
+
+        @return: A C{Deferred} that fires with the result.
+        """
+        started = self.clock.seconds()
+
+        def store(value):
+            if value is None and not cacheNone:
+                return None
+            now = self.clock.seconds()
+            staleAt = now + expireTime if expireTime else None
+            hardExpireTime = int(math.ceil(expireTime + staleTime)) if expireTime else 0
+            d = self.setPickled(key, (value, staleAt, now - started), expireTime=hardExpireTime)
+            return d.addCallback(lambda _: value)
+        return maybeDeferred(func).addCallback(store)
+
+
+    def _pipelined(self, keys, issue, timeout=None, miss=False, changes=False):
+        """
+        Group C{keys} by server and call C{issue(client, key)} for each of
+        them, with all of the commands for a server sent in one write.  Keys
+        are also sent to their replicas.  Each result is bounded by
+        C{timeout}, as in L{bounded}.  During a migration, keys are handled
+        on their old servers as in L{migrated}.
+
+        @return: A C{Deferred} that fires with a C{dict} of the results
+        of each command on the primary servers, keyed by key.
+        """
+        groups = {}
+        for key in keys:
+            self.invalidateHotKey(key)
+            for index, client in enumerate(self.getClients(key)):
+                groups.setdefault(client, []).append((key, index == 0))
+
+        ds = {}
+        for client, ks in groups.items():
+            client.startPipeline()
+            try:
+                for key, primary in ks:
+                    d = issue(client, key)
+                    if primary:
+                        d = self.migrated(d, key, lambda client=client, key=key: issue(client, key), changes)
+                        ds[key] = self.bounded(d, timeout, miss)
+                    else:
+                        d.addErrback(self.replicaFailed, key)
+            finally:
+                client.flushPipeline()
+        return deferredDict(ds)
+
+
+    def _storeMultiple(self, cmd, values, expireTime, noreply, timeout=None):
+        """
+        Store many values with C{cmd}, where C{values} maps each key to a
+        C{tuple} of flags and value.
+        """
+        if noreply:
+            cmd += "NoReply"
+
+        def issue(client, key):
+            flags, value = values[key]
+            return getattr(client, cmd)(key, value, flags, expireTime)
+        return self._pipelined(values.keys(), issue, timeout)
+
+
+    def setMultiple(self, values, flags=0, expireTime=0, noreply=False, timeout=None):
+        """
+        Set all of the keys and values in the C{dict} C{values}.  Commands
+        for each server are pipelined and sent in a single write.
+
+        @param noreply: If C{True}, send the commands with the C{noreply}
+        option.  The results will all be C{None}.
+
+        @return: A C{Deferred} that fires with a C{dict} mapping each key to
+        the result of its C{set}.
+        """
+        values = dict((key, (flags, value)) for key, value in values.items())
+        return self._storeMultiple("set", values, expireTime, noreply, timeout)
+
+
+    def addMultiple(self, values, flags=0, expireTime=0, noreply=False, timeout=None):
+        """
+        Just like L{setMultiple}, but uses C{add}.
+        """
+        values = dict((key, (flags, value)) for key, value in values.items())
+        return self._storeMultiple("add", values, expireTime, noreply, timeout)
+
+
+    def deleteMultiple(self, keys, noreply=False, timeout=None):
+        """
+        Delete all of the given C{keys}.  Commands for each server are
+        pipelined and sent in a single write.
+
+        @return: A C{Deferred} that fires with a C{dict} mapping each key to
+        the result of its C{delete}.
+        """
+        def issue(client, key):
+            if noreply:
+                return client.deleteNoReply(key)
+            return client.delete(key)
+        return self._pipelined(keys, issue, timeout)
+
+
+    def incrementMultiple(self, deltas, timeout=None):
+        """
+        Change many counters at once.  Commands for each server are pipelined
+        and sent in a single write.
+
+        @param deltas: A C{dict} mapping each key to the amount to add to it.
+        Keys with negative amounts are decremented.
+
+        @return: A C{Deferred} that fires with a C{dict} mapping each key to
+        its new value, or C{False} if it doesn't exist.
+        """
+        def issue(client, key):
+            if deltas[key] < 0:
+                return client.decrement(key, -deltas[key])
+            return client.increment(key, deltas[key])
+        return self._pipelined(deltas.keys(), issue, timeout, MISSES['increment'], True)
+
+
+    def _storeMultiplePickled(self, cmd, values, kwargs):
+        expireTime = kwargs.pop('expireTime', 0)
+        noreply = kwargs.pop('noreply', False)
+        timeout = kwargs.pop('timeout', None)
+
+        def storeAll(encoded):
+            large = {}
+            if self.chunkSize is not None:
+                for key, (flags, value) in encoded.items():
+                    if len(value) > self.chunkSize:
+                        del encoded[key]
+                        large[key] = self.store(cmd, key, flags, value,
+                                                {'expireTime': expireTime, 'timeout': timeout})
+            d = self._storeMultiple(cmd, encoded, expireTime, noreply, timeout)
+            if not large:
+                return d
+            large[None] = d
+            return deferredDict(large).addCallback(merge)
+
+        def merge(results):
+            rvalue = results.pop(None)
+            rvalue.update(results)
+            return rvalue
+
+        d = deferredDict(dict((key, self.encode(value, dict(kwargs))) for key, value in values.items()))
+        return d.addCallback(storeAll)
+
+
+    def setMultiplePickled(self, values, **kwargs):
+        """
+        Just like L{setMultiple}, but encodes each value as L{setPickled}
+        does, and accepts the same keyword arguments.
+        """
+        return self._storeMultiplePickled("set", values, kwargs)
+
+
+    def addMultiplePickled(self, values, **kwargs):
+        """
+        Just like L{setMultiplePickled}, but uses C{add}.
+        """
+        return self._storeMultiplePickled("add", values, kwargs)
+
+
+    def replicaFailed(self, failure, key):
+        log.err(failure, "Failed to update replica of %s" % key)
+
+
+    def checkAndSet(self, key, val, cas, flags=0, expireTime=0, timeout=None):
+        """
+        Store C{val} if C{cas} matches the identifier of the value on the
+        primary server.  Replicas can't be checked, so if the primary is
+        updated, they are just set.
+        """
+        self.invalidateHotKey(key)
+        clients = self.getClients(key)
+
+        def updateReplicas(stored):
+            if stored:
+                for client in clients[1:]:
+                    client.set(key, val, flags, expireTime).addErrback(self.replicaFailed, key)
+            return stored
+        d = clients[0].checkAndSet(key, val, cas, flags, expireTime).addCallback(updateReplicas)
+        return self.bounded(self.migrated(d, key, None, False), timeout, False)
+
+
+    def modify(self, key, func, flags=0, expireTime=0, retries=5, backoff=0.01, maxBackoff=1.0, timeout=None):
+        """
+        Change the value of C{key} with C{func}, without losing changes made
+        by anyone else in the meantime: the value is read with C{gets} and
+        written back with C{checkAndSet}, and if it changed in between, this
+        is retried.  See L{Modification}.
+
+        @param func: Called with the current value, or C{None} if there
+        isn't one (in which case the new value is written with C{add}).
+        Returns the new value, or a C{Deferred} that fires with it.
+
+        @param retries: How many times to retry before giving up.
+
+        @param backoff: The longest delay, in seconds, before the first retry.
+        Later retries wait up to twice as long as the last, up to
+        C{maxBackoff}.
+
+        @return: A C{Deferred} that fires with the new value, or fails with
+        a L{ConflictError} if it kept changing.
+        """
+        d = self.modifyMultiple([key], lambda _, value: func(value), flags, expireTime, retries, backoff,
+                                maxBackoff, timeout)
+        return d.addCallback(lambda results: results[key])
+
+
+    def modifyPickled(self, key, func, retries=5, backoff=0.01, maxBackoff=1.0, **kwargs):
+        """
+        Just like L{modify}, but values are decoded before they are passed to
+        C{func} and encoded before they are written.  Other keyword
+        arguments are the same as for L{setPickled}, along with
+        C{uncompress} and C{timeout}.
+        """
+        d = self.modifyMultiplePickled([key], lambda _, value: func(value), retries, backoff, maxBackoff, **kwargs)
+        return d.addCallback(lambda results: results[key])
+
+
+    def modifyMultiple(self, keys, func, flags=0, expireTime=0, retries=5, backoff=0.01, maxBackoff=1.0,
+                       timeout=None):
+        """
+        Just like L{modify}, for many keys at once, with one C{gets} per
+        server for each try.  C{func} is called with each key and its value.
+
+        @return: A C{Deferred} that fires with a C{dict} mapping each key to
+        its new value, or fails with a L{ConflictError} listing the keys
+        that kept changing (the others have been changed).
+        """
+        kwargs = dict(flags=flags, expireTime=expireTime, timeout=timeout)
+        return Modification(self, keys, func, False, retries, backoff, maxBackoff, kwargs).deferred
+
+
+    def modifyMultiplePickled(self, keys, func, retries=5, backoff=0.01, maxBackoff=1.0, **kwargs):
+        """
+        Just like L{modifyMultiple}, but for pickled values, as with
+        L{modifyPickled}.
+        """
+        return Modification(self, keys, func, True, retries, backoff, maxBackoff, kwargs).deferred
 
 
     # Following methods can be found at
     # http://twistedmatrix.com/trac/browser/tags/releases/twisted-12.0.0/twisted/protocols/memcache.py
     set = wrap("set")
-    get = wrap("get")
     increment = wrap("increment")
     decrement = wrap("decrement")
     replace = wrap("replace")
     add = wrap("add")
-    checkAndSet = wrap("checkAndSet")
     append = wrap("append")
     prepend = wrap("prepend")
-    getMultiple = wrap("getMultiple")
     delete = wrap("delete")
 
 
-def ConnectedYamClient(hosts):
-    return YamClient(hosts, connect=False).connect()
+def ConnectedYamClient(hosts, **kwargs):
+    return YamClient(hosts, connect=False, **kwargs).connect()
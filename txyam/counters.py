@@ -0,0 +1,156 @@
+"""
+Counters whose increments are added up locally and sent in batches, for
+keys that are incremented far more often than their values are needed.
+"""
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.protocols.memcache import ClientError
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+class Counters:
+    """
+    Adds up the increments and decrements of each key, and every
+    C{interval} seconds sends one change per key, pipelined to each server
+    with L{txyam.client.YamClient.incrementMultiple}.  Keys that don't exist
+    yet are created with C{add}, starting at C{initial}.
+
+    Changes that fail are added back and sent with the next batch, up to
+    C{retries} times.  Changes that time out are not, as they may have been
+    made.  Changes rejected with a C{ClientError}, such as those to
+    non-numeric values, are never retried.
+    """
+    def __init__(self, client, interval=0.1, initial=0, expireTime=0, retries=3, clock=None):
+        """
+        @param client: A L{txyam.client.YamClient}.
+
+        @param expireTime: The expire time of counters created by this
+        object.
+
+        @param retries: The number of times a failed change is sent again
+        before the callers waiting for it are given the failure.
+        """
+        self.client = client
+        self.interval = interval
+        self.initial = initial
+        self.expireTime = expireTime
+        self.retries = retries
+        self.clock = clock or reactor
+        self.pending = {}
+        self.waiting = {}
+        self.attempts = {}
+        self.call = None
+
+
+    def increment(self, key, delta=1, immediate=False):
+        """
+        Add C{delta} to the counter C{key}.
+
+        @param immediate: If C{True}, send this key's change now, rather than
+        with the next batch, for callers that need the exact value.
+
+        @return: A C{Deferred} that fires with the counter's value once the
+        change has been sent, or C{None} if it timed out.  It fails if the
+        change was rejected, or still failed after C{retries} retries.
+        """
+        self.pending[key] = self.pending.get(key, 0) + delta
+        d = Deferred()
+        self.waiting.setdefault(key, []).append(d)
+        if immediate:
+            self.flush([key])
+        elif self.call is None:
+            self.call = self.clock.callLater(self.interval, self.flush)
+        return d
+
+
+    def decrement(self, key, delta=1, immediate=False):
+        """
+        Subtract C{delta} from the counter C{key}.  As in memcached,
+        counters don't go below 0.
+        """
+        return self.increment(key, -delta, immediate)
+
+
+    def flush(self, keys=None):
+        """
+        Send the changes to C{keys}, or to every key if C{None}.
+
+        @return: A C{Deferred} that fires when they have all been sent.
+        """
+        if keys is None:
+            keys = self.pending.keys()
+        deltas = dict((key, self.pending.pop(key)) for key in keys if key in self.pending)
+        if not self.pending and self.call is not None:
+            if self.call.active():
+                self.call.cancel()
+            self.call = None
+        waiting = dict((key, self.waiting.pop(key, [])) for key in deltas)
+        d = maybeDeferred(self.client.incrementMultiple, deltas)
+        return d.addCallbacks(self.sent, self.failed, (deltas, waiting), None, (deltas, waiting))
+
+
+    def sent(self, results, deltas, waiting):
+        for key, result in results.items():
+            if isinstance(result, Failure):
+                self.retry(result, key, deltas[key], waiting[key])
+            elif result is False:
+                d = self.create(key, deltas[key])
+                d.addCallbacks(self.finished, self.retry, (key, waiting[key]), None,
+                               (key, deltas[key], waiting[key]))
+            else:
+                self.finished(result, key, waiting[key])
+
+
+    def failed(self, failure, deltas, waiting):
+        for key in deltas:
+            self.retry(failure, key, deltas[key], waiting[key])
+
+
+    def create(self, key, delta):
+        """
+        Create the counter C{key}, or change it if someone else just did.
+        """
+        value = max(self.initial + delta, 0)
+
+        def added(stored):
+            if stored:
+                return value
+            return self.client.incrementMultiple({key: delta}).addCallback(changed)
+
+        def changed(results):
+            # False if it was deleted again in between
+            if results[key] is False:
+                return None
+            return results[key]
+        return self.client.add(key, str(value), 0, self.expireTime).addCallback(added)
+
+
+    def finished(self, value, key, waiting):
+        self.attempts.pop(key, None)
+        for d in waiting:
+            d.callback(value)
+
+
+    def retry(self, failure, key, delta, waiting):
+        attempts = self.attempts.get(key, 0) + 1
+        if failure.check(ClientError) or attempts > self.retries:
+            self.attempts.pop(key, None)
+            for d in waiting:
+                d.errback(failure)
+            return
+        log.err(failure, "Failed to change counter %s" % key)
+        self.attempts[key] = attempts
+        self.pending[key] = self.pending.get(key, 0) + delta
+        self.waiting.setdefault(key, [])[:0] = waiting
+        if self.call is None:
+            self.call = self.clock.callLater(self.interval, self.flush)
+
+
+    def stop(self):
+        """
+        Send everything that's waiting.
+
+        @return: A C{Deferred} that fires when it has been sent.
+        """
+        return self.flush()
@@ -1,32 +1,364 @@
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed, fail
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.python import log
-from twisted.protocols.memcache import MemCacheProtocol
+from twisted.protocols.memcache import MemCacheProtocol, ClientError, Command
 
 
-class ConnectingMemCacheProtocol(MemCacheProtocol):
+def observed(method):
+    """
+    Wrap a protocol's command method so that the factory can watch how it
+    turns out.
+    """
+    cmd = method.__name__
+
+    def wrapper(self, *args, **kwargs):
+        d = method(self, *args, **kwargs)
+        self.factory.observe(cmd, args, d)
+        return d
+    wrapper.__name__ = cmd
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class Pipelining:
+    """
+    Buffering of outgoing commands, so that many can be sent in one write,
+    for protocols that send everything through C{_write}.
+
+    @ivar batchWindow: If not C{None}, commands are always buffered, and
+    are sent this many seconds after the first of them (so 0 sends all of
+    the commands issued in one reactor iteration together).
+
+    @ivar batchBytes: Buffered commands are sent as soon as there are this
+    many bytes of them, unless the buffering was started by
+    L{startPipeline}.
+    """
+    batchWindow = None
+    batchBytes = 65536
+    _pipeline = None
+    _pipelineSize = 0
+    _batchCall = None
+
+    def startPipeline(self):
+        """
+        Start buffering outgoing commands.  Nothing is written to the
+        transport until L{flushPipeline} is called, at which point all
+        buffered commands are sent in a single write.
+        """
+        if self._pipeline is None:
+            self._pipeline = []
+            self._pipelineSize = 0
+
+
+    def flushPipeline(self):
+        """
+        Send all commands buffered since L{startPipeline} in one write.
+        """
+        if self._batchCall is not None:
+            if self._batchCall.active():
+                self._batchCall.cancel()
+            self._batchCall = None
+        pipeline, self._pipeline = self._pipeline, None
+        if pipeline:
+            self.transport.write("".join(pipeline))
+
+
+    def _write(self, data):
+        if self._pipeline is None:
+            if self.batchWindow is None:
+                self.transport.write(data)
+                return
+            self.startPipeline()
+            self._batchCall = self.callLater(self.batchWindow, self.flushPipeline)
+        self._pipeline.append(data)
+        self._pipelineSize += len(data)
+        if self._batchCall is not None and self._pipelineSize >= self.batchBytes:
+            self.flushPipeline()
+
+
+    def _stopBatching(self):
+        if self._batchCall is not None and self._batchCall.active():
+            self._batchCall.cancel()
+        self._batchCall = None
+        self._pipeline = None
+
+
+class ConnectingMemCacheProtocol(Pipelining, MemCacheProtocol):
+    """
+    @ivar mergeGets: If C{True} and commands are being batched (see
+    L{Pipelining}), adjacent single key C{get}s in a batch are sent as one
+    multi-key C{get}, of up to C{mergeMaxKeys} keys.
+    """
+    mergeGets = False
+    mergeMaxKeys = 100
+    _merged = None
+
     def connectionMade(self):
         self.factory.connectionMade()
 
 
+    def connectionLost(self, reason):
+        self._stopBatching()
+        MemCacheProtocol.connectionLost(self, reason)
+
+
+    def _write(self, data):
+        # anything else written means the next get can't be merged
+        self._merged = None
+        Pipelining._write(self, data)
+
+
+    def flushPipeline(self):
+        self._merged = None
+        Pipelining.flushPipeline(self)
+
+
+    @observed
+    def get(self, key, withIdentifier=False):
+        if self.mergeGets and not withIdentifier and (self.batchWindow is not None or self._pipeline is not None):
+            return self._getMerged(key)
+        return MemCacheProtocol.get(self, key, withIdentifier)
+
+
+    def _getMerged(self, key):
+        """
+        Get C{key} as part of a multi-key C{get}, which is started if the last
+        command buffered wasn't one.
+        """
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        d = Deferred()
+        cmd = self._merged
+        if cmd is not None and key in cmd.values:
+            cmd.waiting.append((key, d))
+            return d
+
+        if cmd is not None and len(cmd.keys) < self.mergeMaxKeys:
+            cmd.keys.append(key)
+            cmd.values[key] = (0, "", None)
+            cmd.waiting.append((key, d))
+            line = "get %s%s" % (" ".join(cmd.keys), self.delimiter)
+            self._pipelineSize += len(line) - len(self._pipeline[cmd.line])
+            self._pipeline[cmd.line] = line
+            if self._batchCall is not None and self._pipelineSize >= self.batchBytes:
+                self.flushPipeline()
+            return d
+
+        cmd = Command("get", keys=[key], values={key: (0, "", None)}, multiple=True, waiting=[(key, d)])
+        cmd._deferred.addCallbacks(self._mergedResults, self._mergedFailed,
+                                   callbackArgs=(cmd,), errbackArgs=(cmd,))
+        self.sendLine("get %s" % key)
+        self._current.append(cmd)
+        if self._pipeline is not None:
+            # the line can still be rewritten to add more keys
+            cmd.line = len(self._pipeline) - 1
+            self._merged = cmd
+        return d
+
+
+    def _mergedResults(self, values, cmd):
+        for key, d in cmd.waiting:
+            d.callback(values[key])
+
+
+    def _mergedFailed(self, failure, cmd):
+        for _, d in cmd.waiting:
+            d.errback(failure)
+
+
+    def queueDepth(self):
+        """
+        @return: The number of commands waiting for a response.
+        """
+        return len(self._current)
+
+
+    def sendLine(self, line):
+        # Same as MemCacheProtocol.sendLine, but honors the pipeline
+        if not self._current:
+            self.setTimeout(self.persistentTimeOut)
+        self._write(line + self.delimiter)
+
+
+    def setNoReply(self, key, val, flags=0, expireTime=0):
+        """
+        Like C{set}, but with the C{noreply} option so the server does not
+        respond.  The returned C{Deferred} fires with C{None} immediately.
+        """
+        return self._setNoReply("set", key, val, flags, expireTime)
+
+
+    def addNoReply(self, key, val, flags=0, expireTime=0):
+        """
+        Like C{add}, but with the C{noreply} option so the server does not
+        respond.  The returned C{Deferred} fires with C{None} immediately.
+        """
+        return self._setNoReply("add", key, val, flags, expireTime)
+
+
+    def deleteNoReply(self, key):
+        """
+        Like C{delete}, but with the C{noreply} option so the server does not
+        respond.  The returned C{Deferred} fires with C{None} immediately.
+        """
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        self._write("delete %s noreply%s" % (key, self.delimiter))
+        return succeed(None)
+
+
+    def _setNoReply(self, cmd, key, val, flags, expireTime):
+        error = self._checkKey(key)
+        if error is not None:
+            return error
+        if not isinstance(val, bytes):
+            return fail(ClientError("Invalid type for value: %s, expecting bytes" % type(val)))
+        self._write("%s %s %d %d %d noreply%s%s%s" % (cmd, key, flags, expireTime, len(val),
+                                                      self.delimiter, val, self.delimiter))
+        return succeed(None)
+
+
+    def _checkKey(self, key):
+        if self._disconnected:
+            return fail(RuntimeError("not connected"))
+        if not isinstance(key, bytes):
+            return fail(ClientError("Invalid type for key: %s, expecting bytes" % type(key)))
+        if len(key) > self.MAX_KEY_LENGTH:
+            return fail(ClientError("Key too long"))
+        return None
+
+
     def __str__(self):
         # this method is necessary per hash_ring docs
         return "memcache[%s]" % str(self.factory.addr)
 
 
+    getMultiple = observed(MemCacheProtocol.getMultiple)
+    set = observed(MemCacheProtocol.set)
+    add = observed(MemCacheProtocol.add)
+    replace = observed(MemCacheProtocol.replace)
+    append = observed(MemCacheProtocol.append)
+    prepend = observed(MemCacheProtocol.prepend)
+    checkAndSet = observed(MemCacheProtocol.checkAndSet)
+    increment = observed(MemCacheProtocol.increment)
+    decrement = observed(MemCacheProtocol.decrement)
+    delete = observed(MemCacheProtocol.delete)
+
+
+class BufferedMemCacheProtocol(ConnectingMemCacheProtocol):
+    """
+    Reads values of at least C{largeValue} bytes straight into a
+    preallocated C{bytearray}, instead of keeping every piece as it arrives
+    and joining them at the end.  Those values are returned as the
+    C{bytearray}, which L{txyam.serialization.Codec} can decompress and
+    unpickle without copying.  Smaller values are still returned as C{str}.
+    """
+    largeValue = 16384
+
+    def cmd_VALUE(self, line):
+        ConnectingMemCacheProtocol.cmd_VALUE(self, line)
+        if self._lenExpected >= self.largeValue:
+            self._getBuffer = bytearray(self._lenExpected)
+
+
+    def rawDataReceived(self, data):
+        if not isinstance(self._getBuffer, bytearray):
+            return ConnectingMemCacheProtocol.rawDataReceived(self, data)
+        self.resetTimeout()
+        value = self._getBuffer
+        start = self._bufferLength
+        # the value is followed by "\r\n", which is read but not kept
+        end = min(self._lenExpected + 2, start + len(data))
+        if start < self._lenExpected:
+            length = min(self._lenExpected, end) - start
+            memoryview(value)[start:start + length] = buffer(data, 0, length)
+        self._bufferLength = end
+        if end < self._lenExpected + 2:
+            return
+
+        self._lenExpected = None
+        self._getBuffer = None
+        self._bufferLength = None
+        cmd = self._current[0]
+        if cmd.multiple:
+            flags, cas = cmd.values[cmd.currentKey]
+            cmd.values[cmd.currentKey] = (flags, cas, value)
+        else:
+            cmd.value = value
+        self.setLineMode(data[end - start:])
+
+
 class MemCacheClientFactory(ReconnectingClientFactory):
+    """
+    @ivar batchWindow: Passed on to each protocol built, along with
+    C{batchBytes} and C{mergeGets}.  See L{Pipelining}.
+    """
     initialDelay = 0.1
     protocol = ConnectingMemCacheProtocol
     noisy = True
+    batchWindow = None
+    batchBytes = 65536
+    mergeGets = False
+    nameByHostPort = False
+
+    def __init__(self, owner=None, hostport=None):
+        """
+        @param owner: An optional object (usually a L{txyam.client.YamClient})
+        whose C{connectionStateChanged} method will be called with this
+        factory whenever a connection is made or lost.  If it has an
+        C{observe} method, that is called with this factory, the name and
+        arguments of each command sent and the command's C{Deferred}.
 
-    def __init__(self):
+        @param hostport: The configured "host:port" of the server, which
+        unlike the connected address does not change between reconnects.
+        """
+        self.owner = owner
+        self.hostport = hostport
         self.client = None
         self.addr = None
         self.deferred = Deferred()
 
 
+    def __str__(self):
+        # used as the node name in the hash ring; this is the same name
+        # the protocol has, so keys map to the same server as before.
+        # Factories that can be in the ring before they connect (because
+        # commands are queued for them) are always named by their
+        # configured address, so their keys don't move when they connect
+        if self.nameByHostPort or self.addr is None:
+            return "memcache[%s]" % self.hostport
+        return "memcache[%s]" % str(self.addr)
+
+
+    def getConnections(self):
+        if self.client is None:
+            return []
+        return [self.client]
+
+
+    def notifyOwner(self):
+        if self.owner is not None:
+            self.owner.connectionStateChanged(self)
+
+
+    def observe(self, cmd, args, d):
+        """
+        Called by the protocol with each command it sends, and passed along
+        to the owner if it has an C{observe} method.
+        """
+        observe = getattr(self.owner, 'observe', None)
+        if observe is not None:
+            observe(self, cmd, args, d)
+
+
     def buildProtocol(self, addr, timeOut=60):
         self.client = self.protocol(timeOut=timeOut)
+        if self.batchWindow is not None:
+            self.client.batchWindow = self.batchWindow
+            self.client.batchBytes = self.batchBytes
+            self.client.mergeGets = self.mergeGets
         self.addr = addr
         self.client.factory = self
         self.resetDelay()
@@ -36,16 +368,19 @@ class MemCacheClientFactory(ReconnectingClientFactory):
     def clientConnectionLost(self, connector, reason):
         log.msg("Lost connection to %s - %s" % (self.addr, reason))
         self.client = None
+        self.notifyOwner()
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
 
     def clientConnectionFailed(self, connector, reason):
         log.msg("Connection failed to %s - %s" % (self.addr, reason))
         self.client = None
+        self.notifyOwner()
         ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
 
     def connectionMade(self):
+        self.notifyOwner()
         # Only fire deferred after the first connection has been made.
         # This is used in the ConnectedYamClient to keep track of when
         # all factories have connected so that ConnectedYamClient.connect()
@@ -53,3 +388,117 @@ class MemCacheClientFactory(ReconnectingClientFactory):
         if self.deferred is not None:
             self.deferred.callback(self)
             self.deferred = None
+
+
+class BufferedMemCacheClientFactory(MemCacheClientFactory):
+    """
+    A L{MemCacheClientFactory} whose connections read large values into
+    preallocated buffers.  See L{BufferedMemCacheProtocol}.
+    """
+    protocol = BufferedMemCacheProtocol
+
+
+class MemCacheClientPool(object):
+    """
+    A pool of connections to a single server.  Each connection has its own
+    L{MemCacheClientFactory}, and commands are sent over the connection with
+    the fewest outstanding requests, so one slow response does not hold up
+    every other request to the server.
+
+    A pool can be used anywhere a single L{MemCacheClientFactory} would be.
+    Its owner is only notified when the server becomes available (the first
+    connection is made) or unavailable (the last connection is lost).
+    """
+    nameByHostPort = False
+
+    def __init__(self, size, owner=None, hostport=None, factoryClass=MemCacheClientFactory):
+        """
+        @param size: The number of connections in the pool.
+
+        @param owner: Just like the C{owner} of a L{MemCacheClientFactory}.
+
+        @param hostport: The configured "host:port" of the server.
+
+        @param factoryClass: The class of the factory for each connection.
+        """
+        self.owner = owner
+        self.hostport = hostport
+        self.factories = [factoryClass(self, hostport) for _ in range(size)]
+        self.connected = []
+        self.connects = 0
+        self.deferred = Deferred()
+
+
+    def __str__(self):
+        if self.nameByHostPort or self.addr is None:
+            return "memcache[%s]" % self.hostport
+        return "memcache[%s]" % str(self.addr)
+
+
+    @property
+    def addr(self):
+        for factory in self.factories:
+            if factory.addr is not None:
+                return factory.addr
+        return None
+
+
+    @property
+    def client(self):
+        """
+        The connected protocol with the fewest outstanding requests, or
+        C{None} if there are no connections.
+        """
+        best = None
+        for client in self.connected:
+            if best is None or client.queueDepth() < best.queueDepth():
+                best = client
+        return best
+
+
+    def getConnections(self):
+        return list(self.connected)
+
+
+    def stopTrying(self):
+        for factory in self.factories:
+            factory.stopTrying()
+
+
+    def observe(self, factory, cmd, args, d):
+        observe = getattr(self.owner, 'observe', None)
+        if observe is not None:
+            observe(self, cmd, args, d)
+
+
+    def connectionStateChanged(self, factory):
+        wasAvailable = len(self.connected) > 0
+        self.connected = [f.client for f in self.factories if f.client is not None]
+        if factory.client is not None:
+            self.connects += 1
+            # the server is back, so there's no need for the other
+            # connections to keep backing off
+            for other in self.factories:
+                other.resetDelay()
+                if other._callID is not None and other._callID.active():
+                    other._callID.reset(0)
+            if self.deferred is not None:
+                self.deferred.callback(self)
+                self.deferred = None
+
+        if wasAvailable != (len(self.connected) > 0) and self.owner is not None:
+            self.owner.connectionStateChanged(self)
+
+
+    def poolStats(self):
+        """
+        @return: A C{dict} with the pool size, the number of connected
+        connections, the number of requests outstanding on each connection
+        and the total number of connections made.
+        """
+        return {
+            'size': len(self.factories),
+            'connected': len(self.connected),
+            'outstanding': [client.queueDepth() for client in self.connected],
+            'connects': self.connects
+        }
@@ -0,0 +1,269 @@
+"""
+Tracking the health of servers, so that slow or flapping ones can be taken
+out of the ring before they cause trouble for every key they own.
+"""
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import TimeoutError
+from twisted.protocols.memcache import ClientError
+from twisted.python import log
+
+from txyam.utils import timeoutDeferred
+
+
+class ServerHealth:
+    """
+    What a L{HealthMonitor} knows about one server.
+
+    @ivar errorRate: A moving average of the fraction of commands that
+    failed.
+
+    @ivar timeoutRate: A moving average of the fraction of commands that
+    timed out or were slower than the monitor's C{slowLatency}.
+
+    @ivar latency: A moving average of command latency, in seconds.
+    """
+    def __init__(self):
+        self.errorRate = 0.0
+        self.timeoutRate = 0.0
+        self.latency = 0.0
+        self.samples = 0
+        self.losses = deque()
+        self.ejected = False
+        self.ejectedAt = None
+        self.readmittedAt = None
+        self.ejections = 0
+        self.goodProbes = 0
+        self.probe = None
+
+
+    def reset(self):
+        self.errorRate = self.timeoutRate = self.latency = 0.0
+        self.samples = 0
+        self.losses.clear()
+
+
+    def asDict(self):
+        return {'errorRate': self.errorRate, 'timeoutRate': self.timeoutRate,
+                'latency': self.latency, 'samples': self.samples,
+                'ejected': self.ejected, 'ejections': self.ejections}
+
+
+class HealthMonitor:
+    """
+    Watches the commands sent to each server and ejects servers from the ring
+    when their error rate, timeout rate or latency is too high, or when they
+    keep losing their connections.  Ejected servers are probed in the
+    background, and are only readmitted after answering several probes in a
+    row and waiting out a cooldown, which doubles each time a server is
+    ejected again soon after being readmitted.
+
+    Pass an instance to L{txyam.client.YamClient} as C{health}, which adds
+    it as an observer (see L{txyam.stats}).
+    """
+    def __init__(self, errorThreshold=0.5, timeoutThreshold=0.5, latencyThreshold=None, slowLatency=None,
+                 alpha=0.1, minSamples=20, maxFlaps=3, flapWindow=60, cooldown=10, maxCooldown=300,
+                 probeInterval=1, probesNeeded=3, maxEjectedFraction=0.5, clock=None):
+        """
+        @param errorThreshold: Eject a server when this fraction of its
+        commands are failing.
+
+        @param timeoutThreshold: Eject a server when this fraction of its
+        commands are timing out or are slower than C{slowLatency}.
+
+        @param latencyThreshold: If given, eject a server when its average
+        latency is over this many seconds.
+
+        @param slowLatency: If given, commands slower than this many seconds
+        count as timeouts.
+
+        @param alpha: How much weight the moving averages give to each new
+        command, from 0 to 1.
+
+        @param minSamples: The number of commands a server must have answered
+        before it can be ejected for its error rate, timeout rate or latency.
+
+        @param maxFlaps: Eject a server when it loses its connection this many
+        times within C{flapWindow} seconds.
+
+        @param cooldown: The shortest time in seconds a server stays ejected.
+
+        @param maxCooldown: The longest cooldown.  A server that stays healthy
+        this long after being readmitted starts over with C{cooldown}.
+
+        @param probeInterval: How often, in seconds, ejected servers are
+        probed.
+
+        @param probesNeeded: The number of probes in a row an ejected server
+        must answer before it is readmitted.
+
+        @param maxEjectedFraction: Never eject more than this fraction of the
+        servers, so that a problem on the client's side can't empty the
+        ring.
+        """
+        self.errorThreshold = errorThreshold
+        self.timeoutThreshold = timeoutThreshold
+        self.latencyThreshold = latencyThreshold
+        self.slowLatency = slowLatency
+        self.alpha = alpha
+        self.minSamples = minSamples
+        self.maxFlaps = maxFlaps
+        self.flapWindow = flapWindow
+        self.cooldown = cooldown
+        self.maxCooldown = maxCooldown
+        self.probeInterval = probeInterval
+        self.probesNeeded = probesNeeded
+        self.maxEjectedFraction = maxEjectedFraction
+        self.clock = clock or reactor
+        self.owner = None
+        self.servers = {}
+
+
+    def getHealth(self, node):
+        health = self.servers.get(node)
+        if health is None:
+            health = self.servers[node] = ServerHealth()
+        return health
+
+
+    def isHealthy(self, node):
+        health = self.servers.get(node)
+        return health is None or not health.ejected
+
+
+    def observe(self, node, cmd, args, d):
+        """
+        Record how the command C{cmd} sent to C{node} turns out, once its
+        C{Deferred} C{d} fires.
+        """
+        started = self.clock.seconds()
+
+        def record(result):
+            self.record(node, self.clock.seconds() - started, result)
+            return result
+        d.addBoth(record)
+
+
+    def record(self, node, latency, result=None):
+        """
+        Record a command that took C{latency} seconds and ended with
+        C{result}.
+        """
+        health = self.getHealth(node)
+        if health.ejected:
+            return
+        error = timeout = 0.0
+        if hasattr(result, 'check') and not result.check(ClientError):
+            if result.check(TimeoutError):
+                timeout = 1.0
+            else:
+                error = 1.0
+        elif self.slowLatency is not None and latency > self.slowLatency:
+            timeout = 1.0
+
+        alpha = self.alpha
+        if health.samples == 0:
+            health.latency = latency
+        health.errorRate += alpha * (error - health.errorRate)
+        health.timeoutRate += alpha * (timeout - health.timeoutRate)
+        health.latency += alpha * (latency - health.latency)
+        health.samples += 1
+        if health.samples >= self.minSamples and self.isFailing(health):
+            self.eject(node)
+
+
+    def isFailing(self, health):
+        return (health.errorRate >= self.errorThreshold or
+                health.timeoutRate >= self.timeoutThreshold or
+                (self.latencyThreshold is not None and health.latency >= self.latencyThreshold))
+
+
+    def connectionLost(self, node):
+        """
+        Record that C{node} lost its connection.
+        """
+        health = self.getHealth(node)
+        if health.ejected:
+            return
+        now = self.clock.seconds()
+        health.losses.append(now)
+        while health.losses and health.losses[0] <= now - self.flapWindow:
+            health.losses.popleft()
+        if len(health.losses) >= self.maxFlaps:
+            self.eject(node)
+
+
+    def eject(self, node):
+        ejected = len([h for h in self.servers.values() if h.ejected])
+        total = len(self.owner.factories) if self.owner is not None else len(self.servers)
+        if ejected + 1 > total * self.maxEjectedFraction:
+            return
+
+        health = self.getHealth(node)
+        now = self.clock.seconds()
+        if health.readmittedAt is not None and now - health.readmittedAt >= self.maxCooldown:
+            health.ejections = 0
+        health.ejected = True
+        health.ejectedAt = now
+        health.ejections += 1
+        health.goodProbes = 0
+        log.msg("Ejecting %s (%s)" % (node, health.asDict()))
+        if self.owner is not None:
+            self.owner.rebuildRouter()
+        health.probe = self.clock.callLater(self.probeInterval, self.sendProbe, node)
+
+
+    def getCooldown(self, health):
+        return min(self.cooldown * 2 ** (health.ejections - 1), self.maxCooldown)
+
+
+    def sendProbe(self, node):
+        health = self.getHealth(node)
+        health.probe = None
+        if node.client is None:
+            self.probeFinished(False, node)
+            return
+        d = timeoutDeferred(node.client.version(), self.probeInterval, self.clock, lambda: None)
+        d.addCallbacks(lambda version: version is not None, lambda _: False)
+        d.addCallback(self.probeFinished, node)
+
+
+    def probeFinished(self, ok, node):
+        health = self.getHealth(node)
+        if not health.ejected:
+            return
+        health.goodProbes = health.goodProbes + 1 if ok else 0
+        now = self.clock.seconds()
+        if health.goodProbes >= self.probesNeeded and now - health.ejectedAt >= self.getCooldown(health):
+            self.readmit(node)
+        else:
+            health.probe = self.clock.callLater(self.probeInterval, self.sendProbe, node)
+
+
+    def readmit(self, node):
+        health = self.getHealth(node)
+        health.ejected = False
+        health.readmittedAt = self.clock.seconds()
+        health.reset()
+        log.msg("Readmitting %s" % node)
+        if self.owner is not None:
+            self.owner.rebuildRouter()
+
+
+    def stop(self):
+        """
+        Stop probing ejected servers.
+        """
+        for health in self.servers.values():
+            if health.probe is not None and health.probe.active():
+                health.probe.cancel()
+            health.probe = None
+
+
+    def healthStats(self):
+        """
+        @return: A C{dict} mapping the name of each server to a C{dict} of
+        what is known about its health.
+        """
+        return dict((str(node), health.asDict()) for node, health in self.servers.items())
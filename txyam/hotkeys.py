@@ -0,0 +1,117 @@
+"""
+Finding the keys that get a large share of reads, so they can be kept off
+the one server that owns each of them.
+"""
+import random
+
+from twisted.internet import reactor
+
+
+class SpaceSaving:
+    """
+    The space saving top-k sketch.  At most C{capacity} keys are counted;
+    when a new key arrives and the sketch is full, it replaces the key with
+    the smallest count and takes over that count.  Counts may be too high,
+    but never too low, and any key with more than M{total / capacity}
+    occurrences is always in the sketch.
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.counts = {}
+        self.total = 0
+
+
+    def add(self, key, count=1):
+        """
+        @return: The new count for C{key}.
+        """
+        self.total += count
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.capacity:
+            counts[key] = count
+        else:
+            victim = min(counts, key=counts.get)
+            counts[key] = counts.pop(victim) + count
+        return counts[key]
+
+
+    def top(self, n=None):
+        """
+        @return: A C{list} of C{(key, count)} tuples, largest count first.
+        """
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:n] if n is not None else ranked
+
+
+    def decay(self):
+        """
+        Halve every count, so that keys that were hot a while ago are
+        forgotten.
+        """
+        self.total //= 2
+        for key, count in self.counts.items():
+            if count > 1:
+                self.counts[key] = count // 2
+            else:
+                del self.counts[key]
+
+
+class HotKeyDetector:
+    """
+    Samples the keys that are read and keeps track of which of them are
+    getting at least C{threshold} of all reads.  Counts are halved every
+    C{decayInterval} seconds so that the hot keys follow recent traffic.
+    """
+    def __init__(self, capacity=64, threshold=0.01, sampleRate=0.1, minSamples=100, decayInterval=10, clock=None):
+        """
+        @param capacity: The number of keys to count.
+
+        @param threshold: The fraction of reads a key must get to be hot.
+
+        @param sampleRate: The fraction of reads to count, from 0 to 1.
+
+        @param minSamples: The number of reads that must be counted before
+        any key is considered hot.
+
+        @param decayInterval: How often, in seconds, counts are halved.
+        """
+        self.sketch = SpaceSaving(capacity)
+        self.threshold = threshold
+        self.sampleRate = sampleRate
+        self.minSamples = minSamples
+        self.decayInterval = decayInterval
+        self.clock = clock or reactor
+        self.nextDecay = self.clock.seconds() + decayInterval
+        self.hot = set()
+
+
+    def record(self, key):
+        if self.sampleRate < 1 and random.random() >= self.sampleRate:
+            return
+        now = self.clock.seconds()
+        if now >= self.nextDecay:
+            self.nextDecay = now + self.decayInterval
+            self.sketch.decay()
+            self.hot = set(key for key, _ in self.getHotKeys())
+        count = self.sketch.add(key)
+        total = self.sketch.total
+        if total >= self.minSamples and count >= self.threshold * total:
+            self.hot.add(key)
+
+
+    def isHot(self, key):
+        return key in self.hot
+
+
+    def getHotKeys(self):
+        """
+        @return: A C{list} of C{(key, fraction)} tuples for the keys currently
+        getting at least C{threshold} of reads, hottest first.
+        """
+        total = self.sketch.total
+        if total < self.minSamples:
+            return []
+        return [(key, float(count) / total) for key, count in self.sketch.top()
+                if count >= self.threshold * total]
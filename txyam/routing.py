@@ -0,0 +1,190 @@
+"""
+Strategies for deciding which server owns a key.
+
+A router is built from the list of currently usable nodes (factories) and
+is replaced, never modified, when that list changes.  All of the expensive
+work is done when a router is built, so that finding the node for a key is
+cheap.
+"""
+import hashlib
+import math
+import struct
+from bisect import bisect_left
+from itertools import islice
+
+from hash_ring import HashRing
+
+
+class Router(object):
+    """
+    Base class for routing strategies.  Subclasses must implement
+    C{build}, C{findNode} and C{findNodes}.
+
+    @ivar memoSize: The maximum number of key lookups to remember.  When
+    full, the memo is cleared.
+    """
+    memoSize = 4096
+
+    def __init__(self, nodes, weights=None):
+        """
+        @param nodes: A C{list} of nodes.  Each node should have a C{hostport}
+        attribute, which is the configured "host:port" of the server.
+
+        @param weights: An optional C{dict} mapping "host:port" strings to
+        integer weights.  Nodes not in the C{dict} have a weight of 1.
+        """
+        self.nodes = list(nodes)
+        self.weights = weights or {}
+        self._memo = {}
+        self.build()
+
+
+    def nodeName(self, node):
+        return node.hostport
+
+
+    def getWeight(self, node):
+        return self.weights.get(node.hostport, 1)
+
+
+    def getNode(self, key):
+        """
+        Get the node that owns C{key}, or C{None} if there are no nodes.
+        """
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        if not self.nodes:
+            return None
+        if len(self._memo) >= self.memoSize:
+            self._memo.clear()
+        node = self._memo[key] = self.findNode(key)
+        return node
+
+
+    def getNodes(self, key, count):
+        """
+        Get up to C{count} distinct nodes for C{key}, in order of preference.
+        The first is always the same as the result of L{getNode}.
+        """
+        if not self.nodes:
+            return []
+        return self.findNodes(key, min(count, len(self.nodes)))
+
+
+    def build(self):
+        raise NotImplementedError()
+
+
+    def findNode(self, key):
+        raise NotImplementedError()
+
+
+    def findNodes(self, key, count):
+        raise NotImplementedError()
+
+
+class HashRingRouter(Router):
+    """
+    Routes using a C{hash_ring.HashRing}.  Nodes are named by their connected
+    address, which is how txyam has always distributed keys.
+    """
+    def nodeName(self, node):
+        return str(node)
+
+
+    def build(self):
+        weights = dict((node, self.getWeight(node)) for node in self.nodes)
+        self.ring = HashRing(self.nodes, weights)
+
+
+    def findNode(self, key):
+        return self.ring.get_node(key)
+
+
+    def findNodes(self, key, count):
+        return list(islice(self.ring.iterate_nodes(key), count))
+
+
+def float32(value):
+    """
+    Round C{value} to the nearest single precision float.
+    """
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+class KetamaRouter(Router):
+    """
+    Routes compatibly with libketama (and the many clients based on it),
+    using the configured "host:port" of each server as its name.
+    """
+    pointsPerServer = 40
+
+    def build(self):
+        total = sum(self.getWeight(node) for node in self.nodes)
+        points = []
+        for node in self.nodes:
+            name = self.nodeName(node)
+            # libketama uses C floats here, which round up some counts that
+            # would otherwise be just below a whole number
+            share = float32(float(self.getWeight(node)) / total)
+            count = int(math.floor(float32(share * self.pointsPerServer * len(self.nodes))))
+            for index in xrange(count):
+                digest = hashlib.md5("%s-%i" % (name, index)).digest()
+                for point in struct.unpack("<4I", digest):
+                    points.append((point, node))
+        points.sort(key=lambda p: p[0])
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+
+    def findPosition(self, key):
+        point = struct.unpack("<I", hashlib.md5(key).digest()[:4])[0]
+        position = bisect_left(self.points, point)
+        if position == len(self.points):
+            return 0
+        return position
+
+
+    def findNode(self, key):
+        return self.owners[self.findPosition(key)]
+
+
+    def findNodes(self, key, count):
+        position = self.findPosition(key)
+        nodes = []
+        for index in xrange(len(self.owners)):
+            node = self.owners[(position + index) % len(self.owners)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+
+class RendezvousRouter(Router):
+    """
+    Routes using weighted rendezvous (highest random weight) hashing.  When a
+    server is removed only the keys it owned move, and there is no ring to
+    build, at the cost of a lookup that is linear in the number of servers.
+    """
+    def build(self):
+        self.scored = [(self.nodeName(node) + "-", float(self.getWeight(node)), node)
+                       for node in self.nodes]
+
+
+    def scores(self, key):
+        for prefix, weight, node in self.scored:
+            # map 53 bits of the hash to (0, 1) so the log is always defined
+            h = ((struct.unpack("<Q", hashlib.md5(prefix + key).digest()[:8])[0] >> 11) + 0.5) / 9007199254740992.0
+            yield -weight / math.log(h), node
+
+
+    def findNode(self, key):
+        return max(self.scores(key))[1]
+
+
+    def findNodes(self, key, count):
+        ranked = sorted(self.scores(key), reverse=True)
+        return [node for _, node in ranked[:count]]
@@ -0,0 +1,202 @@
+"""
+Serializers and compressors for storing objects, and the L{Codec} that picks
+between them.
+
+The serializer and compressor used for a value are recorded in the low byte
+of the memcached flags stored with it, so values can be decoded without
+knowing how they were stored.  A flags value of 0 is a pickle, which is what
+older versions of txyam always stored.  The high bit of the low byte is
+used by L{txyam.client.YamClient} to mark values that were split into
+chunks.
+"""
+import cPickle
+import cStringIO
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+SERIALIZER_MASK = 0x0f
+COMPRESSOR_MASK = 0x70
+CODEC_MASK = SERIALIZER_MASK | COMPRESSOR_MASK
+CHUNKED = 0x80
+
+serializers = {}
+compressors = {}
+
+
+class UnknownCodecError(Exception):
+    """
+    A value was stored with a serializer or compressor that isn't registered.
+    """
+
+
+class Serializer:
+    def __init__(self, name, flag, dumps, loads, loadsBuffers=False):
+        self.name = name
+        self.flag = flag
+        self.dumps = dumps
+        self.loads = loads
+        self.loadsBuffers = loadsBuffers
+
+
+class Compressor:
+    def __init__(self, name, flag, compress, decompress):
+        self.name = name
+        self.flag = flag
+        self.compress = compress
+        self.decompress = decompress
+
+
+def registerSerializer(name, flag, dumps, loads, loadsBuffers=False):
+    """
+    Register a serializer.
+
+    @param flag: An integer from 0 to 15 that identifies values stored with
+    this serializer.
+
+    @param dumps: A function that turns an object into a C{str}.
+
+    @param loads: A function that turns a C{str} back into an object.
+
+    @param loadsBuffers: C{True} if C{loads} also accepts a C{bytearray}.
+    Otherwise, large values read into a C{bytearray} are copied into a
+    C{str} first.
+    """
+    if flag & ~SERIALIZER_MASK:
+        raise ValueError("Serializer flag must be between 0 and 15")
+    serializers[name] = serializers[flag] = Serializer(name, flag, dumps, loads, loadsBuffers)
+
+
+def registerCompressor(name, flag, compress, decompress):
+    """
+    Register a compressor.
+
+    @param flag: An integer from 1 to 7 that identifies values stored with
+    this compressor.
+    """
+    if not 0 < flag < 8:
+        raise ValueError("Compressor flag must be between 1 and 7")
+    flag = flag << 4
+    compressors[name] = compressors[flag] = Compressor(name, flag, compress, decompress)
+
+
+def unpickle(data):
+    if isinstance(data, bytearray):
+        # cStringIO reads from the bytearray without copying it
+        return cPickle.load(cStringIO.StringIO(data))
+    return cPickle.loads(data)
+
+
+registerSerializer('pickle', 0, lambda value: cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL), unpickle, True)
+registerSerializer('json', 1, json.dumps, json.loads)
+registerSerializer('raw', 2, str, str)
+if msgpack is not None:
+    registerSerializer('msgpack', 3, msgpack.packb, msgpack.unpackb, True)
+
+registerCompressor('zlib', 1, zlib.compress, zlib.decompress)
+if lz4 is not None:
+    registerCompressor('lz4', 2, lz4.frame.compress, lz4.frame.decompress)
+
+
+class Codec:
+    """
+    Encodes objects to be stored and decodes them again.
+    """
+    def __init__(self, serializer='pickle', compressor='zlib', compressThreshold=16384):
+        """
+        @param serializer: The name of the default serializer.
+
+        @param compressor: The name of the compressor to use.
+
+        @param compressThreshold: Serialized values at least this many bytes
+        long are compressed, unless compression is explicitly turned off.
+        Values that don't get any smaller are stored uncompressed.
+        """
+        self.serializer = serializers[serializer]
+        self.compressor = compressors[compressor]
+        self.compressThreshold = compressThreshold
+
+
+    def encode(self, value, serializer=None, compress=None):
+        """
+        Encode C{value}.
+
+        @param serializer: The name of the serializer to use instead of the
+        default.
+
+        @param compress: If C{True}, always compress.  If C{False}, never
+        compress.  If C{None}, compress when the serialized value is at least
+        C{compressThreshold} bytes long.
+
+        @return: A C{tuple} of the flags to store and the encoded C{str}.
+        """
+        flags, data = self.serialize(value, serializer)
+        return self.compress(flags, data, compress)
+
+
+    def serialize(self, value, serializer=None):
+        """
+        The first half of L{encode}.
+
+        @return: A C{tuple} of flags and the serialized C{str}.
+        """
+        if serializer is None:
+            serializer = self.serializer
+        else:
+            serializer = serializers[serializer]
+        return serializer.flag, serializer.dumps(value)
+
+
+    def compress(self, flags, data, compress=None):
+        """
+        The second half of L{encode}.
+
+        @return: A C{tuple} of flags and the (possibly) compressed C{str}.
+        """
+        if compress or (compress is None and len(data) >= self.compressThreshold):
+            compressed = self.compressor.compress(data)
+            if compress or len(compressed) < len(data):
+                return flags | self.compressor.flag, compressed
+        return flags, data
+
+
+    def decode(self, flags, data, uncompress=False):
+        """
+        Decode a value stored with the given C{flags}.  C{data} may be a
+        C{str} or a C{bytearray}.
+
+        @param uncompress: Only used for values stored without any codec
+        flags, which older versions of txyam stored compressed with zlib
+        without recording it.
+        """
+        try:
+            serializer = serializers[flags & SERIALIZER_MASK]
+            if flags & COMPRESSOR_MASK:
+                data = compressors[flags & COMPRESSOR_MASK].decompress(readable(data))
+            elif uncompress and not flags & CODEC_MASK:
+                data = zlib.decompress(readable(data))
+        except KeyError:
+            raise UnknownCodecError("No codec registered for flags %i" % flags)
+        if isinstance(data, bytearray) and not serializer.loadsBuffers:
+            data = str(data)
+        return serializer.loads(data)
+
+
+def readable(data):
+    """
+    Get a read-only view of C{data} without copying it, which is what the
+    compressors need if it's a C{bytearray}.
+    """
+    if isinstance(data, bytearray):
+        return buffer(data)
+    return data
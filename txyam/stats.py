@@ -0,0 +1,165 @@
+"""
+Counters and latency histograms for the commands sent to each server.
+
+Anything with an C{observe(node, cmd, args, d)} method can be added to a
+L{txyam.client.YamClient} with C{addObserver}.  It is called for every
+command sent to a server, with the node (factory or pool) for the server,
+the name of the command, the command's arguments and the C{Deferred} that
+will fire with its result.  L{StatsCollector} is an observer that keeps
+counts that can be exported to a metrics system.
+"""
+from bisect import bisect_left
+
+from twisted.internet import reactor
+
+
+# commands whose second argument is the value being stored
+STORAGE = frozenset(["set", "add", "replace", "append", "prepend", "checkAndSet"])
+
+
+class Histogram:
+    """
+    A latency histogram with fixed, exponentially growing buckets, so that
+    recording a latency is just a binary search and an increment.
+    """
+    def __init__(self, smallest=0.00005, largest=10.0, factor=1.5):
+        """
+        @param smallest: The upper bound, in seconds, of the first bucket.
+
+        @param largest: Latencies over this are all counted in the last
+        bucket.
+
+        @param factor: How much larger each bucket's upper bound is than the
+        last.
+        """
+        bounds = [smallest]
+        while bounds[-1] < largest:
+            bounds.append(bounds[-1] * factor)
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+
+    def record(self, latency):
+        self.counts[bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+
+
+    def percentile(self, percentile):
+        """
+        @return: The upper bound of the bucket holding the given percentile
+        (0 to 100) of recorded latencies, or C{None} if nothing has been
+        recorded.
+        """
+        if not self.count:
+            return None
+        wanted = self.count * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                break
+        return self.bounds[min(index, len(self.bounds) - 1)]
+
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+    def asDict(self):
+        return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(50),
+                'p99': self.percentile(99), 'p999': self.percentile(99.9)}
+
+
+class CommandStats:
+    """
+    Counts for one command sent to one server.
+    """
+    def __init__(self):
+        self.ops = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.latency = Histogram()
+
+
+    def asDict(self):
+        return {'ops': self.ops, 'hits': self.hits, 'misses': self.misses,
+                'errors': self.errors, 'bytesIn': self.bytesIn, 'bytesOut': self.bytesOut,
+                'latency': self.latency.asDict()}
+
+
+class StatsCollector:
+    """
+    Keeps L{CommandStats} for every command sent to every server.
+    """
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.nodes = {}
+        self.commands = {}
+
+
+    def observe(self, node, cmd, args, d):
+        stats = self.commands.get((node.hostport, cmd))
+        if stats is None:
+            stats = self.commands[(node.hostport, cmd)] = CommandStats()
+            self.nodes[node.hostport] = node
+        stats.ops += 1
+        if cmd in STORAGE and len(args) > 1 and isinstance(args[1], bytes):
+            stats.bytesOut += len(args[1])
+        started = self.clock.seconds()
+
+        def record(result):
+            stats.latency.record(self.clock.seconds() - started)
+            if hasattr(result, 'check'):
+                stats.errors += 1
+            elif cmd == "get":
+                self.countValue(stats, result)
+            elif cmd == "getMultiple":
+                for value in result.values():
+                    self.countValue(stats, value)
+            return result
+        d.addBoth(record)
+
+
+    def countValue(self, stats, result):
+        if result[-1] is None:
+            stats.misses += 1
+        else:
+            stats.hits += 1
+            stats.bytesIn += len(result[-1])
+
+
+    def queueDepth(self, hostport):
+        """
+        @return: The number of requests waiting for a response from the
+        given server, over all of its connections.
+        """
+        node = self.nodes.get(hostport)
+        if node is None:
+            return 0
+        return sum(client.queueDepth() for client in node.getConnections())
+
+
+    def snapshot(self, reset=False):
+        """
+        @param reset: If C{True}, start counting again from zero.
+
+        @return: A C{dict} mapping each server's "host:port" to a C{dict} with
+        its C{queueDepth} and, under C{commands}, a C{dict} mapping each
+        command name to its counts.
+        """
+        servers = {}
+        for (hostport, cmd), stats in self.commands.items():
+            if hostport not in servers:
+                servers[hostport] = {'queueDepth': self.queueDepth(hostport), 'commands': {}}
+            servers[hostport]['commands'][cmd] = stats.asDict()
+        if reset:
+            self.commands = {}
+        return servers
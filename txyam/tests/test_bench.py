@@ -0,0 +1,94 @@
+import random
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.test.proto_helpers import StringTransport
+
+from txyam.bench.server import FakeMemCacheServerFactory, listen
+from txyam.bench.workload import Benchmark, UniformKeys, ZipfianKeys
+from txyam.client import YamClient
+
+
+class FakeServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeMemCacheServerFactory(Clock())
+        self.proto = self.factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+
+    def send(self, data):
+        self.transport.clear()
+        self.proto.dataReceived(data)
+        return self.transport.value()
+
+
+    def test_storeAndGet(self):
+        self.assertEqual(self.send("set foo 3 0 3\r\nbar\r\nadd foo 0 0 1\r\nx\r\n"), "STORED\r\nNOT_STORED\r\n")
+        self.assertEqual(self.send("get foo baz\r\n"), "VALUE foo 3 3\r\nbar\r\nEND\r\n")
+        self.assertEqual(self.send("gets foo\r\n"), "VALUE foo 3 3 1\r\nbar\r\nEND\r\n")
+        self.assertEqual(self.send("cas foo 0 0 1 2\r\nx\r\ncas foo 0 0 1 1\r\nx\r\n"), "EXISTS\r\nSTORED\r\n")
+        self.assertEqual(self.send("delete foo noreply\r\ndelete foo\r\n"), "NOT_FOUND\r\n")
+
+
+    def test_splitValues(self):
+        """
+        Ensure that values split across reads, or sharing one with the next
+        command, are stored.
+        """
+        data = "set foo 0 0 10\r\n0123456789\r\nget foo\r\n"
+        self.transport.clear()
+        for index in xrange(0, len(data), 4):
+            self.proto.dataReceived(data[index:index + 4])
+        self.assertEqual(self.transport.value(), "STORED\r\nVALUE foo 0 10\r\n0123456789\r\nEND\r\n")
+        self.assertEqual(self.send("set foo 0 0 1\r\nxy\r\n"), "CLIENT_ERROR bad data chunk\r\n")
+
+
+    def test_counters(self):
+        self.send("set foo 0 0 1\r\n5\r\n")
+        self.assertEqual(self.send("incr foo 3\r\ndecr foo 10\r\nincr bar 1\r\n"), "8\r\n0\r\nNOT_FOUND\r\n")
+
+
+    def test_expiry(self):
+        self.send("set foo 0 10 1\r\nx\r\n")
+        self.factory.clock.advance(10)
+        self.assertEqual(self.send("get foo\r\n"), "END\r\n")
+
+
+class KeysTest(unittest.TestCase):
+
+    def test_zipfian(self):
+        keys = ZipfianKeys(1000, rand=random.Random(1))
+        counts = {}
+        for _ in xrange(10000):
+            key = keys.next()
+            counts[key] = counts.get(key, 0) + 1
+        # the most popular key gets about 1 / H(1000) of the reads
+        self.assertTrue(1000 < counts["bench:0"] < 1600)
+        self.assertTrue(counts["bench:0"] > 5 * counts.get("bench:9", 0))
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ports = [listen(), listen()]
+        self.client = YamClient([("127.0.0.1", port.getHost().port) for port in self.ports], connect=False)
+        return self.client.connect()
+
+
+    def tearDown(self):
+        self.client.disconnect()
+        return gatherResults([port.stopListening() for port in self.ports])
+
+
+    @inlineCallbacks
+    def test_run(self):
+        for operation in Benchmark.operations:
+            keys = UniformKeys(50, rand=random.Random(operation))
+            result = yield Benchmark(self.client, operation, keys, valueSize=10, concurrency=5, requests=100).run()
+            self.assertEqual((result['requests'], result['errors']), (100, 0))
+            self.assertTrue(result['p50'] <= result['p99'])
+        # the preloaded keys, plus a memoized value for each key called
+        self.assertTrue(50 < sum(len(port.factory.items) for port in self.ports) <= 100)
@@ -0,0 +1,204 @@
+import struct
+
+from twisted.trial import unittest
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.protocols.memcache import ClientError, NoSuchCommand
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport, MemoryReactorClock
+
+from txyam.binary import BinaryMemCacheClientFactory, HEADER, RESPONSE
+from txyam.client import YamClient
+import txyam.binary
+import txyam.client
+
+
+def request(opcode, key="", extras="", value="", opaque=0, cas=0):
+    return HEADER.pack(0x80, opcode, len(key), len(extras), 0, 0,
+                       len(extras) + len(key) + len(value), opaque, cas) + extras + key + value
+
+
+def response(opcode, opaque, status=0, key="", extras="", value="", cas=0):
+    return HEADER.pack(RESPONSE, opcode, len(key), len(extras), 0, status,
+                       len(extras) + len(key) + len(value), opaque, cas) + extras + key + value
+
+
+class BinaryProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = BinaryMemCacheClientFactory()
+        self.proto = self.factory.buildProtocol('ahost', timeOut=None)
+        self.factory.connectionMade = lambda: None
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+
+    def test_get(self):
+        d = self.proto.get("foo")
+        self.assertEqual(self.transport.value(), request(0x00, "foo", opaque=1))
+        self.proto.dataReceived(response(0x00, 1, extras=struct.pack("!I", 5), value="bar"))
+        self.assertEqual(self.successResultOf(d), (5, "bar"))
+
+        d = self.proto.get("foo", withIdentifier=True)
+        self.proto.dataReceived(response(0x00, 2, extras=struct.pack("!I", 5), value="bar", cas=123))
+        self.assertEqual(self.successResultOf(d), (5, "123", "bar"))
+
+        d = self.proto.get("foo")
+        self.proto.dataReceived(response(0x00, 3, status=0x01, value="Not found"))
+        self.assertEqual(self.successResultOf(d), (0, None))
+
+
+    def test_partialResponses(self):
+        """
+        Ensure that responses split across reads, or sharing one, are parsed.
+        """
+        one = self.proto.get("foo")
+        two = self.proto.get("bar")
+        data = (response(0x00, 1, extras=struct.pack("!I", 0), value="a" * 100) +
+                response(0x00, 2, extras=struct.pack("!I", 0), value="b"))
+        for index in xrange(0, len(data), 7):
+            self.proto.dataReceived(data[index:index + 7])
+        self.assertEqual(self.successResultOf(one), (0, "a" * 100))
+        self.assertEqual(self.successResultOf(two), (0, "b"))
+        self.assertEqual(self.proto.queueDepth(), 0)
+
+
+    def test_getMultiple(self):
+        """
+        Ensure that multi-gets use quiet gets ended with a C{NOOP}, so only
+        hits get responses.
+        """
+        d = self.proto.getMultiple(["foo", "bar"])
+        opaques = {}
+        data = self.transport.value()
+        while data:
+            _, opcode, keylen, extlen, _, _, bodylen, opaque, _ = HEADER.unpack_from(data)
+            opaques[data[24 + extlen:24 + extlen + keylen] or opcode] = opaque
+            data = data[24 + bodylen:]
+        self.assertEqual(sorted(opaques), [0x0a, "bar", "foo"])
+        self.proto.dataReceived(response(0x0d, opaques["foo"], key="foo", extras=struct.pack("!I", 1), value="x"))
+        self.proto.dataReceived(response(0x0a, opaques[0x0a]))
+        self.assertEqual(self.successResultOf(d), {"foo": (1, "x"), "bar": (0, None)})
+
+
+    def test_store(self):
+        d = self.proto.set("foo", "bar", 3, 10)
+        self.assertEqual(self.transport.value(), request(0x01, "foo", struct.pack("!II", 3, 10), "bar", opaque=1))
+        self.proto.dataReceived(response(0x01, 1))
+        self.assertTrue(self.successResultOf(d))
+
+        d = self.proto.add("foo", "bar")
+        self.proto.dataReceived(response(0x02, 2, status=0x02, value="Data exists for key."))
+        self.assertFalse(self.successResultOf(d))
+
+        self.transport.clear()
+        d = self.proto.checkAndSet("foo", "bar", "99")
+        self.assertEqual(self.transport.value(), request(0x01, "foo", struct.pack("!II", 0, 0), "bar", 3, 99))
+        self.proto.dataReceived(response(0x01, 3, status=0x02))
+        self.assertFalse(self.successResultOf(d))
+
+        self.failureResultOf(self.proto.set("foo", 12), ClientError)
+
+
+    def test_pipelinedStoresAreQuiet(self):
+        """
+        Ensure that storage commands sent while pipelining are quiet, and the
+        batch ends with a C{NOOP}.
+        """
+        self.proto.startPipeline()
+        one = self.proto.set("foo", "bar")
+        two = self.proto.add("baz", "bar")
+        three = self.proto.delete("foo")
+        self.assertEqual(self.transport.value(), "")
+        self.proto.flushPipeline()
+        extras = struct.pack("!II", 0, 0)
+        self.assertEqual(self.transport.value(),
+                         request(0x11, "foo", extras, "bar", opaque=1) +
+                         request(0x12, "baz", extras, "bar", opaque=2) +
+                         request(0x14, "foo", opaque=3) +
+                         request(0x0a, opaque=4))
+        self.proto.dataReceived(response(0x12, 2, status=0x02))
+        self.proto.dataReceived(response(0x0a, 4))
+        self.assertEqual([self.successResultOf(d) for d in (one, two, three)], [True, False, True])
+        self.assertEqual(self.proto.queueDepth(), 0)
+
+
+    def test_batchedStoresAreQuiet(self):
+        """
+        Ensure that automatically batched storage commands are quiet too.
+        """
+        clock = Clock()
+        self.proto.batchWindow = 0
+        self.proto.callLater = clock.callLater
+        d = self.proto.set("foo", "bar")
+        self.assertEqual(self.transport.value(), "")
+        clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         request(0x11, "foo", struct.pack("!II", 0, 0), "bar", opaque=1) + request(0x0a, opaque=2))
+        self.proto.dataReceived(response(0x0a, 2))
+        self.assertTrue(self.successResultOf(d))
+
+
+    def test_counters(self):
+        d = self.proto.increment("foo", 5)
+        self.assertEqual(self.transport.value(),
+                         request(0x05, "foo", struct.pack("!QQI", 5, 0, 0xffffffff), opaque=1))
+        self.proto.dataReceived(response(0x05, 1, value=struct.pack("!Q", 7)))
+        self.assertEqual(self.successResultOf(d), 7)
+
+        d = self.proto.decrement("foo")
+        self.proto.dataReceived(response(0x06, 2, status=0x01))
+        self.assertFalse(self.successResultOf(d))
+
+
+    def test_stats(self):
+        d = self.proto.stats()
+        self.proto.dataReceived(response(0x10, 1, key="pid", value="42") +
+                                response(0x10, 1, key="uptime", value="10") +
+                                response(0x10, 1))
+        self.assertEqual(self.successResultOf(d), {"pid": "42", "uptime": "10"})
+
+
+    def test_errors(self):
+        d = self.proto.version()
+        self.proto.dataReceived(response(0x0b, 1, status=0x81, value="Unknown command"))
+        self.failureResultOf(d, NoSuchCommand)
+
+        # errors for commands without replies are ignored
+        self.proto.setNoReply("foo", "bar")
+        self.proto.dataReceived(response(0x11, 0, status=0x82, value="Out of memory"))
+        self.assertEqual(self.proto.queueDepth(), 0)
+
+
+    def test_noReplyMisses(self):
+        """
+        Ensure that misses and existing keys for commands without replies
+        aren't logged, and other errors are.
+        """
+        messages = []
+        self.patch(txyam.binary.log, 'msg', messages.append)
+        self.proto.deleteNoReply("foo")
+        self.proto.dataReceived(response(0x14, 0, status=0x01, value="Not found"))
+        self.proto.addNoReply("foo", "bar")
+        self.proto.dataReceived(response(0x12, 0, status=0x02, value="Data exists for key."))
+        self.assertEqual(messages, [])
+        self.proto.setNoReply("foo", "bar")
+        self.proto.dataReceived(response(0x11, 0, status=0x82, value="Out of memory"))
+        self.assertEqual(len(messages), 1)
+
+
+    def test_connectionLost(self):
+        d = self.proto.get("foo")
+        self.proto.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+        self.failureResultOf(self.proto.get("foo"), RuntimeError)
+
+
+class BinaryClientTest(unittest.TestCase):
+
+    def test_connect(self):
+        self.patch(txyam.client, 'reactor', MemoryReactorClock())
+        client = YamClient(['one'], binary=True, poolSize=2)
+        factories = [connector[2] for connector in txyam.client.reactor.tcpClients]
+        self.assertEqual([factory.__class__ for factory in factories], [BinaryMemCacheClientFactory] * 2)
+        self.assertEqual(client.factories[0].factories, factories)
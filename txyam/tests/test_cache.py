@@ -0,0 +1,159 @@
+import cPickle
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import inlineCallbacks, DeferredList
+
+from txyam.tests.utils import makeTestConnections
+from txyam.client import YamClient
+from txyam.cache import LRUCache, NearCacheClient
+from txyam.counters import Counters
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def test_expires(self):
+        cache = LRUCache(clock=self.clock)
+        cache.set("foo", "bar", 10)
+        self.assertEqual(cache.get("foo"), "bar")
+        self.clock.advance(10)
+        self.assertIdentical(cache.get("foo"), None)
+        self.assertEqual(len(cache), 0)
+
+
+    def test_evictsLeastRecentlyUsed(self):
+        cache = LRUCache(maxEntries=2, clock=self.clock)
+        cache.set("one", 1, 10)
+        cache.set("two", 2, 10)
+        cache.get("one")
+        cache.set("three", 3, 10)
+        self.assertEqual(cache.get("one"), 1)
+        self.assertIdentical(cache.get("two"), None)
+        self.assertEqual(cache.get("three"), 3)
+
+
+    def test_maxBytes(self):
+        cache = LRUCache(maxBytes=10, clock=self.clock)
+        cache.set("one", 1, 10, 6)
+        cache.set("two", 2, 10, 6)
+        self.assertIdentical(cache.get("one"), None)
+        self.assertEqual(cache.bytes, 6)
+        cache.set("big", 3, 10, 11)
+        self.assertIdentical(cache.get("big"), None)
+        self.assertEqual(cache.get("two"), 2)
+
+
+class NearCacheClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        client = YamClient(['one'], connect=False)
+        self.transport = makeTestConnections(client)[0]
+        self.client = NearCacheClient(client, ttl=5, clock=self.clock)
+
+
+    @inlineCallbacks
+    def test_getPickled(self):
+        """
+        Ensure that a pickled value is only fetched and unpickled once.
+        """
+        pickled = cPickle.dumps([1, 2], cPickle.HIGHEST_PROTOCOL)
+        d = self.client.getPickled("foo")
+        self.transport.protocol.dataReceived("VALUE foo 0 %i\r\n%s\r\nEND\r\n" % (len(pickled), pickled))
+        first = yield d
+        self.assertEqual(first, (0, [1, 2]))
+
+        self.transport.clear()
+        second = yield self.client.getPickled("foo")
+        self.assertIdentical(second[1], first[1])
+        self.assertEqual(self.transport.value(), "")
+        self.assertEqual(self.client.localStats(), {'hits': 1, 'misses': 1, 'entries': 1, 'bytes': len(pickled)})
+
+        # after the ttl, go back to the server
+        self.clock.advance(5)
+        self.client.getPickled("foo")
+        self.assertEqual(self.transport.value(), "get foo\r\n")
+
+
+    @inlineCallbacks
+    def test_setWritesThrough(self):
+        d = self.client.set("foo", "bar", expireTime=2)
+        self.transport.protocol.dataReceived("STORED\r\n")
+        yield d
+        self.transport.clear()
+        result = yield self.client.get("foo")
+        self.assertEqual(result, (0, "bar"))
+        self.assertEqual(self.transport.value(), "")
+
+        # capped at the memcached expire time
+        self.clock.advance(2)
+        self.client.get("foo")
+        self.assertEqual(self.transport.value(), "get foo\r\n")
+
+
+    @inlineCallbacks
+    def test_invalidate(self):
+        d = self.client.get("foo")
+        self.transport.protocol.dataReceived("VALUE foo 0 1\r\n1\r\nEND\r\n")
+        yield d
+        d = self.client.increment("foo")
+        self.transport.protocol.dataReceived("2\r\n")
+        yield d
+        self.transport.clear()
+        self.client.get("foo")
+        self.assertEqual(self.transport.value(), "get foo\r\n")
+
+
+    @inlineCallbacks
+    def test_timeout(self):
+        """
+        Ensure that a C{timeout} is passed on to the wrapped client.
+        """
+        self.client.client.clock = self.clock
+        ds = [self.client.get("foo", timeout=1), self.client.getPickled("aaa", timeout=1),
+              self.client.set("bar", "1", timeout=1)]
+        self.assertEqual(self.transport.value(), "get foo\r\nget aaa\r\nset bar 0 0 1\r\n1\r\n")
+        self.clock.advance(1)
+        results = yield DeferredList(ds)
+        self.assertEqual(results, [(True, (0, None)), (True, (0, None)), (True, False)])
+
+
+    @inlineCallbacks
+    def test_modifyInvalidates(self):
+        d = self.client.get("foo")
+        self.transport.protocol.dataReceived("VALUE foo 0 1\r\n1\r\nEND\r\n")
+        yield d
+        d = self.client.modify("foo", lambda value: value + "!")
+        self.transport.protocol.dataReceived("VALUE foo 0 1 3\r\n1\r\nEND\r\n")
+        self.transport.protocol.dataReceived("STORED\r\n")
+        yield d
+        self.transport.clear()
+        d = self.client.get("foo")
+        self.assertEqual(self.transport.value(), "get foo\r\n")
+        self.transport.protocol.dataReceived("VALUE foo 0 2\r\n1!\r\nEND\r\n")
+        yield d
+
+        self.assertEqual(self.client.localStats()['entries'], 1)
+        self.client.modifyMultiplePickled(["foo"], lambda key, value: value)
+        self.assertEqual(self.client.localStats()['entries'], 0)
+
+
+    @inlineCallbacks
+    def test_countersInvalidate(self):
+        """
+        Ensure that batched counter changes made through the near cache
+        invalidate it.
+        """
+        d = self.client.get("foo")
+        self.transport.protocol.dataReceived("VALUE foo 0 1\r\n1\r\nEND\r\n")
+        yield d
+        d = Counters(self.client, clock=self.clock).increment("foo", immediate=True)
+        self.transport.protocol.dataReceived("2\r\n")
+        yield d
+        self.transport.clear()
+        self.client.get("foo")
+        self.assertEqual(self.transport.value(), "get foo\r\n")
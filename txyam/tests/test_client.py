@@ -1,16 +1,24 @@
 import cPickle
+import gc
 import zlib
 import uuid
 
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks, DeferredList
+from twisted.internet.defer import inlineCallbacks, DeferredList, TimeoutError
 from twisted.internet.error import ConnectionDone
+from twisted.python import log
+from twisted.python.failure import Failure
 
 from twisted.internet.address import IPv4Address
-from twisted.test.proto_helpers import MemoryReactor
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransportWithDisconnection
 
-from txyam.tests.utils import makeTestConnections
+from txyam.tests.utils import makeTestConnections, FakeThreadPool, ThreadlessReactor
 from txyam.client import YamClient, NoServerError
+from txyam.routing import KetamaRouter
+from txyam.factory import MemCacheClientPool
+from txyam.serialization import Codec
+from txyam.utils import memoize
 import txyam
 
 
@@ -72,6 +80,127 @@ class ClientTest(unittest.TestCase):
         self.assertEqual(transports[0].value(), "")
 
 
+    @inlineCallbacks
+    def test_getMultiple(self):
+        """
+        Ensure that keys are grouped per server and the results merged.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        d = client.getMultiple(["aaa", "foo", "bbb"])
+        self.assertEqual(transports[0].value(), "get aaa\r\n")
+        self.assertEqual(transports[1].value(), "get foo bbb\r\n")
+        transports[0].protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        transports[1].protocol.dataReceived("VALUE foo 1 3\r\nbaz\r\nEND\r\n")
+        result = yield d
+        self.assertEqual(result, {"aaa": (0, "bar"), "foo": (1, "baz"), "bbb": (0, None)})
+
+
+    @inlineCallbacks
+    def test_getMultiplePickled(self):
+        """
+        Ensure that multiple pickled objects can be fetched across servers.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        value = {'foo': 'bar'}
+        pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        d = client.getMultiplePickled(["aaa", "foo"])
+        transports[0].protocol.dataReceived("VALUE aaa 0 %i\r\n%s\r\nEND\r\n" % (len(pickled), pickled))
+        transports[1].protocol.dataReceived("END\r\n")
+        result = yield d
+        self.assertEqual(result, {"aaa": (0, value), "foo": (0, None)})
+
+
+    @inlineCallbacks
+    def test_setMultiple(self):
+        """
+        Ensure that commands are grouped per server and written at once.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+        writes = []
+        transports[1].write = lambda data: writes.append(data)
+
+        d = client.setMultiple({"aaa": "bar", "foo": "baz", "bbb": "egg"})
+        self.assertEqual(transports[0].value(), "set aaa 0 0 3\r\nbar\r\n")
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(sorted(writes[0].split("set ")[1:]),
+                         ["bbb 0 0 3\r\negg\r\n", "foo 0 0 3\r\nbaz\r\n"])
+        transports[0].protocol.dataReceived("STORED\r\n")
+        transports[1].protocol.dataReceived("STORED\r\nNOT_STORED\r\n")
+        result = yield d
+        self.assertTrue(result["aaa"])
+        self.assertEqual(sorted(result.values()), [False, True, True])
+
+
+    @inlineCallbacks
+    def test_setMultipleNoReply(self):
+        """
+        Ensure that noreply commands fire immediately.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        result = yield client.setMultiple({"aaa": "bar"}, expireTime=10, noreply=True)
+        self.assertEqual(result, {"aaa": None})
+        self.assertEqual(transports[0].value(), "set aaa 0 10 3 noreply\r\nbar\r\n")
+
+
+    @inlineCallbacks
+    def test_deleteMultiple(self):
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        d = client.deleteMultiple(["aaa", "foo"])
+        self.assertEqual(transports[0].value(), "delete aaa\r\n")
+        self.assertEqual(transports[1].value(), "delete foo\r\n")
+        transports[0].protocol.dataReceived("DELETED\r\n")
+        transports[1].protocol.dataReceived("NOT_FOUND\r\n")
+        result = yield d
+        self.assertEqual(result, {"aaa": True, "foo": False})
+
+
+    @inlineCallbacks
+    def test_addMultiplePickled(self):
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        value = cPickle.dumps([1, 2], cPickle.HIGHEST_PROTOCOL)
+        d = client.addMultiplePickled({"aaa": [1, 2]})
+        self.assertEqual(transports[0].value(), "add aaa 0 0 %i\r\n%s\r\n" % (len(value), value))
+        transports[0].protocol.dataReceived("STORED\r\n")
+        result = yield d
+        self.assertEqual(result, {"aaa": True})
+
+
+    @inlineCallbacks
+    def test_coalesce(self):
+        """
+        Ensure that concurrent gets for the same key share one request.
+        """
+        client = YamClient(['one', 'two'], connect=False, coalesce=True)
+        transports = makeTestConnections(client)
+
+        d1 = client.get("aaa")
+        d2 = client.getPickled("aaa")
+        d3 = client.get("aaa", withIdentifier=True)
+        self.assertEqual(transports[0].value(), "get aaa\r\ngets aaa\r\n")
+        pickled = cPickle.dumps([1], cPickle.HIGHEST_PROTOCOL)
+        transports[0].protocol.dataReceived("VALUE aaa 0 %i\r\n%s\r\nEND\r\n" % (len(pickled), pickled))
+        transports[0].protocol.dataReceived("END\r\n")
+        self.assertEqual((yield d1), (0, pickled))
+        self.assertEqual((yield d2), (0, [1]))
+        self.assertEqual((yield d3), (0, "", None))
+
+        # once done, the next get goes to the server again
+        transports[0].clear()
+        client.get("aaa")
+        self.assertEqual(transports[0].value(), "get aaa\r\n")
+
+
     def test_getClient(self):
         """
         Ensure that we can split by key correctly.
@@ -81,15 +210,50 @@ class ClientTest(unittest.TestCase):
         self.assertEqual(yclient.getClient('aaa'), yclient.factories[0].client)
         self.assertEqual(yclient.getClient('foo'), yclient.factories[1].client)
 
-        # now lose first connection
-        yclient.factories[0].stopTrying()
-        # next line is handled by clientConnectionLost which is called when an actual
+        # now lose first connection; clientConnectionLost is called when an actual
         # internet.tcp.Connector has a failed connection
-        yclient.factories[0].client = None
+        yclient.factories[0].stopTrying()
+        yclient.factories[0].clientConnectionLost(None, Failure(ConnectionDone()))
         self.assertEqual(yclient.getClient('aaa'), yclient.factories[1].client)
         self.assertEqual(yclient.getClient('foo'), yclient.factories[1].client)
 
 
+    def test_ringOnlyRebuiltOnMembershipChange(self):
+        """
+        Ensure that the ring is reused between calls and only rebuilt when a
+        connection is made or lost.
+        """
+        yclient = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(yclient)
+        router = yclient.router
+        yclient.getClient('aaa')
+        yclient.getClient('foo')
+        self.assertIdentical(yclient.router, router)
+
+        transports[0].loseConnection()
+        yclient.factories[0].stopTrying()
+        yclient.factories[0].clientConnectionLost(None, Failure(ConnectionDone()))
+        self.assertNotIdentical(yclient.router, router)
+        self.assertEqual(yclient.getClient('aaa'), yclient.factories[1].client)
+
+        # reconnecting puts the server back into rotation
+        proto = yclient.factories[0].buildProtocol('one', timeOut=None)
+        proto.makeConnection(StringTransportWithDisconnection())
+        self.assertEqual(yclient.getClient('aaa'), proto)
+
+
+    def test_router(self):
+        """
+        Ensure that an alternate router can be used.
+        """
+        yclient = YamClient(['one', 'two'], connect=False, router=KetamaRouter, weights={'one': 2})
+        makeTestConnections(yclient)
+        self.assertIsInstance(yclient.router, KetamaRouter)
+        self.assertEqual(yclient.router.getWeight(yclient.factories[0]), 2)
+        factory = yclient.router.getNode('aaa')
+        self.assertEqual(yclient.getClient('aaa'), factory.client)
+
+
     def test_getClientIsDistributed(self):
         yclient = YamClient(map(str, range(10)), connect=False)
         makeTestConnections(yclient)
@@ -235,9 +399,10 @@ class ClientTest(unittest.TestCase):
         client = YamClient(['one', 'two'], connect=False)
         transports = makeTestConnections(client)
 
-        # Set a value that should hit first client and not second, and is gzipped
+        # Set a value that should hit first client and not second, and is gzipped,
+        # which is recorded in the flags
         value = zlib.compress(cPickle.dumps({'foo': 'bar'}, cPickle.HIGHEST_PROTOCOL))
-        send = "set aaa 0 0 %i\r\n%s\r\n" % (len(value), value)
+        send = "set aaa 16 0 %i\r\n%s\r\n" % (len(value), value)
         recv = ["STORED\r\n"]
         d = client.setPickled("aaa", {'foo': 'bar'}, compress=True)
         yield self._test(d, transports[:1], send, recv, True)
@@ -279,8 +444,408 @@ class ClientTest(unittest.TestCase):
         self.assertEqual(transports[1].value(), "")
 
 
+    @inlineCallbacks
+    def test_getPickledUsesFlags(self):
+        """
+        Ensure that values are decoded according to the flags they were
+        stored with.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        value = zlib.compress('{"foo": [1, 2]}')
+        send = "get aaa\r\n"
+        recv = ["VALUE aaa 17 %i\r\n%s\r\nEND\r\n" % (len(value), value)]
+        yield self._test(client.getPickled("aaa"), transports[:1], send, recv, (17, {'foo': [1, 2]}))
+
+
+    @inlineCallbacks
+    def test_setPickledWithSerializer(self):
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        send = "set aaa 257 10 6\r\n[1, 2]\r\n"
+        recv = ["STORED\r\n"]
+        d = client.setPickled("aaa", [1, 2], serializer='json', flags=256, expireTime=10)
+        yield self._test(d, transports[:1], send, recv, True)
+
+
+    def test_setPickledRejectsCodecFlags(self):
+        """
+        Ensure that flags that would be mistaken for a codec or for a chunked
+        value aren't accepted.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        for flags in (32, 128, 257):
+            self.assertRaises(ValueError, client.setPickled, "aaa", [1, 2], flags=flags)
+            self.assertRaises(ValueError, client.setMultiplePickled, {"aaa": [1, 2]}, flags=flags)
+        self.assertEqual([transport.value() for transport in transports], ["", ""])
+
+
+    @inlineCallbacks
+    def test_pickledRoundTripWithFlags(self):
+        """
+        Ensure that values stored with flags of their own are decoded, and
+        that the flags are returned with them.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        transports = makeTestConnections(client)
+
+        d = client.setPickled("aaa", {'foo': [1, 2]}, serializer='json', compress=True, flags=0x300)
+        header, value = transports[0].value()[:-2].split("\r\n", 1)
+        self.assertEqual(header, "set aaa %i 0 %i" % (0x311, len(value)))
+        transports[0].protocol.dataReceived("STORED\r\n")
+        yield d
+
+        transports[0].clear()
+        send = "get aaa\r\n"
+        recv = ["VALUE aaa %i %i\r\n%s\r\nEND\r\n" % (0x311, len(value), value)]
+        yield self._test(client.getPickled("aaa"), transports[:1], send, recv, (0x311, {'foo': [1, 2]}))
+
+
+    def test_setMultiplePickledCompressesLargeValues(self):
+        client = YamClient(['one', 'two'], connect=False, codec=Codec(compressThreshold=100))
+        transports = makeTestConnections(client)
+
+        client.setMultiplePickled({"aaa": 'a', "foo": 'a' * 200})
+        small = cPickle.dumps('a', cPickle.HIGHEST_PROTOCOL)
+        self.assertEqual(transports[0].value(), "set aaa 0 0 %i\r\n%s\r\n" % (len(small), small))
+        header, large = transports[1].value()[:-2].split("\r\n")
+        self.assertEqual(header, "set foo 16 0 %i" % len(large))
+        self.assertEqual(cPickle.loads(zlib.decompress(large)), 'a' * 200)
+
+
+    @inlineCallbacks
+    def test_offloadLargeValues(self):
+        """
+        Ensure that large values are compressed and decoded in the thread
+        pool, and small ones aren't.
+        """
+        self.patch(txyam.client, 'reactor', ThreadlessReactor())
+        pool = FakeThreadPool()
+        client = YamClient(['one', 'two'], connect=False, codec=Codec(compressThreshold=100),
+                           threadPool=pool, offloadThreshold=100)
+        transports = makeTestConnections(client)
+
+        d = client.setPickled("aaa", "a" * 200)
+        self.assertEqual(pool.calls, [client.codec.compress])
+        transports[0].protocol.dataReceived("STORED\r\n")
+        yield d
+        header, value = transports[0].value()[:-2].split("\r\n", 1)
+        self.assertEqual(header, "set aaa 16 0 %i" % len(value))
+
+        d = client.setPickled("aaa", "a" * 10)
+        transports[0].protocol.dataReceived("STORED\r\n")
+        yield d
+        self.assertEqual(len(pool.calls), 1)
+
+        d = client.setPickled("aaa", "a" * 10, offload=True)
+        self.assertEqual(pool.calls[1:], [client.codec.encode])
+        transports[0].protocol.dataReceived("STORED\r\n")
+        yield d
+
+        pool.calls = []
+        d = client.getPickled("aaa")
+        transports[0].protocol.dataReceived("VALUE aaa 16 %i\r\n%s\r\nEND\r\n" % (len(value), value))
+        result = yield d
+        self.assertEqual(result, (16, "a" * 200))
+        self.assertEqual(pool.calls, [])
+
+        value = cPickle.dumps("a" * 200, cPickle.HIGHEST_PROTOCOL)
+        d = client.getPickled("aaa")
+        transports[0].protocol.dataReceived("VALUE aaa 0 %i\r\n%s\r\nEND\r\n" % (len(value), value))
+        result = yield d
+        self.assertEqual(result, (0, "a" * 200))
+        self.assertEqual(pool.calls, [client.codec.decode])
+
+
+    @inlineCallbacks
+    def test_chunking(self):
+        """
+        Ensure that large values are split into chunks spread across servers
+        and put back together when read.
+        """
+        client = YamClient(['one', 'two'], connect=False, chunkSize=10)
+        transports = makeTestConnections(client)
+        self.patch(txyam.client.os, 'urandom', lambda size: "\x00" * size)
+        value = "abcdefghij" * 5
+        pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        count = (len(pickled) + 9) / 10
+        chunkKeys = ["txyam:chunk:0000000000000000:%i" % index for index in range(count)]
+
+        d = client.setPickled("aaa", value, expireTime=10)
+        for key in chunkKeys:
+            self.assertIn("set %s 0 10 " % key, client.getClient(key).transport.value())
+        # the value being replaced is read first
+        self.assertTrue(transports[0].value().startswith("get aaa\r\n"))
+        transports[0].protocol.dataReceived("END\r\n")
+        for transport in transports:
+            transport.protocol.dataReceived("STORED\r\n" * transport.value().count("set "))
+            transport.clear()
+        manifest = "0000000000000000:%i:%i" % (count, len(pickled))
+        self.assertEqual(transports[0].value(), "set aaa 128 10 %i\r\n%s\r\n" % (len(manifest), manifest))
+        transports[0].protocol.dataReceived("STORED\r\n")
+        self.assertTrue((yield d))
+        transports[0].clear()
+
+        d = client.getPickled("aaa")
+        self.assertEqual(transports[0].value(), "get aaa\r\n")
+        transports[0].clear()
+        transports[0].protocol.dataReceived("VALUE aaa 128 %i\r\n%s\r\nEND\r\n" % (len(manifest), manifest))
+        for transport in transports:
+            if not transport.value():
+                continue
+            keys = transport.value().strip().split(" ")[1:]
+            response = ""
+            for key in keys:
+                index = int(key.split(":")[-1])
+                chunk = pickled[index * 10:(index + 1) * 10]
+                response += "VALUE %s 0 %i\r\n%s\r\n" % (key, len(chunk), chunk)
+            transport.protocol.dataReceived(response + "END\r\n")
+        result = yield d
+        self.assertEqual(result, (128, value))
+
+
+    def test_replacedChunksDeleted(self):
+        """
+        Ensure that the chunks of a value are deleted when it is replaced,
+        and that chunk writes are bounded by the caller's timeout.
+        """
+        client = YamClient(['one'], connect=False, chunkSize=10)
+        client.clock = Clock()
+        transport = makeTestConnections(client)[0]
+        self.patch(txyam.client.os, 'urandom', lambda size: "\x01" * size)
+
+        d = client.setPickled("aaa", "a" * 20, compress=False, serializer='raw', timeout=1)
+        manifest = "0000000000000000:3:25"
+        transport.protocol.dataReceived("VALUE aaa 128 %i\r\n%s\r\nEND\r\n" % (len(manifest), manifest))
+        transport.clear()
+        client.clock.advance(1)
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(transport.value(), "")
+
+        transport.protocol.dataReceived("STORED\r\nSTORED\r\n")
+        d = client.setPickled("aaa", "short", serializer='raw')
+        self.assertEqual(transport.value(), "get aaa\r\nset aaa 2 0 5\r\nshort\r\n")
+        transport.clear()
+        transport.protocol.dataReceived("VALUE aaa 128 %i\r\n%s\r\nEND\r\nSTORED\r\n" % (len(manifest), manifest))
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(sorted(transport.value().split("\r\n")),
+                         ["", "delete txyam:chunk:0000000000000000:0 noreply",
+                          "delete txyam:chunk:0000000000000000:1 noreply",
+                          "delete txyam:chunk:0000000000000000:2 noreply"])
+
+
+    @inlineCallbacks
+    def test_chunkMissing(self):
+        client = YamClient(['one'], connect=False, chunkSize=10)
+        transports = makeTestConnections(client)
+
+        manifest = "0000000000000000:2:15"
+        d = client.getPickled("aaa")
+        transports[0].protocol.dataReceived("VALUE aaa 128 %i\r\n%s\r\nEND\r\n" % (len(manifest), manifest))
+        transports[0].protocol.dataReceived("VALUE txyam:chunk:0000000000000000:0 0 10\r\n0123456789\r\nEND\r\n")
+        result = yield d
+        self.assertEqual(result, (128, None))
+
+
+    @inlineCallbacks
+    def test_replicatedWrites(self):
+        """
+        Ensure that writes go to the primary and the replicas, and the result
+        is the primary's.
+        """
+        client = YamClient(['one', 'two'], connect=False, replicas=2)
+        transports = makeTestConnections(client)
+
+        d = client.set("aaa", "bar")
+        for transport in transports:
+            self.assertEqual(transport.value(), "set aaa 0 0 3\r\nbar\r\n")
+        transports[1].protocol.dataReceived("NOT_STORED\r\n")
+        transports[0].protocol.dataReceived("STORED\r\n")
+        self.assertTrue((yield d))
+
+        for transport in transports:
+            transport.clear()
+        d = client.deleteMultiple(["aaa", "foo"])
+        for transport in transports:
+            self.assertEqual(sorted(transport.value().split("\r\n")), ["", "delete aaa", "delete foo"])
+            transport.protocol.dataReceived("DELETED\r\nDELETED\r\n")
+        self.assertEqual((yield d), {"aaa": True, "foo": True})
+
+
+    @inlineCallbacks
+    def test_replicaFailover(self):
+        """
+        Ensure that reads try the replica when the primary misses.
+        """
+        client = YamClient(['one', 'two'], connect=False, replicas=2)
+        transports = makeTestConnections(client)
+
+        d = client.get("aaa")
+        self.assertEqual(transports[0].value(), "get aaa\r\n")
+        self.assertEqual(transports[1].value(), "")
+        transports[0].protocol.dataReceived("END\r\n")
+        self.assertEqual(transports[1].value(), "get aaa\r\n")
+        transports[1].protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual((yield d), (0, "bar"))
+
+        for transport in transports:
+            transport.clear()
+        d = client.getMultiple(["aaa", "foo"])
+        transports[0].protocol.dataReceived("END\r\n")
+        transports[1].protocol.dataReceived("VALUE foo 0 3\r\nbaz\r\nEND\r\n")
+        self.assertEqual(transports[1].value(), "get foo\r\nget aaa\r\n")
+        transports[1].protocol.dataReceived("END\r\n")
+        self.assertEqual((yield d), {"aaa": (0, None), "foo": (0, "baz")})
+
+
+    @inlineCallbacks
+    def test_hedgedRead(self):
+        """
+        Ensure that a replica is asked when the primary is slow, and the
+        first answer wins.
+        """
+        client = YamClient(['one', 'two'], connect=False, replicas=2, hedgeDelay=0.01)
+        client.clock = Clock()
+        transports = makeTestConnections(client)
+
+        d = client.get("aaa")
+        self.assertEqual(transports[1].value(), "")
+        client.clock.advance(0.01)
+        self.assertEqual(transports[1].value(), "get aaa\r\n")
+        transports[1].protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual((yield d), (0, "bar"))
+        transports[0].protocol.dataReceived("END\r\n")
+
+
+    @inlineCallbacks
+    def test_replicatedCheckAndSet(self):
+        client = YamClient(['one', 'two'], connect=False, replicas=2)
+        transports = makeTestConnections(client)
+
+        d = client.checkAndSet("aaa", "bar", "123")
+        self.assertEqual(transports[0].value(), "cas aaa 0 0 3 123\r\nbar\r\n")
+        self.assertEqual(transports[1].value(), "")
+        transports[0].protocol.dataReceived("STORED\r\n")
+        self.assertEqual(transports[1].value(), "set aaa 0 0 3\r\nbar\r\n")
+        self.assertTrue((yield d))
+
+
+    @inlineCallbacks
+    def test_timeoutIsMiss(self):
+        """
+        Ensure that commands that take longer than their timeout return a
+        miss, and that a late answer doesn't break the connection.
+        """
+        client = YamClient(['one'], connect=False)
+        client.clock = Clock()
+        transport = makeTestConnections(client)[0]
+
+        d = client.get("aaa", timeout=1)
+        client.clock.advance(1)
+        self.assertEqual((yield d), (0, None))
+        transport.protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+
+        d = client.set("aaa", "bar", timeout=1)
+        client.clock.advance(1)
+        self.assertFalse((yield d))
+        transport.protocol.dataReceived("STORED\r\n")
+
+        transport.clear()
+        d = client.get("aaa", timeout=1)
+        transport.protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual((yield d), (0, "bar"))
+        self.assertEqual(client.clock.getDelayedCalls(), [])
+
+
+    @inlineCallbacks
+    def test_broadcastTimeouts(self):
+        """
+        Ensure that commands sent to every server are bounded per server, so
+        that one slow server doesn't hold up the others.
+        """
+        addrs = [IPv4Address('TCP', 'one', 123), IPv4Address('TCP', 'two', 456)]
+        client = YamClient(addrs, connect=False, timeout=1)
+        client.clock = Clock()
+        transports = makeTestConnections(client)
+
+        d = client.version()
+        transports[0].protocol.dataReceived("VERSION 1.2\r\n")
+        client.clock.advance(1)
+        self.assertEqual((yield d), {'one:123': "1.2", 'two:456': None})
+        transports[1].protocol.dataReceived("VERSION 3.4\r\n")
+
+        d = client.stats(timeout=2)
+        transports[1].protocol.dataReceived("STAT foo bar\r\nEND\r\n")
+        client.clock.advance(2)
+        self.assertEqual((yield d), {'one:123': None, 'two:456': {"foo": "bar"}})
+        transports[0].protocol.dataReceived("STAT foo bar\r\nEND\r\n")
+
+        d = client.flushAll()
+        transports[0].protocol.dataReceived("OK\r\n")
+        client.clock.advance(1)
+        self.assertEqual((yield d), [(True, True), (True, False)])
+        self.assertEqual(client.clock.getDelayedCalls(), [])
+
+
+    @inlineCallbacks
+    def test_raiseOnTimeout(self):
+        client = YamClient(['one'], connect=False, timeout=1, raiseOnTimeout=True)
+        client.clock = Clock()
+        makeTestConnections(client)
+
+        d = client.increment("aaa")
+        client.clock.advance(1)
+        yield self.assertFailure(d, TimeoutError)
+
+
+    @inlineCallbacks
+    def test_getMultipleTimeout(self):
+        """
+        Ensure that only the keys on a slow server are misses when
+        C{getMultiple} times out.
+        """
+        client = YamClient(['one', 'two'], connect=False)
+        client.clock = Clock()
+        transports = makeTestConnections(client)
+        fast = client.getClient("aaa").transport
+        slow = [transport for transport in transports if transport is not fast][0]
+        slowKey = [key for key in "abcdefgh" if client.getClient(key).transport is slow][0]
+
+        d = client.getMultiple(["aaa", slowKey], timeout=1)
+        fast.protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        client.clock.advance(1)
+        self.assertEqual((yield d), {"aaa": (0, "bar"), slowKey: (0, None)})
+
+
+    @inlineCallbacks
+    def test_hedgePercentile(self):
+        """
+        Ensure that the hedge delay follows recent read latencies.
+        """
+        client = YamClient(['one', 'two'], connect=False, replicas=2, hedgeDelay=5, hedgePercentile=50)
+        client.clock = Clock()
+        client.latencies.minimum = 2
+        transports = makeTestConnections(client)
+        for _ in range(2):
+            d = client.get("aaa")
+            client.clock.advance(0.5)
+            transports[0].protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+            yield d
+        self.assertEqual(client.latencies.percentile(50), 0.5)
+
+        d = client.get("aaa")
+        client.clock.advance(0.5)
+        self.assertEqual(transports[1].value(), "get aaa\r\n")
+        transports[1].protocol.dataReceived("VALUE aaa 0 3\r\nbaz\r\nEND\r\n")
+        self.assertEqual((yield d), (0, "baz"))
+
+
     def test_connect(self):
-        txyam.client.reactor = MemoryReactor()
+        self.patch(txyam.client, 'reactor', MemoryReactorClock())
         YamClient(['one', ('two', 123)])
         connection = txyam.client.reactor.connectors[0].getDestination()
         self.assertEqual(connection, IPv4Address('TCP', 'one', 11211))
@@ -288,6 +853,15 @@ class ClientTest(unittest.TestCase):
         self.assertEqual(connection, IPv4Address('TCP', 'two', 123))
 
 
+    def test_connectWithPool(self):
+        reactor = MemoryReactorClock()
+        self.patch(txyam.client, 'reactor', reactor)
+        client = YamClient(['one', 'two'], poolSize=3)
+        self.assertEqual(len(reactor.connectors), 6)
+        self.assertIsInstance(client.factories[0], MemCacheClientPool)
+        self.assertEqual(client.poolStats()['one:11211']['size'], 3)
+
+
     def test_disconnect(self):
         client = YamClient(['one', 'two'], connect=False)
         transports = makeTestConnections(client)
@@ -297,3 +871,480 @@ class ClientTest(unittest.TestCase):
         for transport in transports:
             self.assertFalse(transport.connected)
             self.assertTrue(transport.protocol._disconnected)
+
+
+class GetOrComputeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = YamClient(['one'], connect=False)
+        self.client.clock = Clock()
+        self.client.clock.advance(1000)
+        self.transport = makeTestConnections(self.client)[0]
+        self.calls = []
+
+
+    def compute(self):
+        self.calls.append(None)
+        return "new"
+
+
+    def respond(self, value=None, staleAt=None, delta=0):
+        self.transport.clear()
+        if value is None:
+            self.transport.protocol.dataReceived("END\r\n")
+        else:
+            flags, data = self.client.codec.encode((value, staleAt, delta))
+            self.transport.protocol.dataReceived("VALUE foo %i %i\r\n%s\r\nEND\r\n" % (flags, len(data), data))
+
+
+    def test_miss(self):
+        d = self.client.getOrCompute("foo", self.compute, expireTime=10, staleTime=5)
+        self.respond()
+        command, data = self.transport.value().split("\r\n")[:2]
+        self.assertEqual(command.split()[3], "15")
+        self.assertEqual(self.client.codec.decode(int(command.split()[2]), data), ("new", 1010, 0))
+        self.transport.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.successResultOf(d), "new")
+
+
+    def test_fresh(self):
+        d = self.client.getOrCompute("foo", self.compute, expireTime=10)
+        self.respond("old", 1001)
+        self.assertEqual(self.successResultOf(d), "old")
+        self.assertEqual(self.transport.value(), "")
+
+
+    def test_staleWhileRevalidate(self):
+        """
+        Ensure that stale values are returned, while the caller that gets
+        the lock refreshes them.
+        """
+        d = self.client.getOrCompute("foo", self.compute, expireTime=10, staleTime=5)
+        self.respond("old", 1000)
+        self.assertEqual(self.successResultOf(d), "old")
+        self.assertEqual(self.transport.value(), "add txyam:lock:foo 0 30 1\r\n1\r\n")
+        self.transport.clear()
+        self.transport.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.calls, [None])
+        self.assertTrue(self.transport.value().startswith("set foo "))
+        self.transport.clear()
+        self.transport.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.transport.value(), "delete txyam:lock:foo\r\n")
+        self.transport.protocol.dataReceived("DELETED\r\n")
+
+        # someone else is refreshing
+        d = self.client.getOrCompute("foo", self.compute, expireTime=10, staleTime=5)
+        self.respond("old", 1000)
+        self.transport.protocol.dataReceived("NOT_STORED\r\n")
+        self.assertEqual(self.successResultOf(d), "old")
+        self.assertEqual(self.calls, [None])
+
+
+    def test_earlyRecompute(self):
+        self.patch(txyam.client.random, 'random', lambda: 0.9)
+        # reads look -log(0.1) * delta * beta, about 2.3 * delta, seconds ahead
+        d = self.client.getOrCompute("foo", self.compute, expireTime=10, beta=1)
+        self.respond("old", 1005, delta=3)
+        self.assertEqual(self.successResultOf(d), "old")
+        self.assertTrue(self.transport.value().startswith("add txyam:lock:foo"))
+        self.transport.protocol.dataReceived("NOT_STORED\r\n")
+
+        d = self.client.getOrCompute("foo", self.compute, expireTime=10, beta=1)
+        self.respond("old", 1005, delta=1)
+        self.assertEqual(self.successResultOf(d), "old")
+        self.assertEqual(self.transport.value(), "")
+
+
+    def test_memoize(self):
+        @memoize(self.client, expireTime=10, staleTime=5)
+        def func(arg):
+            self.calls.append(arg)
+            return arg * 2
+
+        d = func.many([(1,)])
+        self.transport.protocol.dataReceived("END\r\n")
+        self.transport.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.successResultOf(d), [2])
+        self.transport.clear()
+
+        key = func.memoizer.makeKey((1,), {})
+        flags, data = self.client.codec.encode((2, 1000, 0))
+        d = func(1)
+        self.transport.protocol.dataReceived("VALUE %s %i %i\r\n%s\r\nEND\r\n" % (key, flags, len(data), data))
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(self.transport.value().split("\r\n")[1], "add txyam:lock:%s 0 30 1" % key)
+        self.transport.protocol.dataReceived("NOT_STORED\r\n")
+        self.assertEqual(self.calls, [1])
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hosts = ['one', 'two']
+        self.client = YamClient(self.hosts, connect=False)
+        self.client.clock = Clock()
+        self.transports = makeTestConnections(self.client)
+
+
+    def test_removeHost(self):
+        """
+        Ensure that while a removed server's keys are migrating, misses are
+        read from it and copied to their new server, and writes delete them
+        from it.
+        """
+        one, two = self.transports
+        self.client.startMigration(copyForward=True, copyExpireTime=60, duration=10)
+        self.client.removeHost('one', migrate=True)
+        self.assertEqual(self.client.hosts, ['two'])
+        self.assertEqual(self.hosts, ['one', 'two'])
+
+        d = self.client.get("aaa")
+        self.assertEqual(two.value(), "get aaa\r\n")
+        two.protocol.dataReceived("END\r\n")
+        self.assertEqual(one.value(), "get aaa\r\n")
+        one.protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual(self.successResultOf(d), (0, "bar"))
+        self.assertEqual(two.value(), "get aaa\r\nadd aaa 0 60 3\r\nbar\r\n")
+        two.protocol.dataReceived("STORED\r\n")
+
+        one.clear()
+        two.clear()
+        d = self.client.getMultiple(["aaa", "aab"])
+        two.protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual(one.value(), "get aab\r\n")
+        one.protocol.dataReceived("END\r\n")
+        self.assertEqual(self.successResultOf(d), {"aaa": (0, "bar"), "aab": (0, None)})
+
+        one.clear()
+        self.client.set("aaa", "baz")
+        self.assertEqual(one.value(), "delete aaa noreply\r\n")
+        two.protocol.dataReceived("STORED\r\n")
+
+        self.client.clock.advance(10)
+        self.assertIdentical(self.client.previousRouter, None)
+        self.assertFalse(one.connected)
+        self.client.get("aaa")
+        self.assertEqual(one.value(), "delete aaa noreply\r\n")
+
+
+    def test_writesDeletePrevious(self):
+        """
+        Ensure that multi-key writes and C{checkAndSet} delete the keys from
+        their old server, so that later misses don't read old values.
+        """
+        one, two = self.transports
+        self.client.removeHost('one', migrate=True)
+        writes = [self.client.deleteMultiple(["aaa"]), self.client.setMultiple({"aab": "1"}),
+                  self.client.checkAndSet("aaa", "2", "5")]
+        self.assertEqual(one.value(), "delete aaa noreply\r\ndelete aab noreply\r\ndelete aaa noreply\r\n")
+        two.protocol.dataReceived("DELETED\r\nSTORED\r\nSTORED\r\n")
+        self.assertEqual([self.successResultOf(d) for d in writes], [{"aaa": True}, {"aab": True}, True])
+
+
+    def test_incrementDuringMigration(self):
+        """
+        Ensure that a counter still on its old server is copied to its new
+        one before it is changed.
+        """
+        one, two = self.transports
+        self.client.removeHost('one', migrate=True)
+        d = self.client.increment("aaa", 2)
+        self.assertEqual(one.value(), "")
+        two.protocol.dataReceived("NOT_FOUND\r\n")
+        self.assertEqual(one.value(), "get aaa\r\n")
+        one.protocol.dataReceived("VALUE aaa 0 1\r\n5\r\nEND\r\n")
+        two.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(two.value(), "incr aaa 2\r\nadd aaa 0 0 1\r\n5\r\nincr aaa 2\r\n")
+        two.protocol.dataReceived("7\r\n")
+        self.assertEqual(self.successResultOf(d), 7)
+        self.assertEqual(one.value(), "get aaa\r\ndelete aaa noreply\r\n")
+
+        one.clear()
+        two.clear()
+        d = self.client.incrementMultiple({"aaa": 1, "aab": 1})
+        two.protocol.dataReceived("8\r\nNOT_FOUND\r\n")
+        self.assertEqual(one.value(), "delete aaa noreply\r\nget aab\r\n")
+        one.protocol.dataReceived("END\r\n")
+        self.assertEqual(self.successResultOf(d), {"aaa": 8, "aab": False})
+
+
+    def test_addHost(self):
+        reactor = MemoryReactorClock()
+        self.patch(txyam.client, 'reactor', reactor)
+        d = self.client.addHost('three', weight=2, migrate=True)
+        factory = reactor.tcpClients[0][2]
+        self.assertEqual((factory.hostport, self.client.weights), ('three:11211', {'three:11211': 2}))
+        three = StringTransportWithDisconnection()
+        three.protocol = factory.buildProtocol('three', timeOut=None)
+        three.protocol.makeConnection(three)
+        self.successResultOf(d)
+
+        key = [key for key in ("key%i" % index for index in xrange(100))
+               if self.client.router.getNode(key) is factory][0]
+        owner = self.transports[self.client.factories.index(self.client.previousRouter.getNode(key))]
+        owner.clear()
+        d = self.client.get(key)
+        self.assertEqual(three.value(), "get %s\r\n" % key)
+        three.protocol.dataReceived("END\r\n")
+        self.assertEqual(owner.value(), "get %s\r\n" % key)
+        owner.protocol.dataReceived("END\r\n")
+        self.assertEqual(self.successResultOf(d), (0, None))
+
+        self.client.finishMigration()
+        owner.clear()
+        self.client.get(key)
+        three.protocol.dataReceived("END\r\n")
+        self.assertEqual(owner.value(), "")
+
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.patch(txyam.client, 'reactor', self.reactor)
+
+
+    def connectFactory(self, factory):
+        transport = StringTransportWithDisconnection()
+        transport.protocol = factory.buildProtocol(factory.hostport, timeOut=None)
+        transport.protocol.makeConnection(transport)
+        return transport
+
+
+    def test_quorum(self):
+        """
+        Ensure that at most C{connectConcurrency} hosts are connected to at
+        once, and that C{connect} fires once C{quorum} of them connect.
+        """
+        client = YamClient(['one', 'two', 'three'], connect=False, quorum=2, connectConcurrency=2)
+        d = client.connect()
+        one, two, three = client.factories
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        self.assertEqual(client.readiness(), {'one:11211': 'connecting', 'two:11211': 'connecting',
+                                              'three:11211': 'waiting'})
+        self.connectFactory(one)
+        self.assertEqual(len(self.reactor.tcpClients), 3)
+        two.stopTrying()
+        two.clientConnectionFailed(self.reactor.connectors[1], Failure(ConnectionDone()))
+        self.assertNoResult(d)
+        self.assertEqual(client.readiness()['two:11211'], 'disconnected')
+        self.connectFactory(three)
+        self.assertIdentical(self.successResultOf(d), client)
+
+
+    def test_retriedUntilTimeout(self):
+        """
+        Ensure that hosts whose first connection fails are waited for until
+        C{connectTimeout}, as they are retried.
+        """
+        client = YamClient(['one', 'two'], connect=False, connectTimeout=5)
+        d = client.connect()
+        one, two = client.factories
+        two.clock = self.reactor
+        self.connectFactory(one)
+        two.clientConnectionFailed(self.reactor.connectors[1], Failure(ConnectionDone()))
+        self.assertNoResult(d)
+        self.assertEqual(client.readiness()['two:11211'], 'connecting')
+        self.connectFactory(two)
+        self.assertIdentical(self.successResultOf(d), client)
+
+
+    def test_quorumErrorLogged(self):
+        """
+        Ensure that when the client connects on its own, a quorum that can't
+        be met is logged rather than left unhandled.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        YamClient(['one'], connectTimeout=5)
+        self.reactor.advance(5)
+        gc.collect()
+        self.assertEqual(len(self.flushLoggedErrors(txyam.client.QuorumError)), 1)
+        errors = [event for event in events if event.get('isError')]
+        self.assertEqual([event.get('why') for event in errors], ["Failed to connect to enough hosts"])
+
+
+    def test_timeout(self):
+        client = YamClient(['one', 'two'], connect=False, quorum=0.5, poolSize=2, connectTimeout=5)
+        d = client.connect()
+        self.assertEqual(len(self.reactor.tcpClients), 4)
+        self.reactor.advance(4)
+        self.assertNoResult(d)
+        self.reactor.advance(1)
+        self.assertEqual(client.readiness(), {'one:11211': 'disconnected', 'two:11211': 'disconnected'})
+        self.failureResultOf(d, txyam.client.QuorumError)
+        self.connectFactory(client.factories[1].factories[0])
+        self.assertEqual(client.readiness()['two:11211'], 'connected')
+
+
+    def test_quorumImpossible(self):
+        """
+        Ensure that C{connect} fails once too many hosts have failed or
+        timed out for the quorum to be met, and that they are still
+        connected to later.
+        """
+        client = YamClient(['one', 'two', 'three'], connect=False, quorum=2, connectTimeout=5)
+        d = client.connect()
+        one, two, three = client.factories
+        self.connectFactory(one)
+        two.stopTrying()
+        two.clientConnectionFailed(self.reactor.connectors[1], Failure(ConnectionDone()))
+        self.assertNoResult(d)
+        self.reactor.advance(5)
+        self.failureResultOf(d, txyam.client.QuorumError)
+        self.connectFactory(three)
+        self.assertEqual(client.readiness()['three:11211'], 'connected')
+
+
+    def test_queuedMultiple(self):
+        """
+        Ensure that multi-key commands can be sent to hosts that haven't
+        connected yet.
+        """
+        client = YamClient(['one'], connect=False, lazy=True)
+        client.connect()
+        gets = client.getMultiple(["aaa", "aab"])
+        sets = client.setMultiple({"aaa": "1"})
+        adds = client.addMultiple({"aab": "2"})
+        increments = client.incrementMultiple({"aaa": 1})
+        deletes = client.deleteMultiple(["aab"])
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        transport = self.connectFactory(client.factories[0])
+        self.assertEqual(transport.value(), "get aaa aab\r\nset aaa 0 0 1\r\n1\r\nadd aab 0 0 1\r\n2\r\n"
+                                            "incr aaa 1\r\ndelete aab\r\n")
+        transport.protocol.dataReceived("END\r\nSTORED\r\nSTORED\r\n2\r\nDELETED\r\n")
+        self.assertEqual(self.successResultOf(gets), {"aaa": (0, None), "aab": (0, None)})
+        self.assertEqual(self.successResultOf(sets), {"aaa": True})
+        self.assertEqual(self.successResultOf(adds), {"aab": True})
+        self.assertEqual(self.successResultOf(increments), {"aaa": 2})
+        self.assertEqual(self.successResultOf(deletes), {"aab": True})
+
+
+    def test_queuedKeysStay(self):
+        """
+        Ensure that hosts that commands are queued for are named the same in
+        the ring before and after they connect, so keys don't move.
+        """
+        client = YamClient(['one', 'two'], connect=False, lazy=True)
+        client.connect()
+        keys = ["key%i" % index for index in xrange(100)]
+        before = dict((key, client.router.getNode(key)) for key in keys)
+        for factory in client.factories:
+            transport = StringTransportWithDisconnection()
+            address = IPv4Address('TCP', '10.0.0.%i' % (len(client.everConnected) + 1), 11211)
+            transport.protocol = factory.buildProtocol(address, timeOut=None)
+            transport.protocol.makeConnection(transport)
+        self.assertEqual(len(client.router.nodes), 2)
+        self.assertEqual(dict((key, client.router.getNode(key)) for key in keys), before)
+
+
+    def test_lazy(self):
+        """
+        Ensure that lazy clients only connect to a host when a command is
+        sent to it, and that the command waits until it is connected.
+        """
+        client = YamClient(['one', 'two'], connect=False, lazy=True, connectTimeout=5)
+        self.assertIdentical(self.successResultOf(client.connect()), client)
+        self.assertEqual(self.reactor.tcpClients, [])
+
+        d = client.get("foo")
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        factory = self.reactor.tcpClients[0][2]
+        self.assertEqual(client.readiness()[factory.hostport], 'connecting')
+        transport = self.connectFactory(factory)
+        self.assertEqual(transport.value(), "get foo\r\n")
+        transport.protocol.dataReceived("VALUE foo 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual(self.successResultOf(d), (0, "bar"))
+
+        other = [key for key in ("key%i" % index for index in xrange(100))
+                 if client.router.getNode(key) is not factory][0]
+        d = client.get(other)
+        self.reactor.advance(5)
+        self.failureResultOf(d, NoServerError)
+        self.assertEqual(client.router.nodes, [factory])
+
+
+class ModifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = YamClient(['one', 'two'], connect=False)
+        self.client.clock = Clock()
+        self.one, self.two = makeTestConnections(self.client)
+        self.patch(txyam.client.random, 'uniform', lambda low, high: high)
+
+
+    def test_modify(self):
+        d = self.client.modify("aaa", lambda value: value + "!", expireTime=10)
+        self.assertEqual(self.one.value(), "gets aaa\r\n")
+        self.one.protocol.dataReceived("VALUE aaa 0 3 5\r\nbar\r\nEND\r\n")
+        self.assertEqual(self.one.value(), "gets aaa\r\ncas aaa 0 10 4 5\r\nbar!\r\n")
+        self.one.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.successResultOf(d), "bar!")
+
+
+    def test_missing(self):
+        d = self.client.modify("aaa", lambda value: "1" if value is None else value)
+        self.one.protocol.dataReceived("END\r\n")
+        self.assertEqual(self.one.value(), "gets aaa\r\nadd aaa 0 0 1\r\n1\r\n")
+        self.one.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.successResultOf(d), "1")
+
+
+    def test_retries(self):
+        """
+        Ensure that conflicting writes are retried after a growing delay,
+        and that C{ConflictError} is raised when there are too many.
+        """
+        d = self.client.modify("aaa", lambda value: value + "!", retries=2, backoff=0.5, maxBackoff=0.75)
+        for delay in (0.5, 0.75):
+            self.one.protocol.dataReceived("VALUE aaa 0 3 5\r\nbar\r\nEND\r\n")
+            self.one.clear()
+            self.one.protocol.dataReceived("EXISTS\r\n")
+            self.client.clock.advance(delay - 0.01)
+            self.assertEqual(self.one.value(), "")
+            self.client.clock.advance(0.01)
+            self.assertEqual(self.one.value(), "gets aaa\r\n")
+        self.one.protocol.dataReceived("VALUE aaa 0 3 6\r\nbar\r\nEND\r\n")
+        self.one.protocol.dataReceived("EXISTS\r\n")
+        self.assertEqual(self.failureResultOf(d, txyam.client.ConflictError).value.keys, ["aaa"])
+
+
+    def test_noServersOnRetry(self):
+        """
+        Ensure that a retry that can't be sent anywhere fails the modification.
+        """
+        d = self.client.modify("aaa", lambda value: value + "!")
+        self.one.protocol.dataReceived("VALUE aaa 0 3 5\r\nbar\r\nEND\r\n")
+        self.one.protocol.dataReceived("EXISTS\r\n")
+        self.client.removeHost("one")
+        self.client.removeHost("two")
+        self.client.clock.advance(0.01)
+        self.failureResultOf(d, NoServerError)
+
+
+    def test_modifyMultiplePickled(self):
+        """
+        Ensure that every server gets one C{gets} per try, and that only
+        keys that conflicted are tried again.
+        """
+        codec = self.client.codec
+        d = self.client.modifyMultiplePickled(["aaa", "aab", "foo"], lambda key, value: (value or 0) + 1)
+        self.assertEqual(sorted(self.one.value().split()), ["aaa", "aab", "gets"])
+        self.assertEqual(self.two.value(), "gets foo\r\n")
+        flags, data = codec.encode(1)
+        self.one.clear()
+        self.one.protocol.dataReceived("VALUE aaa %i %i 1\r\n%s\r\nEND\r\n" % (flags, len(data), data))
+        self.two.protocol.dataReceived("END\r\n")
+        self.two.protocol.dataReceived("STORED\r\n")
+        writes = [line for line in self.one.value().split("\r\n") if line[:3] in ("cas", "add")]
+        self.one.protocol.dataReceived("".join("EXISTS\r\n" if "cas aaa" in line else "STORED\r\n" for line in writes))
+        self.one.clear()
+        self.client.clock.advance(0.01)
+        self.assertEqual(self.one.value(), "gets aaa\r\n")
+        flags, data = codec.encode(5)
+        self.one.protocol.dataReceived("VALUE aaa %i %i 2\r\n%s\r\nEND\r\n" % (flags, len(data), data))
+        flags, data = codec.encode(6)
+        self.assertEqual(self.one.value().split("\r\n")[1], "cas aaa %i 0 %i 2" % (flags, len(data)))
+        self.one.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.successResultOf(d), {"aaa": 6, "aab": 1, "foo": 1})
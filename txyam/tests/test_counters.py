@@ -0,0 +1,122 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.protocols.memcache import ClientError, ServerError
+
+from txyam.tests.utils import makeTestConnections
+from txyam.client import YamClient
+from txyam.counters import Counters
+
+
+class CountersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = YamClient(['one', 'two'], connect=False)
+        self.transport = makeTestConnections(self.client)[0]
+        self.counters = Counters(self.client, interval=1, initial=10, expireTime=60, clock=Clock())
+
+
+    def test_batched(self):
+        ds = [self.counters.increment("aaa"), self.counters.increment("aaa", 3), self.counters.decrement("aaa")]
+        self.assertEqual(self.transport.value(), "")
+        self.counters.clock.advance(1)
+        self.assertEqual(self.transport.value(), "incr aaa 3\r\n")
+        self.transport.protocol.dataReceived("8\r\n")
+        self.assertEqual([self.successResultOf(d) for d in ds], [8, 8, 8])
+
+        self.counters.decrement("aaa", 2)
+        self.counters.clock.advance(1)
+        self.assertEqual(self.transport.value(), "incr aaa 3\r\ndecr aaa 2\r\n")
+
+
+    def test_pipelined(self):
+        self.counters.increment("aaa")
+        self.counters.increment("aab")
+        self.counters.stop()
+        self.assertEqual(sorted(self.transport.value().split("\r\n")), ["", "incr aaa 1", "incr aab 1"])
+
+
+    def test_immediate(self):
+        self.counters.increment("aaa")
+        d = self.counters.increment("aaa", 2, immediate=True)
+        self.assertEqual(self.transport.value(), "incr aaa 3\r\n")
+        self.transport.protocol.dataReceived("3\r\n")
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertIdentical(self.counters.call, None)
+
+
+    def test_create(self):
+        """
+        Ensure that missing counters are created with C{add}, and changed if
+        someone else creates them first.
+        """
+        d = self.counters.increment("aaa", 2, immediate=True)
+        self.transport.clear()
+        self.transport.protocol.dataReceived("NOT_FOUND\r\n")
+        self.assertEqual(self.transport.value(), "add aaa 0 60 2\r\n12\r\n")
+        self.transport.protocol.dataReceived("STORED\r\n")
+        self.assertEqual(self.successResultOf(d), 12)
+
+        d = self.counters.decrement("aaa", 2, immediate=True)
+        self.transport.protocol.dataReceived("NOT_FOUND\r\n")
+        self.transport.clear()
+        self.transport.protocol.dataReceived("NOT_STORED\r\n")
+        self.assertEqual(self.transport.value(), "decr aaa 2\r\n")
+        self.transport.protocol.dataReceived("7\r\n")
+        self.assertEqual(self.successResultOf(d), 7)
+
+
+    def test_createRaceToZero(self):
+        """
+        Ensure that a counter someone else created is reported as 0, not as
+        a timeout, when the change takes it to 0.
+        """
+        d = self.counters.decrement("aaa", 20, immediate=True)
+        self.transport.protocol.dataReceived("NOT_FOUND\r\n")
+        self.transport.protocol.dataReceived("NOT_STORED\r\n")
+        self.transport.protocol.dataReceived("0\r\n")
+        self.assertEqual(self.successResultOf(d), 0)
+
+
+    def test_retry(self):
+        d = self.counters.increment("aaa", 2, immediate=True)
+        self.counters.increment("aaa")
+        self.transport.clear()
+        self.transport.protocol.dataReceived("SERVER_ERROR busy\r\n")
+        self.assertEqual(len(self.flushLoggedErrors(ServerError)), 1)
+        self.assertNoResult(d)
+        self.counters.clock.advance(1)
+        self.assertEqual(self.transport.value(), "incr aaa 3\r\n")
+        self.transport.protocol.dataReceived("13\r\n")
+        self.assertEqual(self.successResultOf(d), 13)
+
+
+    def test_retryLimit(self):
+        """
+        Ensure that changes that keep failing are given up on after
+        C{retries} retries.
+        """
+        d = self.counters.increment("aaa", immediate=True)
+        for _ in range(3):
+            self.transport.protocol.dataReceived("SERVER_ERROR busy\r\n")
+            self.assertNoResult(d)
+            self.counters.clock.advance(1)
+        self.transport.clear()
+        self.transport.protocol.dataReceived("SERVER_ERROR busy\r\n")
+        self.failureResultOf(d, ServerError)
+        self.assertEqual(len(self.flushLoggedErrors(ServerError)), 3)
+        self.counters.clock.advance(1)
+        self.assertEqual(self.transport.value(), "")
+        self.assertEqual(self.counters.attempts, {})
+
+
+    def test_clientErrorNotRetried(self):
+        """
+        Ensure that changes the server rejects fail right away.
+        """
+        d = self.counters.increment("aaa", immediate=True)
+        self.transport.clear()
+        self.transport.protocol.dataReceived("CLIENT_ERROR cannot increment or decrement non-numeric value\r\n")
+        self.failureResultOf(d, ClientError)
+        self.assertEqual(self.flushLoggedErrors(ClientError), [])
+        self.assertIdentical(self.counters.call, None)
+        self.assertEqual(self.counters.pending, {})
@@ -1,7 +1,12 @@
 from twisted.trial import unittest
 from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 
-from txyam.factory import ConnectingMemCacheProtocol, MemCacheClientFactory
+from txyam.factory import ConnectingMemCacheProtocol, MemCacheClientFactory, MemCacheClientPool
+from txyam.factory import BufferedMemCacheClientFactory
 
 
 class FactoryTest(unittest.TestCase):
@@ -13,3 +18,206 @@ class FactoryTest(unittest.TestCase):
         self.assertIsInstance(p, ConnectingMemCacheProtocol)
         self.assertEqual(p.persistentTimeOut, 123)
         self.assertEqual(str(p), "memcache[%s]" % addy)
+        self.assertEqual(str(f), str(p))
+
+
+    def test_notifyOwner(self):
+        """
+        Ensure that the owner is told about connections made and lost.
+        """
+        class Owner:
+            def __init__(self):
+                self.changes = []
+
+            def connectionStateChanged(self, factory):
+                self.changes.append(factory.client)
+
+        f = MemCacheClientFactory(Owner())
+        p = f.buildProtocol('ahost', timeOut=None)
+        p.makeConnection(StringTransport())
+        f.stopTrying()
+        f.clientConnectionLost(None, None)
+        self.assertEqual(f.owner.changes, [p, None])
+
+
+class ProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.proto = MemCacheClientFactory().buildProtocol('ahost', timeOut=None)
+        self.proto.makeConnection(self.transport)
+
+
+    def test_pipeline(self):
+        """
+        Ensure that nothing is written until the pipeline is flushed.
+        """
+        self.proto.startPipeline()
+        d1 = self.proto.get("foo")
+        d2 = self.proto.delete("bar")
+        self.assertEqual(self.transport.value(), "")
+        self.proto.flushPipeline()
+        self.assertEqual(self.transport.value(), "get foo\r\ndelete bar\r\n")
+        self.proto.dataReceived("END\r\nDELETED\r\n")
+        d1.addCallback(self.assertEqual, (0, None))
+        d2.addCallback(self.assertEqual, True)
+        return d2
+
+
+    def test_noreply(self):
+        self.proto.setNoReply("foo", "bar", 2, 3)
+        self.proto.addNoReply("egg", "spam")
+        self.proto.deleteNoReply("baz")
+        send = "set foo 2 3 3 noreply\r\nbar\r\nadd egg 0 0 4 noreply\r\nspam\r\ndelete baz noreply\r\n"
+        self.assertEqual(self.transport.value(), send)
+        self.assertEqual(len(self.proto._current), 0)
+
+
+class BatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        factory = MemCacheClientFactory()
+        factory.batchWindow = 0
+        factory.mergeGets = True
+        self.proto = factory.buildProtocol('ahost', timeOut=None)
+        self.proto.callLater = self.clock.callLater
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+
+    def test_batched(self):
+        """
+        Ensure that commands issued together are sent in one write.
+        """
+        writes = []
+        self.transport.write = writes.append
+        self.proto.set("foo", "bar")
+        self.proto.delete("baz")
+        self.assertEqual(writes, [])
+        self.clock.advance(0)
+        self.assertEqual(writes, ["set foo 0 0 3\r\nbar\r\ndelete baz\r\n"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_batchBytes(self):
+        """
+        Ensure that a batch is sent as soon as it is C{batchBytes} long.
+        """
+        self.proto.batchBytes = 30
+        self.proto.set("foo", "bar")
+        self.assertEqual(self.transport.value(), "")
+        self.proto.set("foo", "0123456789")
+        self.assertEqual(self.transport.value(), "set foo 0 0 3\r\nbar\r\nset foo 0 0 10\r\n")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "set foo 0 0 3\r\nbar\r\nset foo 0 0 10\r\n0123456789\r\n")
+
+
+    def test_mergeGets(self):
+        """
+        Ensure that adjacent gets are sent as one multi-key get, and each
+        caller gets the result for its key.
+        """
+        foo = self.proto.get("foo")
+        bar = self.proto.get("bar")
+        again = self.proto.get("foo")
+        self.proto.delete("foo")
+        baz = self.proto.get("baz")
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "get foo bar\r\ndelete foo\r\nget baz\r\n")
+        self.proto.dataReceived("VALUE foo 1 3\r\nabc\r\nEND\r\nDELETED\r\nVALUE baz 0 1\r\nz\r\nEND\r\n")
+        self.assertEqual(self.successResultOf(foo), (1, "abc"))
+        self.assertEqual(self.successResultOf(again), (1, "abc"))
+        self.assertEqual(self.successResultOf(bar), (0, None))
+        self.assertEqual(self.successResultOf(baz), (0, "z"))
+
+
+    def test_mergedGetFails(self):
+        d = self.proto.get("foo")
+        self.proto.get("bar").addErrback(lambda failure: None)
+        self.proto.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class BufferedProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.proto = BufferedMemCacheClientFactory().buildProtocol('ahost', timeOut=None)
+        self.proto.largeValue = 10
+        self.proto.makeConnection(self.transport)
+
+
+    def test_largeValue(self):
+        """
+        Ensure that large values are read into a C{bytearray}, however the
+        data is split up, and anything after them is still parsed.
+        """
+        value = "0123456789" * 5
+        data = "VALUE foo 0 50\r\n%s\r\nEND\r\nSTORED\r\n" % value
+        for size in [1, 7, 51, len(data)]:
+            get = self.proto.get("foo")
+            store = self.proto.set("foo", "bar")
+            for index in xrange(0, len(data), size):
+                self.proto.dataReceived(data[index:index + size])
+            result = self.successResultOf(get)
+            self.assertIsInstance(result[1], bytearray)
+            self.assertEqual(result, (0, value))
+            self.assertTrue(self.successResultOf(store))
+
+
+    def test_getMultiple(self):
+        d = self.proto.getMultiple(["foo", "bar"])
+        self.proto.dataReceived("VALUE foo 1 12\r\nhello world!\r\nVALUE bar 2 3\r\nbaz\r\nEND\r\n")
+        result = self.successResultOf(d)
+        self.assertEqual(result, {"foo": (1, "hello world!"), "bar": (2, "baz")})
+        self.assertIsInstance(result["foo"][1], bytearray)
+        self.assertIsInstance(result["bar"][1], str)
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        class Owner:
+            def __init__(self):
+                self.changes = []
+
+            def connectionStateChanged(self, pool):
+                self.changes.append(pool.client)
+
+        self.pool = MemCacheClientPool(2, Owner(), 'ahost:1234')
+        self.transports = []
+        for factory in self.pool.factories:
+            transport = StringTransport()
+            factory.buildProtocol('ahost', timeOut=None).makeConnection(transport)
+            self.transports.append(transport)
+
+
+    def test_leastOutstanding(self):
+        """
+        Ensure that requests go to the connection with the fewest requests
+        waiting for a response.
+        """
+        one, two = [factory.client for factory in self.pool.factories]
+        self.pool.client.get("foo")
+        self.pool.client.get("bar")
+        self.pool.client.get("baz")
+        self.assertEqual(len(one._current), 2)
+        self.assertEqual(len(two._current), 1)
+        self.assertEqual(self.pool.poolStats(),
+                         {'size': 2, 'connected': 2, 'outstanding': [2, 1], 'connects': 2})
+
+
+    def test_availability(self):
+        """
+        Ensure that the owner is only notified when the first connection is
+        made and when the last is lost.
+        """
+        self.assertEqual(len(self.pool.owner.changes), 1)
+        self.pool.stopTrying()
+        for factory in self.pool.factories:
+            factory.clientConnectionLost(None, None)
+        self.assertEqual(self.pool.owner.changes[1:], [None])
+        self.assertIdentical(self.pool.client, None)
+        self.assertEqual(self.pool.getConnections(), [])
@@ -0,0 +1,117 @@
+from twisted.trial import unittest
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.protocols.memcache import ClientError, ServerError
+from twisted.test.proto_helpers import StringTransportWithDisconnection
+
+from txyam.tests.utils import makeTestConnections
+from txyam.client import YamClient
+from txyam.health import HealthMonitor
+
+
+class HealthMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.health = HealthMonitor(alpha=0.5, minSamples=2, cooldown=2, probesNeeded=2, clock=self.clock)
+        self.client = YamClient(['one', 'two'], connect=False, health=self.health)
+        self.transports = makeTestConnections(self.client)
+        self.bad = self.client.factories[0]
+
+
+    def failCommands(self, count):
+        for _ in range(count):
+            d = self.client.set("aaa", "bar")
+            self.transports[0].protocol.dataReceived("SERVER_ERROR out of memory\r\n")
+            self.failureResultOf(d, ServerError)
+
+
+    def test_ejectOnErrors(self):
+        """
+        Ensure that a server is taken out of the ring once enough of its
+        commands fail.
+        """
+        self.failCommands(1)
+        self.assertEqual(len(self.client.getActiveFactories()), 2)
+        self.failCommands(1)
+        self.assertEqual(self.client.getActiveFactories(), [self.client.factories[1]])
+        self.assertEqual(self.client.getClient("aaa"), self.client.factories[1].client)
+        self.assertTrue(self.health.healthStats()[str(self.bad)]['ejected'])
+
+
+    def test_clientErrorsIgnored(self):
+        """
+        Ensure that errors that are the caller's fault don't count against a
+        server.
+        """
+        for _ in range(2):
+            self.health.record(self.bad, 0, Failure(ClientError("Key too long")))
+        self.assertEqual(self.health.healthStats()[str(self.bad)]['errorRate'], 0)
+        self.assertEqual(len(self.client.getActiveFactories()), 2)
+
+
+    def test_readmitAfterProbes(self):
+        """
+        Ensure that an ejected server is only readmitted after answering
+        enough probes in a row and waiting out the cooldown.
+        """
+        self.failCommands(2)
+        transport = self.transports[0]
+        transport.clear()
+
+        self.clock.advance(1)
+        self.assertEqual(transport.value(), "version\r\n")
+        transport.protocol.dataReceived("SERVER_ERROR busy\r\n")
+        for _ in range(2):
+            transport.clear()
+            self.clock.advance(1)
+            self.assertEqual(transport.value(), "version\r\n")
+            transport.protocol.dataReceived("VERSION 1.4.5\r\n")
+        self.assertEqual(self.client.getClient("aaa"), self.bad.client)
+        self.assertFalse(self.health.servers[self.bad].ejected)
+
+
+    def test_cooldownGrows(self):
+        """
+        Ensure that a server that is ejected again soon after being readmitted
+        stays out longer.
+        """
+        self.failCommands(2)
+        self.health.readmit(self.bad)
+        self.failCommands(2)
+        health = self.health.servers[self.bad]
+        self.assertEqual(health.ejections, 2)
+        self.assertEqual(self.health.getCooldown(health), 4)
+
+
+    def test_ejectFlapping(self):
+        """
+        Ensure that a server that keeps losing its connection stays out of the
+        ring even after it reconnects.
+        """
+        for _ in range(3):
+            # no connector to retry with
+            self.bad.stopTrying()
+            self.bad.clientConnectionLost(None, Failure(ConnectionDone()))
+            proto = self.bad.buildProtocol('one', timeOut=None)
+            proto.makeConnection(StringTransportWithDisconnection())
+        self.assertEqual(self.client.getActiveFactories(), [self.client.factories[1]])
+
+
+    def test_maxEjected(self):
+        """
+        Ensure that at most C{maxEjectedFraction} of servers are ejected.
+        """
+        self.failCommands(2)
+        for _ in range(2):
+            d = self.client.set("foo", "bar")
+            self.transports[1].protocol.dataReceived("SERVER_ERROR out of memory\r\n")
+            self.failureResultOf(d, ServerError)
+        self.assertEqual(self.client.getActiveFactories(), [self.client.factories[1]])
+
+
+    def test_stop(self):
+        self.failCommands(2)
+        self.client.disconnect()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,119 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from txyam.tests.utils import makeTestConnections
+from txyam.client import YamClient
+from txyam.hotkeys import SpaceSaving, HotKeyDetector
+import txyam.client
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    def test_replaceSmallest(self):
+        sketch = SpaceSaving(2)
+        for key in ["a", "a", "a", "b", "c"]:
+            sketch.add(key)
+        # c takes over b's count
+        self.assertEqual(sketch.top(), [("a", 3), ("c", 2)])
+        self.assertEqual(sketch.total, 5)
+
+
+    def test_decay(self):
+        sketch = SpaceSaving(2)
+        for key in ["a", "a", "a", "b"]:
+            sketch.add(key)
+        sketch.decay()
+        self.assertEqual(sketch.top(), [("a", 1)])
+        self.assertEqual(sketch.total, 2)
+
+
+class HotKeyDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.detector = HotKeyDetector(capacity=4, threshold=0.5, sampleRate=1, minSamples=4,
+                                       decayInterval=10, clock=self.clock)
+
+
+    def test_hotKeys(self):
+        for key in ["b", "c", "a", "a"]:
+            self.detector.record(key)
+        self.assertTrue(self.detector.isHot("a"))
+        self.assertFalse(self.detector.isHot("b"))
+        self.assertEqual(self.detector.getHotKeys(), [("a", 0.5)])
+
+
+    def test_coolsDown(self):
+        for key in ["a", "a", "a", "a"]:
+            self.detector.record(key)
+        self.assertTrue(self.detector.isHot("a"))
+        self.clock.advance(10)
+        for key in ["b", "c", "d", "b", "c", "d"]:
+            self.detector.record(key)
+        self.clock.advance(10)
+        self.detector.record("b")
+        self.assertFalse(self.detector.isHot("a"))
+
+
+class ClientHotKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(txyam.client, 'reactor', self.clock)
+        detector = HotKeyDetector(threshold=0.5, sampleRate=1, minSamples=2)
+        self.client = YamClient(['one', 'two'], connect=False, hotKeys=detector, hotKeyTTL=1)
+        self.transport = makeTestConnections(self.client)[0]
+
+
+    def get(self, key):
+        self.transport.clear()
+        d = self.client.get(key)
+        if self.transport.value():
+            self.transport.protocol.dataReceived("VALUE %s 0 3\r\nbar\r\nEND\r\n" % key)
+        return self.successResultOf(d)
+
+
+    def test_localCache(self):
+        """
+        Ensure that hot keys are served locally until they expire or are
+        written.
+        """
+        self.get("aaa")
+        self.get("aaa")
+        self.assertEqual(self.client.getHotKeys(), [("aaa", 1.0)])
+        self.transport.clear()
+        self.assertEqual(self.successResultOf(self.client.get("aaa")), (0, "bar"))
+        self.assertEqual(self.transport.value(), "")
+
+        d = self.client.getMultiple(["aaa", "aab"])
+        self.assertEqual(self.transport.value(), "get aab\r\n")
+        self.transport.protocol.dataReceived("END\r\n")
+        self.assertEqual(self.successResultOf(d), {"aaa": (0, "bar"), "aab": (0, None)})
+
+        self.clock.advance(1)
+        self.transport.clear()
+        self.client.get("aaa")
+        self.assertEqual(self.transport.value(), "get aaa\r\n")
+        self.transport.protocol.dataReceived("VALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual(len(self.client.hotCache), 1)
+
+        self.client.set("aaa", "baz")
+        self.transport.protocol.dataReceived("STORED\r\n")
+        self.transport.clear()
+        self.client.get("aaa")
+        self.assertEqual(self.transport.value(), "get aaa\r\n")
+        self.transport.protocol.dataReceived("END\r\n")
+
+
+    def test_spreadOverReplicas(self):
+        """
+        Ensure that hot keys are read from any of their replicas.
+        """
+        detector = HotKeyDetector(threshold=0.5, sampleRate=1, minSamples=1)
+        client = YamClient(['one', 'two'], connect=False, replicas=2, hotKeys=detector)
+        transports = makeTestConnections(client)
+        self.patch(txyam.client.random, 'randrange', lambda n: 1)
+        client.get("aaa")
+        self.assertEqual(transports[0].value(), "")
+        self.assertEqual(transports[1].value(), "get aaa\r\n")
+        transports[1].protocol.dataReceived("END\r\n")
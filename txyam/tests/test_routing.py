@@ -0,0 +1,115 @@
+import uuid
+
+from twisted.trial import unittest
+
+from txyam.routing import HashRingRouter, KetamaRouter, RendezvousRouter
+
+
+class Node:
+    def __init__(self, hostport):
+        self.hostport = hostport
+
+
+    def __str__(self):
+        return "memcache[%s]" % self.hostport
+
+
+class RouterTestMixin:
+    routerClass = None
+
+    def makeNodes(self, count):
+        return [Node("host%i:11211" % i) for i in range(count)]
+
+
+    def test_empty(self):
+        router = self.routerClass([])
+        self.assertIdentical(router.getNode("foo"), None)
+        self.assertEqual(router.getNodes("foo", 2), [])
+
+
+    def test_isDistributed(self):
+        nodes = self.makeNodes(5)
+        router = self.routerClass(nodes)
+        counts = dict((node, 0) for node in nodes)
+        for _ in xrange(500):
+            counts[router.getNode(str(uuid.uuid4()))] += 1
+        for count in counts.values():
+            self.assertTrue(count > 50)
+
+
+    def test_weights(self):
+        nodes = self.makeNodes(2)
+        router = self.routerClass(nodes, {"host0:11211": 4})
+        counts = dict((node, 0) for node in nodes)
+        for _ in xrange(500):
+            counts[router.getNode(str(uuid.uuid4()))] += 1
+        self.assertTrue(counts[nodes[0]] > 2 * counts[nodes[1]])
+
+
+    def test_getNodes(self):
+        nodes = self.makeNodes(4)
+        router = self.routerClass(nodes)
+        for key in ("foo", "bar", "baz"):
+            found = router.getNodes(key, 3)
+            self.assertEqual(len(set(found)), 3)
+            self.assertIdentical(found[0], router.getNode(key))
+        self.assertEqual(len(router.getNodes("foo", 10)), 4)
+
+
+    def test_removalOnlyMovesOwnedKeys(self):
+        nodes = self.makeNodes(5)
+        before = self.routerClass(nodes)
+        after = self.routerClass(nodes[1:])
+        for key in (str(uuid.uuid4()) for _ in xrange(200)):
+            if before.getNode(key) is not nodes[0]:
+                self.assertIdentical(before.getNode(key), after.getNode(key))
+
+
+class HashRingRouterTest(RouterTestMixin, unittest.TestCase):
+    routerClass = HashRingRouter
+
+
+class KetamaRouterTest(RouterTestMixin, unittest.TestCase):
+    routerClass = KetamaRouter
+
+    def test_points(self):
+        router = KetamaRouter(self.makeNodes(3))
+        self.assertEqual(len(router.points), 3 * 160)
+        self.assertEqual(router.points, sorted(router.points))
+
+
+    def test_libketamaCompatible(self):
+        """
+        Ensure that keys go to the same servers as with libketama, including
+        with seven servers, where its single precision arithmetic gives each
+        server 40 groups of points rather than 39.  The expected servers come
+        from a C copy of libketama's continuum and lookup code.
+        """
+        nodes = [Node("10.0.1.%i:11211" % i) for i in range(1, 8)]
+        router = KetamaRouter(nodes)
+        self.assertEqual(len(router.points), 7 * 160)
+        expected = {"key0": 4, "key1": 7, "key2": 7, "key3": 1, "key4": 2, "key5": 6,
+                    "key57": 1, "key60": 1, "key81": 1, "key83": 7, "key125": 7, "key239": 5}
+        for key, index in expected.items():
+            self.assertEqual(router.getNode(key).hostport, "10.0.1.%i:11211" % index)
+
+        weights = {"10.0.1.1:11211": 1, "10.0.1.2:11211": 2, "10.0.1.3:11211": 3, "10.0.1.4:11211": 7}
+        router = KetamaRouter(nodes[:4], weights)
+        expected = [4, 4, 4, 4, 2, 3, 3, 3]
+        self.assertEqual([router.getNode("key%i" % i).hostport for i in range(8)],
+                         ["10.0.1.%i:11211" % index for index in expected])
+
+
+    def test_namedByHostPort(self):
+        """
+        Ensure that placement only depends on the configured host and port.
+        """
+        keys = [str(uuid.uuid4()) for _ in xrange(50)]
+        one = KetamaRouter(self.makeNodes(3))
+        two = KetamaRouter(self.makeNodes(3))
+        for key in keys:
+            self.assertEqual(one.getNode(key).hostport, two.getNode(key).hostport)
+
+
+class RendezvousRouterTest(RouterTestMixin, unittest.TestCase):
+    routerClass = RendezvousRouter
@@ -0,0 +1,65 @@
+import cPickle
+import os
+import zlib
+
+from twisted.trial import unittest
+
+from txyam.serialization import Codec, UnknownCodecError, registerSerializer, serializers
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_roundTrip(self):
+        codec = Codec()
+        for serializer in ('pickle', 'json'):
+            for compress in (True, False):
+                flags, data = codec.encode({'foo': [1, 2]}, serializer, compress)
+                self.assertEqual(codec.decode(flags, data), {'foo': [1, 2]})
+
+
+    def test_threshold(self):
+        """
+        Ensure that values are only compressed automatically when they're
+        large and compression helps.
+        """
+        codec = Codec(compressThreshold=100)
+        self.assertEqual(codec.encode('a')[0], 0)
+        flags, data = codec.encode('a' * 200)
+        self.assertEqual(flags, 16)
+        self.assertEqual(codec.decode(flags, data), 'a' * 200)
+        self.assertEqual(codec.encode('a' * 200, compress=False)[0], 0)
+
+        # random data doesn't compress, so it's left alone
+        self.assertEqual(codec.encode(os.urandom(1000), 'raw')[0], 2)
+
+
+    def test_legacyCompression(self):
+        data = zlib.compress(cPickle.dumps([1], cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(Codec().decode(0, data, uncompress=True), [1])
+
+
+    def test_bytearrays(self):
+        """
+        Ensure that values read into a C{bytearray} can be decoded.
+        """
+        codec = Codec()
+        for value, kwargs in [({'a': 1}, {}), ({'a': 1}, {'compress': True}), ([1], {'serializer': 'json'})]:
+            flags, data = codec.encode(value, **kwargs)
+            self.assertEqual(codec.decode(flags, bytearray(data)), value)
+        data = zlib.compress(cPickle.dumps([1], cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(codec.decode(0, bytearray(data), uncompress=True), [1])
+
+
+    def test_unknown(self):
+        self.assertRaises(UnknownCodecError, Codec().decode, 15, "foo")
+        self.assertRaises(UnknownCodecError, Codec().decode, 0x70, "foo")
+
+
+    def test_register(self):
+        self.addCleanup(serializers.pop, 'upper')
+        self.addCleanup(serializers.pop, 9)
+        registerSerializer('upper', 9, lambda value: value.upper(), lambda value: value.lower())
+        codec = Codec(serializer='upper')
+        self.assertEqual(codec.encode('foo'), (9, 'FOO'))
+        self.assertEqual(codec.decode(9, 'FOO'), 'foo')
+        self.assertRaises(ValueError, registerSerializer, 'bad', 16, str, str)
@@ -0,0 +1,66 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.protocols.memcache import ServerError
+
+from txyam.tests.utils import makeTestConnections
+from txyam.client import YamClient
+from txyam.stats import Histogram, StatsCollector
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_percentile(self):
+        histogram = Histogram(smallest=1, largest=100, factor=2)
+        self.assertIdentical(histogram.percentile(50), None)
+        for latency in [0.5, 1.5, 3, 3, 100, 1000]:
+            histogram.record(latency)
+        self.assertEqual(histogram.count, 6)
+        self.assertEqual(histogram.percentile(0), 1)
+        self.assertEqual(histogram.percentile(50), 4)
+        self.assertEqual(histogram.percentile(80), 128)
+        self.assertEqual(histogram.percentile(100), 128)
+
+
+class StatsCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = StatsCollector(Clock())
+        self.client = YamClient(['one', 'two'], connect=False)
+        self.client.addObserver(self.collector)
+        self.transports = makeTestConnections(self.client)
+
+
+    def test_counts(self):
+        self.client.set("aaa", "bar")
+        failed = self.client.set("aaa", "bar")
+        d = self.client.get("aaa")
+        self.assertEqual(self.collector.snapshot()['one']['queueDepth'], 3)
+        self.collector.clock.advance(0.5)
+        self.transports[0].protocol.dataReceived("STORED\r\nSERVER_ERROR busy\r\nVALUE aaa 0 3\r\nbar\r\nEND\r\n")
+        self.assertEqual(self.successResultOf(d), (0, "bar"))
+        self.failureResultOf(failed, ServerError)
+        self.client.getMultiple(["aaa", "aab"])
+        self.transports[0].protocol.dataReceived("VALUE aab 0 5\r\nhello\r\nEND\r\n")
+
+        stats = self.collector.snapshot()['one']
+        self.assertEqual(stats['queueDepth'], 0)
+        sets = stats['commands']['set']
+        self.assertEqual((sets['ops'], sets['errors'], sets['bytesOut']), (2, 1, 6))
+        self.assertEqual(sets['latency']['count'], 2)
+        self.assertTrue(0.5 <= sets['latency']['p50'] < 0.75)
+        gets = stats['commands']['get']
+        self.assertEqual((gets['ops'], gets['hits'], gets['misses'], gets['bytesIn']), (1, 1, 0, 3))
+        multi = stats['commands']['getMultiple']
+        self.assertEqual((multi['ops'], multi['hits'], multi['misses'], multi['bytesIn']), (1, 1, 1, 5))
+
+
+    def test_reset(self):
+        self.client.delete("foo")
+        self.assertEqual(self.collector.snapshot(reset=True).keys(), ['two'])
+        self.assertEqual(self.collector.snapshot(), {})
+
+
+    def test_removeObserver(self):
+        self.client.removeObserver(self.collector)
+        self.client.delete("foo")
+        self.assertEqual(self.collector.snapshot(), {})
@@ -0,0 +1,252 @@
+from twisted.trial import unittest
+from twisted.internet.defer import Deferred, succeed, TimeoutError
+from twisted.internet.task import Clock
+
+from txyam.utils import SingleFlight, LatencyTracker, Namespace, canonical, memoize, timeoutDeferred
+
+
+class FakeClient:
+    """
+    Just enough of a L{txyam.client.YamClient} to memoize with.
+    """
+    def __init__(self, coalesce=False):
+        self.coalesce = coalesce
+        self.values = {}
+        self.expireTimes = {}
+        self.gets = []
+        self.multiGets = []
+
+
+    def getPickled(self, key):
+        d = Deferred()
+        self.gets.append(d)
+        return d
+
+
+    def getMultiplePickled(self, keys):
+        self.multiGets.append(keys)
+        return succeed(dict((key, (0, self.values.get(key))) for key in keys))
+
+
+    def setPickled(self, key, value, expireTime=0):
+        self.values[key] = value
+        self.expireTimes[key] = expireTime
+        return succeed(True)
+
+
+    def get(self, key):
+        return succeed((0, self.values.get(key)))
+
+
+    def set(self, key, value):
+        self.values[key] = value
+        return succeed(True)
+
+
+    def add(self, key, value):
+        if key in self.values:
+            return succeed(False)
+        return self.set(key, value)
+
+
+    def increment(self, key):
+        if key not in self.values:
+            return succeed(False)
+        self.values[key] = str(int(self.values[key]) + 1)
+        return succeed(int(self.values[key]))
+
+
+    def delete(self, key):
+        return succeed(self.values.pop(key, None) is not None)
+
+
+class TimeoutDeferredTest(unittest.TestCase):
+
+    def test_answered(self):
+        clock = Clock()
+        d = Deferred()
+        result = timeoutDeferred(d, 1, clock)
+        d.callback("value")
+        self.assertEqual(self.successResultOf(result), "value")
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_timedOut(self):
+        clock = Clock()
+        d = Deferred()
+        result = timeoutDeferred(d, 1, clock, lambda: "miss")
+        clock.advance(1)
+        self.assertEqual(self.successResultOf(result), "miss")
+        # late results are ignored, but still passed along
+        d.callback("value")
+        self.assertEqual(self.successResultOf(d), "value")
+
+
+    def test_timedOutFails(self):
+        clock = Clock()
+        result = timeoutDeferred(Deferred(), 1, clock)
+        clock.advance(1)
+        self.failureResultOf(result, TimeoutError)
+
+
+class LatencyTrackerTest(unittest.TestCase):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(size=100, minimum=10)
+        self.assertEqual(tracker.percentile(99, 5), 5)
+        for latency in range(100):
+            tracker.record(latency)
+        self.assertEqual(tracker.percentile(50), 50)
+        self.assertEqual(tracker.percentile(99), 99)
+        self.assertEqual(tracker.percentile(100), 99)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_shared(self):
+        calls = []
+        d = Deferred()
+
+        def func(arg):
+            calls.append(arg)
+            return d
+
+        flight = SingleFlight()
+        results = []
+        flight.call("key", func, 1).addCallback(results.append)
+        flight.call("key", func, 2).addCallback(results.append)
+        self.assertEqual(calls, [1])
+        d.callback("result")
+        self.assertEqual(results, ["result", "result"])
+        self.assertEqual(flight.waiting, {})
+
+
+    def test_failureShared(self):
+        d = Deferred()
+        flight = SingleFlight()
+        d1 = flight.call("key", lambda: d)
+        d2 = flight.call("key", lambda: d)
+        d.errback(ValueError())
+        self.assertFailure(d1, ValueError)
+        return self.assertFailure(d2, ValueError)
+
+
+class MemoizeTest(unittest.TestCase):
+
+    def test_coalescedMisses(self):
+        """
+        Ensure that concurrent misses only compute the function once when
+        the client coalesces requests.
+        """
+        client = FakeClient(coalesce=True)
+        calls = []
+
+        @memoize(client)
+        def func(arg):
+            calls.append(arg)
+            return arg * 2
+
+        results = []
+        func(2).addCallback(results.append)
+        func(2).addCallback(results.append)
+        self.assertEqual(len(client.gets), 1)
+        client.gets[0].callback((0, None))
+        self.assertEqual(calls, [2])
+        self.assertEqual(results, [4, 4])
+        self.assertEqual(client.values.values(), [(4,)])
+
+
+    def test_stableKeys(self):
+        """
+        Ensure that keys depend on the function and its arguments, but not
+        on the client or the order of keyword arguments.
+        """
+        def func(*args, **kwargs):
+            pass
+
+        def other(*args, **kwargs):
+            pass
+
+        one = memoize(FakeClient())(func).memoizer
+        two = memoize(FakeClient())(func).memoizer
+        self.assertEqual(one.name, "txyam.tests.test_utils.func")
+        self.assertEqual(one.makeKey((1,), {'a': 1, 'b': 2}), two.makeKey((1,), {'b': 2, 'a': 1}))
+        self.assertNotEqual(one.makeKey((1,), {}), one.makeKey((2,), {}))
+        self.assertNotEqual(one.makeKey((1,), {}), memoize(FakeClient())(other).memoizer.makeKey((1,), {}))
+        self.assertTrue(one.makeKey((), {}).startswith("txyam:memo:"))
+
+
+    def test_canonical(self):
+        self.assertEqual(canonical({'b': set([2, 1]), u'a': [1L, (2.5, None)]}), "{'a':[1,(2.5,None)],'b':set(1,2)}")
+
+
+    def test_cacheNone(self):
+        client = FakeClient()
+        calls = []
+
+        def func(arg):
+            calls.append(arg)
+        memoize(client)(func)(1)
+        client.gets[0].callback((0, None))
+        self.assertEqual(client.values, {})
+
+        memoized = memoize(client, expireTime=60, cacheNone=True, noneExpireTime=5)(func)
+        d = memoized(1)
+        client.gets[1].callback((0, None))
+        self.assertIdentical(self.successResultOf(d), None)
+        self.assertEqual(client.expireTimes.values(), [5])
+        d = memoized(1)
+        client.gets[2].callback((0, client.values.values()[0]))
+        self.assertIdentical(self.successResultOf(d), None)
+        self.assertEqual(calls, [1, 1])
+
+
+    def test_many(self):
+        """
+        Ensure that L{Memoizer.many} uses one multi-get and only computes
+        misses, once each.
+        """
+        client = FakeClient()
+        calls = []
+
+        @memoize(client, expireTime=10)
+        def func(arg):
+            calls.append(arg)
+            return arg * 2
+
+        client.values[func.memoizer.makeKey((1,), {})] = (20,)
+        d = func.many([(1,), (2,), (2,), [3]])
+        self.assertEqual(self.successResultOf(d), [20, 4, 4, 6])
+        self.assertEqual(len(client.multiGets), 1)
+        self.assertEqual(sorted(calls), [2, 3])
+        self.assertEqual(client.expireTimes.values(), [10, 10])
+
+        self.successResultOf(func.invalidate(1))
+        self.assertEqual(len(client.values), 2)
+
+
+    def test_namespace(self):
+        client = FakeClient()
+        clock = Clock()
+        clock.advance(1000)
+        namespace = Namespace(client, "users", refresh=5, clock=clock)
+        func = memoize(client, namespace=namespace)(lambda arg: arg)
+        d = func(1)
+        self.assertEqual(client.values["txyam:ns:users"], "1000")
+        client.gets[0].callback((0, None))
+        self.successResultOf(d)
+        old = client.values.keys()
+
+        self.assertEqual(self.successResultOf(namespace.invalidate()), "1001")
+        d = func(1)
+        client.gets[1].callback((0, None))
+        self.successResultOf(d)
+        self.assertEqual(len(set(client.values) - set(old)), 1)
+
+        # other processes see the new version once they refresh it
+        other = Namespace(client, "users", refresh=5, clock=clock)
+        self.assertEqual(self.successResultOf(other.getVersion()), "1001")
+        self.successResultOf(namespace.invalidate())
+        self.assertEqual(self.successResultOf(other.getVersion()), "1001")
+        clock.advance(5)
+        self.assertEqual(self.successResultOf(other.getVersion()), "1002")
@@ -1,3 +1,4 @@
+from twisted.python.failure import Failure
 from twisted.test.proto_helpers import StringTransportWithDisconnection
 
 from txyam.factory import MemCacheClientFactory
@@ -7,7 +8,7 @@ def makeTestConnections(client):
     client.factories = []
     transports = []
     for addr in client.hosts:
-        factory = MemCacheClientFactory()
+        factory = MemCacheClientFactory(client, str(addr))
         client.factories.append(factory)
         proto = factory.buildProtocol(addr, timeOut=None)
         transport = StringTransportWithDisconnection()
@@ -15,3 +16,28 @@ def makeTestConnections(client):
         proto.makeConnection(transport)
         transports.append(transport)
     return transports
+
+
+class FakeThreadPool:
+    """
+    Runs functions immediately instead of in a thread, and keeps track of
+    what was run.  Patch the reactor with L{ThreadlessReactor} so that the
+    results are delivered immediately too.
+    """
+    def __init__(self):
+        self.calls = []
+
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kwargs):
+        self.calls.append(func)
+        try:
+            result = func(*args, **kwargs)
+        except:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+
+class ThreadlessReactor:
+    def callFromThread(self, func, *args, **kwargs):
+        func(*args, **kwargs)
@@ -1,6 +1,9 @@
+import functools
 import hashlib
+from collections import deque
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
 
 def deferredDict(d):
@@ -22,43 +25,349 @@ def deferredDict(d):
             rvalue[names[index]] = results[index][1]
         return rvalue
 
-    dl = defer.DeferredList(d.values())
+    # failures are passed on in the results, so they aren't left unhandled
+    dl = defer.DeferredList(d.values(), consumeErrors=True)
     return dl.addCallback(handle, d.keys())
 
 
-class Memoizer:
+def timeoutDeferred(d, timeout, clock, onTimeout=None):
+    """
+    Wait for C{d} for at most C{timeout} seconds.  C{d} is not cancelled when
+    the time runs out, so the command it is waiting on can still finish; its
+    result is just ignored.
+
+    @param clock: An C{IReactorTime} provider.
+
+    @param onTimeout: A function returning the result to use if the time runs
+    out.  If C{None}, the returned C{Deferred} fails with a C{TimeoutError}.
+
+    @return: A C{Deferred} that fires with the result of C{d}, or the result
+    of C{onTimeout}.
+    """
+    result = defer.Deferred()
+
+    def expire():
+        if onTimeout is None:
+            result.errback(Failure(defer.TimeoutError("Timed out after %s seconds" % timeout)))
+        else:
+            result.callback(onTimeout())
+
+    def done(value):
+        if not result.called:
+            call.cancel()
+            result.callback(value)
+        if isinstance(value, Failure):
+            # the failure is handled by whoever is waiting on result, and
+            # nobody is waiting for a late one
+            return None
+        return value
+
+    call = clock.callLater(timeout, expire)
+    d.addBoth(done)
+    return result
+
+
+class LatencyTracker:
     """
-    Class to handle memoizing functions.  Not meant to be instantiated
-    by any code other than the C{memoize} function.
+    Keeps the most recent latencies of some operation, so percentiles of
+    them can be found.
     """
-    def __init__(self, client):
+    def __init__(self, size=1000, minimum=100):
+        """
+        @param size: The number of latencies to keep.
+
+        @param minimum: The number of latencies needed before percentiles are
+        calculated.
+        """
+        self.latencies = deque(maxlen=size)
+        self.minimum = minimum
+        self.cache = {}
+        self.recorded = 0
+
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        self.recorded += 1
+        # percentiles are recalculated after a tenth of the window changes
+        if self.recorded >= self.latencies.maxlen / 10:
+            self.cache.clear()
+            self.recorded = 0
+
+
+    def percentile(self, percentile, default=None):
+        """
+        @return: The given percentile (0 to 100) of the recent latencies, or
+        C{default} if there aren't enough of them yet.
+        """
+        if len(self.latencies) < self.minimum:
+            return default
+        if percentile not in self.cache:
+            ordered = sorted(self.latencies)
+            index = min(len(ordered) - 1, int(len(ordered) * percentile / 100.0))
+            self.cache[percentile] = ordered[index]
+        return self.cache[percentile]
+
+
+class SingleFlight:
+    """
+    Share the result of a call among all of the callers that ask for the
+    same key while it is in progress.  Every caller gets the same result
+    object, so callers should not modify it.
+    """
+    def __init__(self):
+        self.waiting = {}
+
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call C{func} with the given arguments, unless a call for C{key} is
+        already in progress, in which case wait for that call's result.
+
+        @return: A C{Deferred} that fires with the result of the call.
+        """
+        if key in self.waiting:
+            d = defer.Deferred()
+            self.waiting[key].append(d)
+            return d
+        self.waiting[key] = []
+        return defer.maybeDeferred(func, *args, **kwargs).addBoth(self.done, key)
+
+
+    def done(self, result, key):
+        for d in self.waiting.pop(key):
+            d.callback(result)
+        return result
+
+
+def canonical(value):
+    """
+    Encode C{value} as a C{str} that is the same in every process, so it can
+    be used in a key.  Dicts and sets are sorted, and C{unicode} is encoded
+    as UTF-8 (so C{u"a"} and C{"a"} are the same, as they are equal).  Any
+    other type is encoded with its C{repr}, which should then not include
+    an object address.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, tuple):
+        return "(%s)" % ",".join(canonical(item) for item in value)
+    if isinstance(value, list):
+        return "[%s]" % ",".join(canonical(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return "set(%s)" % ",".join(sorted(canonical(item) for item in value))
+    if isinstance(value, dict):
+        return "{%s}" % ",".join(sorted("%s:%s" % (canonical(k), canonical(v)) for k, v in value.items()))
+    return repr(value)
+
+
+class Namespace:
+    """
+    A named group of memoized functions whose results can all be thrown
+    away at once.  The namespace's version is kept in memcached and is part
+    of the key of every result memoized in it, so L{invalidate} makes every
+    process miss on the old keys, which are left to expire or be evicted.
+    Each process rereads the version at most every C{refresh} seconds.
+    """
+    prefix = "txyam:ns:"
+
+    def __init__(self, client, name, refresh=1, clock=None):
+        """
+        @param name: The namespace's name, which must not contain spaces.
+        """
         self.client = client
+        self.name = name
+        self.key = self.prefix + name
+        self.refresh = refresh
+        self.clock = clock or reactor
+        self.version = None
+        self.checked = None
+        self.inflight = SingleFlight()
+
+
+    def initialVersion(self):
+        # start at the time, rather than 0, so that if the version is
+        # evicted, the keys of old results aren't used again
+        return str(int(self.clock.seconds()))
+
+
+    def setVersion(self, version):
+        self.version = str(version)
+        self.checked = self.clock.seconds()
+        return self.version
+
+
+    def getVersion(self):
+        """
+        @return: A C{Deferred} that fires with the current version.
+        """
+        if self.version is not None and self.clock.seconds() < self.checked + self.refresh:
+            return defer.succeed(self.version)
+        return self.inflight.call(self.key, self.fetchVersion)
+
 
+    def fetchVersion(self):
+        initial = self.initialVersion()
 
-    def memoize(self, func):
+        def reread(stored):
+            if stored:
+                return self.setVersion(initial)
+            return self.client.get(self.key).addCallback(check, False)
+
+        def check(result, create):
+            if result[-1] is not None:
+                return self.setVersion(result[-1])
+            if create:
+                return self.client.add(self.key, initial).addCallback(reread)
+            return self.setVersion(initial)
+        return self.client.get(self.key).addCallback(check, True)
+
+
+    def invalidate(self):
+        """
+        Move to a new version, so nothing memoized so far is used again.
+
+        @return: A C{Deferred} that fires with the new version.
+        """
+        def check(version):
+            if version:
+                return self.setVersion(version)
+            initial = self.initialVersion()
+            return self.client.set(self.key, initial).addCallback(lambda _: self.setVersion(initial))
+        return self.client.increment(self.key).addCallback(check)
+
+
+class Memoizer:
+    """
+    Memoizes one function.  Made by L{memoize}.
+
+    Results are stored in a 1-tuple, so that a stored C{None} can be told
+    apart from a miss.  If C{staleTime} or C{beta} is given, they are stored
+    and refreshed by the client's C{getOrCompute} and C{compute} instead.
+    """
+    prefix = "txyam:memo:"
+
+    def __init__(self, client, func, expireTime=0, namespace=None, cacheNone=False, noneExpireTime=None,
+                 name=None, staleTime=None, beta=None, lockTime=30):
+        self.client = client
         self.func = func
-        return self.caller
+        if name is None:
+            cls = getattr(func, 'im_class', None)
+            name = ".".join(filter(None, [func.__module__, cls and cls.__name__, func.__name__]))
+        self.name = name
+        self.expireTime = expireTime
+        self.namespace = namespace
+        self.cacheNone = cacheNone
+        self.noneExpireTime = expireTime if noneExpireTime is None else noneExpireTime
+        self.refreshing = staleTime is not None or beta is not None
+        self.staleTime = staleTime or 0
+        self.beta = beta
+        self.lockTime = lockTime
+        self.inflight = SingleFlight()
+
+
+    def makeKey(self, args, kwargs, version=None):
+        digest = hashlib.sha1(self.name + canonical((args, kwargs))).hexdigest()
+        if self.namespace is None:
+            return self.prefix + digest
+        return "%s%s:%s:%s" % (self.prefix, self.namespace.name, version, digest)
+
+
+    def getKeys(self, calls):
+        """
+        @param calls: A C{list} of C{(args, kwargs)} tuples.
+
+        @return: A C{Deferred} that fires with the C{list} of their keys.
+        """
+        def make(version):
+            return [self.makeKey(args, kwargs, version) for args, kwargs in calls]
+        if self.namespace is None:
+            return defer.succeed(make(None))
+        return self.namespace.getVersion().addCallback(make)
+
+
+    def coalesced(self, key, func, *args):
+        if self.client.coalesce:
+            # concurrent misses on the same key only compute func once
+            return self.inflight.call(key, func, *args)
+        return func(*args)
+
 
+    def call(self, args, kwargs):
+        def lookup(keys):
+            return self.coalesced(keys[0], self.lookup, keys[0], args, kwargs)
+        return self.getKeys([(args, kwargs)]).addCallback(lookup)
 
-    def caller(self, *args, **kwargs):
-        self.key = hashlib.sha1(repr(self.client) + repr(args) + repr(kwargs)).hexdigest()
-        d = self.client.getPickled(self.key)
-        return d.addCallback(self.handleResult, args, kwargs)
 
+    def lookup(self, key, args, kwargs):
+        d = self.client.getPickled(key)
+        return d.addCallback(self.handleResult, key, args, kwargs)
 
-    def saveResult(self, result):
-        d = self.client.setPickled(self.key, result)
+
+    def handleResult(self, result, key, args, kwargs):
+        if self.refreshing:
+            return self.client.useComputed(result, key, functools.partial(self.func, *args, **kwargs),
+                                           self.expireTime, self.staleTime, self.beta, self.lockTime,
+                                           self.cacheNone)
+        if result[-1] is None:
+            return self.compute(key, args, kwargs)
+        return result[-1][0]
+
+
+    def compute(self, key, args, kwargs):
+        if self.refreshing:
+            return self.client.compute(key, functools.partial(self.func, *args, **kwargs),
+                                       self.expireTime, self.staleTime, self.cacheNone)
+        d = defer.maybeDeferred(self.func, *args, **kwargs)
+        return d.addCallback(self.saveResult, key)
+
+
+    def saveResult(self, result, key):
+        if result is None and not self.cacheNone:
+            return None
+        expireTime = self.noneExpireTime if result is None else self.expireTime
+        d = self.client.setPickled(key, (result,), expireTime=expireTime)
         return d.addCallback(lambda _: result)
 
 
-    def handleResult(self, result, args, kwargs):
-        if result[1] is None:
-            d = defer.maybeDeferred(self.func, *args, **kwargs)
-            return d.addCallback(self.saveResult)
-        return defer.succeed(result[1])
+    def many(self, calls):
+        """
+        Call the function with each of the argument tuples in C{calls}, using
+        one C{getMultiple} to find the results that are already memoized.
+
+        @return: A C{Deferred} that fires with a C{list} of the results, in
+        the same order as C{calls}.
+        """
+        calls = [(tuple(args), {}) for args in calls]
+
+        def lookup(keys):
+            d = self.client.getMultiplePickled(list(set(keys)))
+            return d.addCallback(fill, keys)
+
+        def fill(results, keys):
+            ds = {}
+            for key, (args, kwargs) in zip(keys, calls):
+                result = results.get(key)
+                if key in ds:
+                    continue
+                elif result is None or result[-1] is None:
+                    ds[key] = self.coalesced(key, self.compute, key, args, kwargs)
+                else:
+                    ds[key] = defer.maybeDeferred(self.handleResult, result, key, args, kwargs)
+            unique = ds.keys()
+            d = defer.gatherResults([ds[key] for key in unique], consumeErrors=True)
+            d.addErrback(lambda failure: failure.value.subFailure)
+            return d.addCallback(lambda values: [dict(zip(unique, values))[key] for key in keys])
+        return self.getKeys(calls).addCallback(lookup)
+
+
+    def invalidate(self, args, kwargs):
+        return self.getKeys([(args, kwargs)]).addCallback(lambda keys: self.client.delete(keys[0]))
 
 
-def memoize(client):
+def memoize(client, expireTime=0, namespace=None, cacheNone=False, noneExpireTime=None, name=None,
+            staleTime=None, beta=None, lockTime=30):
     """
     Memoize a function.  Used like this:
 
@@ -67,8 +376,48 @@ def memoize(client):
         return takesForever(one, two)
 
     Where C{yamclient} is an instance of C{txyam.YamClient} in the
-    decorator.  The function will be memoized based on the function
-    name and arguments.  The function being memoized can return an
-    object, which will be picked before saving.
+    decorator.  The function will be memoized based on its module and name
+    and its arguments, encoded with L{canonical}, so every process shares
+    the results.  The function being memoized can return an object, which
+    will be pickled before saving.
+
+    The memoized function also has a C{many} method, which takes a C{list}
+    of positional argument tuples and looks all of them up at once (see
+    L{Memoizer.many}), and an C{invalidate} method, which takes the same
+    arguments as the function and forgets its result for them.
+
+    @param expireTime: How long, in seconds, results are kept.
+
+    @param namespace: An optional L{Namespace} to memoize in.
+
+    @param cacheNone: If C{True}, C{None} results are stored too.
+
+    @param noneExpireTime: How long C{None} results are kept, if not
+    C{expireTime} (only without C{staleTime} or C{beta}).
+
+    @param name: The name to use for the function in keys, if not its
+    module and name (for instance, to tell apart methods of different
+    classes in one module).
+
+    @param staleTime: If given, results are kept for this many seconds after
+    C{expireTime}, and returned while one caller recomputes them in the
+    background.  See C{YamClient.getOrCompute}.
+
+    @param beta: If given, results are recomputed early, as in
+    C{YamClient.getOrCompute}.
+
+    @param lockTime: The longest time, in seconds, a background recompute
+    keeps others from starting another.
     """
-    return Memoizer(client).memoize
+    def decorator(func):
+        memoizer = Memoizer(client, func, expireTime, namespace, cacheNone, noneExpireTime, name,
+                            staleTime, beta, lockTime)
+
+        @functools.wraps(func)
+        def memoized(*args, **kwargs):
+            return memoizer.call(args, kwargs)
+        memoized.many = memoizer.many
+        memoized.invalidate = lambda *args, **kwargs: memoizer.invalidate(args, kwargs)
+        memoized.memoizer = memoizer
+        return memoized
+    return decorator